@@ -0,0 +1,246 @@
+import asyncio
+import secrets
+import logging
+import httpx
+import openai
+from openai import AsyncOpenAI
+from telebot import types, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from storage import create_user_store
+from user_cache import UserCache
+from dispatcher import AsyncKeyedDispatcher, update_user_id
+from digest import DigestCache
+from digest_scheduler import AsyncDigestScheduler, create_digest_scheduler
+from send_queue import AsyncSendQueue
+from webhook import WebhookServer
+from retrieval import create_retriever
+from media import create_media_pipeline
+from llm_gateway import AsyncLLMGateway, create_llm_gateway
+from bot_logging import setup_logging
+from metrics import timed, QUEUE_DEPTH, IN_FLIGHT, start_metrics_server
+from bot_core import (
+    SCRIPT_DIR, User, load_config, save_config, check_config, get_proxy, configure,
+    AsyncBotHandlers, CONTENT_TYPES, run_steps_async
+)
+
+# Асинхронный вариант бота: AsyncTeleBot и AsyncOpenAI в одном цикле событий.
+# Логика обработчиков общая с main.py (bot_core.BotHandlers); ожидание ответов
+# Telegram и OpenAI не занимает потоки, поэтому одновременно обслуживаются
+# тысячи пользователей.
+
+# Настройка логирования
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Загрузка конфигурации
+config = load_config()
+check_config(config)
+# Дальше логи пишутся через очередь в отдельном потоке (секция "logging")
+setup_logging(config)
+configure(config)
+
+TELEGRAM_BOT_TOKEN = config["TELEGRAM_BOT_TOKEN"]
+OPENAI_API_KEY = config["OPENAI_API_KEY"]
+
+# Общие настройки пулов соединений. Telegram (aiohttp) и OpenAI (httpx)
+# держат свои пулы, но оба размера и прокси берутся отсюда
+proxy = get_proxy(config)
+http_pool_settings = config.get("http_pool", {})
+HTTP_MAX_CONNECTIONS = http_pool_settings.get("max_connections", 100)
+HTTP_MAX_KEEPALIVE = http_pool_settings.get("max_keepalive", 20)
+HTTP_KEEPALIVE_EXPIRY = http_pool_settings.get("keepalive_expiry", 30.0)
+
+asyncio_helper.proxy = proxy
+asyncio_helper.REQUEST_LIMIT = HTTP_MAX_CONNECTIONS
+if "TELEGRAM_API_URL" in config:
+    asyncio_helper.API_URL = config["TELEGRAM_API_URL"]
+
+bot = AsyncTeleBot(TELEGRAM_BOT_TOKEN)
+
+# Один клиент OpenAI на всё приложение: соединения переиспользуются между запросами
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    base_url=config.get("OPENAI_BASE_URL"),
+    max_retries=0,
+    http_client=openai.DefaultAsyncHttpxClient(
+        proxy=proxy,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+    )
+)
+llm = create_llm_gateway(config, client, AsyncLLMGateway)
+
+# Диспетчер обновлений: обновления одного пользователя - строго по порядку
+runtime_settings = config.get("async_runtime", {})
+dispatcher = AsyncKeyedDispatcher(
+    max_in_flight=runtime_settings.get("max_in_flight", 1000),
+    max_queue=runtime_settings.get("max_queue", 10000)
+)
+
+_process_new_updates = bot.process_new_updates
+
+# Раздача обновлений по очередям пользователей (offset AsyncTeleBot сдвигает сам)
+async def dispatch_updates(updates):
+    for update in updates:
+        await dispatcher.submit(update_user_id(update), _process_new_updates, [update])
+
+bot.process_new_updates = dispatch_updates
+
+# Очередь исходящих сообщений с учётом ограничений Telegram на частоту отправки
+send_queue_settings = config.get("send_queue", {})
+send_queue = AsyncSendQueue(
+    bot,
+    per_chat_rate=send_queue_settings.get("per_chat_rate", 1.0),
+    per_chat_burst=send_queue_settings.get("per_chat_burst", 3),
+    global_rate=send_queue_settings.get("global_rate", 30),
+    ack_delay=send_queue_settings.get("ack_delay", 1.5)
+)
+
+# Настройки потокового вывода ответов GPT
+streaming_settings = config.get("streaming", {})
+STREAMING_ENABLED = streaming_settings.get("enabled", True)
+STREAMING_EDIT_INTERVAL = streaming_settings.get("edit_interval", 1.5)
+
+# Хранилище данных пользователей. mark_dirty() только отмечает пользователя,
+# запись на диск идёт в фоновом потоке хранилища и цикл событий не блокирует
+user_store = create_user_store(config, SCRIPT_DIR, save_config)
+
+# Пользователи в памяти: загружаются из хранилища при первом сообщении,
+# давно неактивные вытесняются (секция "user_cache" в config.json)
+user_cache_settings = config.get("user_cache", {})
+user_data = UserCache(
+    user_store,
+    User,
+    on_evict=lambda user: handlers.release_user(user),
+    max_users=user_cache_settings.get("max_users", 10000),
+    idle_timeout=user_cache_settings.get("idle_timeout", 3600),
+    min_idle=user_cache_settings.get("min_idle", 300)
+)
+
+# Кэш сводок 'Show Info'
+digest_cache = DigestCache(user_store, incremental=config.get("digest", {}).get("incremental", True))
+
+# Выбор записей, относящихся к вопросу (секция "retrieval" в config.json)
+retrieval_settings = config.get("retrieval", {})
+retriever = create_retriever(config, SCRIPT_DIR)
+DIGEST_TOP_K = retrieval_settings.get("digest_top_k", 30)
+
+# Извлечение текста из голосовых, фото и документов режима 'info' (секция "media", по умолчанию выключено).
+# Файлы обрабатываются в потоках пула, а запросы к OpenAI идут через общий шлюз llm
+# в цикле событий (pipeline.loop задаётся в main())
+media_pipeline = create_media_pipeline(config, user_store, llm, proxy)
+
+# Заблаговременный расчёт сводок (секция "digest", по умолчанию выключен). Пока
+# занята половина слотов GPT, фоновые расчёты ждут и не мешают ответам пользователям
+digest_scheduler = create_digest_scheduler(
+    config,
+    lambda user, is_current: run_steps_async(handlers.precompute_digest(user, is_current)),
+    busy=lambda: llm.in_flight >= max(1, llm.max_in_flight // 2),
+    scheduler_class=AsyncDigestScheduler
+)
+
+# Команды и режимы бота (общие с main.py, см. bot_core.BotHandlers)
+handlers = AsyncBotHandlers(
+    llm, send_queue, user_data, user_store, digest_cache,
+    retriever=retriever,
+    media_pipeline=media_pipeline,
+    digest_scheduler=digest_scheduler,
+    streaming=STREAMING_ENABLED,
+    edit_interval=STREAMING_EDIT_INTERVAL,
+    digest_top_k=DIGEST_TOP_K
+)
+
+# Метрики очередей для /metrics (см. секцию "metrics" в config.json)
+QUEUE_DEPTH.set_function(lambda: dispatcher.queue_depth, queue="dispatcher")
+QUEUE_DEPTH.set_function(lambda: send_queue.queue_depth, queue="send_queue")
+QUEUE_DEPTH.set_function(lambda: user_store.dirty_count, queue="store")
+IN_FLIGHT.set_function(lambda: dispatcher.in_flight, component="dispatcher")
+IN_FLIGHT.set_function(lambda: llm.in_flight, component="llm")
+
+# Обработчик команды /start
+@bot.message_handler(commands=["start"])
+async def start(message):
+    await run_steps_async(handlers.start(message))
+
+# Обработчик команды /search <запрос>: поиск по сохранённым записям без запроса к GPT
+@bot.message_handler(commands=["search"])
+async def search_command(message):
+    await run_steps_async(handlers.search(message))
+
+# Обработчик команды /list [страница]: постраничный просмотр сохранённых записей
+@bot.message_handler(commands=["list"])
+async def list_command(message):
+    await run_steps_async(handlers.list_entries(message))
+
+# Обработчик команды /digest <тема>: сводка только по записям, относящимся к теме
+@bot.message_handler(commands=["digest"])
+async def digest_command(message):
+    await run_steps_async(handlers.digest(message))
+
+# Основной обработчик сообщений
+@bot.message_handler(func=lambda message: True, content_types=CONTENT_TYPES)
+@timed("dispatch")
+async def handle_messages(message):
+    await run_steps_async(handlers.handle_message(message))
+
+# Приём обновлений через webhook. HTTP-сервер работает в своих потоках
+# и передаёт обновления в цикл событий
+async def run_webhook():
+    loop = asyncio.get_running_loop()
+    settings = config.get("webhook", {})
+    path = settings.get("path", "/telegram")
+    # Если secret_token не задан, генерируем новый при каждом запуске
+    secret_token = settings.get("secret_token") or secrets.token_urlsafe(32)
+    server = WebhookServer(
+        lambda update: asyncio.run_coroutine_threadsafe(
+            bot.process_new_updates([types.Update.de_json(update)]), loop
+        ).result(),
+        host=settings.get("listen", "127.0.0.1"),
+        port=settings.get("port", 8443),
+        path=path,
+        secret_token=secret_token,
+        max_pending=settings.get("max_pending", 1000)
+    )
+    await bot.remove_webhook()
+    await bot.set_webhook(
+        url=settings["url"].rstrip("/") + path,
+        secret_token=secret_token,
+        max_connections=settings.get("max_connections", 40)
+    )
+    server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await asyncio.to_thread(server.stop)
+
+async def main():
+    user_store.start()
+    if media_pipeline is not None:
+        media_pipeline.loop = asyncio.get_running_loop()
+    start_metrics_server(config)
+    try:
+        if config.get("ingestion", "polling") == "webhook":
+            await run_webhook()
+        else:
+            await bot.infinity_polling()
+    finally:
+        # Дожидаемся обработки уже принятых обновлений и отправки ответов,
+        # затем сбрасываем несохранённые изменения
+        await dispatcher.shutdown()
+        await send_queue.close()
+        await asyncio.to_thread(user_store.close)
+        if retriever is not None:
+            retriever.close()
+        if media_pipeline is not None:
+            media_pipeline.close()
+        if digest_scheduler is not None:
+            digest_scheduler.close()
+        await client.close()
+        await bot.close_session()
+
+# Запуск бота: long polling (по умолчанию) или webhook
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,391 @@
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import tempfile
+import logging
+import resource
+from collections import defaultdict
+from bench_servers import FakeTelegramServer, FakeOpenAIServer
+
+# Нагрузочный тест бота (main.py) на локальных двойниках Bot API и OpenAI.
+#
+#   python bench.py --users 10,100,1000 --entries 0,200
+#   python bench.py --replay updates.jsonl
+#   python bench.py --json run.json --baseline previous.json
+#
+# Для каждой фазы (число пользователей x длина info_message) прогоняется
+# синтетический поток обновлений: текст, пересланные посты каналов, медиа с
+# подписью и серии нажатий 'Show Info'. Либо воспроизводятся записанные
+# обновления (по одному JSON объекта Update из Bot API на строку).
+# В отчёте: пропускная способность, p50/p95/p99 времени обработчика по типам
+# обновлений, время записи в хранилище и прирост памяти процесса.
+
+logger = logging.getLogger(__name__)
+
+# Настройки бота для теста: двойник Bot API не ограничивает частоту,
+# поэтому лимиты очереди отправки подняты, чтобы мерить сами обработчики
+BENCH_CONFIG = {
+    "TELEGRAM_BOT_TOKEN": "123456:BENCH",
+    "OPENAI_API_KEY": "sk-bench",
+    "proxy": "",
+    "send_queue": {"per_chat_rate": 1000, "per_chat_burst": 1000, "global_rate": 100000, "ack_delay": 0.05},
+    "streaming": {"edit_interval": 0.5}
+}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+# Текущий объём памяти процесса в МБ (RSS)
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        # Без /proc доступен только пиковый объём (на Linux в КБ)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Тип обновления для разбивки задержек
+def classify(update):
+    message = update.get("message") or update.get("edited_message") or {}
+    text = message.get("text")
+    if text == "Show Info":
+        return "show_info"
+    if message.get("forward_origin") or message.get("forward_from_chat"):
+        return "forward"
+    if message.get("caption") is not None:
+        return "caption"
+    if text and text.startswith("/"):
+        return "command"
+    if text in ("Add Info", "Ask GPT", "Exit to main menu", "Clear Info"):
+        return "menu"
+    return "text" if text is not None else "other"
+
+
+class UpdateFactory:
+    """Синтетические обновления в формате Bot API."""
+
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def message(self, user_id, text=None, forward_from=None, caption=None):
+        self.update_id += 1
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"}
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if forward_from is not None:
+            message["forward_origin"] = {
+                "type": "channel", "date": 0, "message_id": self.message_id,
+                "chat": {"id": forward_from, "type": "channel", "title": "Канал"}
+            }
+        if caption is not None:
+            message["caption"] = caption
+            message["photo"] = [{"file_id": f"photo{self.message_id}", "file_unique_id": f"u{self.message_id}",
+                                 "width": 1280, "height": 720}]
+        return {"update_id": self.update_id, "message": message}
+
+    # Сценарий одного пользователя: запись заметок, показ сводки, вопрос GPT
+    def session(self, user_id, messages=10, show_info_burst=3, gpt_questions=1):
+        updates = [self.message(user_id, "/start"), self.message(user_id, "Add Info")]
+        for i in range(messages):
+            kind = i % 3
+            if kind == 0:
+                updates.append(self.message(user_id, f"Заметка {i}: купить молоко, https://example.com/{i}"))
+            elif kind == 1:
+                updates.append(self.message(user_id, f"Пост канала {i} со ссылкой https://example.com/post/{i}",
+                                            forward_from=-1001000000000 - i % 7))
+            else:
+                updates.append(self.message(user_id, caption=f"Фото {i} с подписью"))
+        updates += [self.message(user_id, "Show Info") for _ in range(show_info_burst)]
+        updates.append(self.message(user_id, "Exit to main menu"))
+        if gpt_questions:
+            updates.append(self.message(user_id, "Ask GPT"))
+            updates += [self.message(user_id, f"Вопрос {i}?") for i in range(gpt_questions)]
+            updates.append(self.message(user_id, "Exit to main menu"))
+        return updates
+
+
+# Перемешивание сценариев: пользователи отправляют сообщения вперемешку,
+# но порядок внутри сценария сохраняется
+def interleave(sessions):
+    updates = []
+    sessions = [list(session) for session in sessions]
+    position = 0
+    while any(position < len(session) for session in sessions):
+        updates += [session[position] for session in sessions if position < len(session)]
+        position += 1
+    return updates
+
+
+def load_replay(path):
+    with open(path, encoding="utf-8") as replay:
+        return [json.loads(line) for line in replay if line.strip()]
+
+
+class Bench:
+    """Запуск main.py против двойников и замеры по фазам."""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="nelegal-bench-")
+        self.telegram = FakeTelegramServer(latency=args.telegram_latency).start()
+        self.openai = FakeOpenAIServer(
+            latency=args.llm_latency, token_delay=args.token_delay,
+            completion_tokens=args.completion_tokens, jitter=args.jitter
+        ).start()
+        self.factory = UpdateFactory()
+        self.next_user_id = 10_000_000
+        self.app = self._start_app()
+
+    def _start_app(self):
+        config = dict(BENCH_CONFIG)
+        config["TELEGRAM_API_URL"] = self.telegram.api_url
+        config["OPENAI_BASE_URL"] = self.openai.api_url
+        # Все данные бота - во временном каталоге, а не рядом с main.py
+        config["storage"] = {"path": os.path.join(self.workdir, "users.db")}
+        config["retrieval"] = {"path": os.path.join(self.workdir, "vectors")}
+        if self.args.config:
+            with open(self.args.config, encoding="utf-8") as extra:
+                for key, value in json.load(extra).items():
+                    if isinstance(value, dict) and isinstance(config.get(key), dict):
+                        config[key] = dict(config[key], **value)
+                    else:
+                        config[key] = value
+        config_path = os.path.join(self.workdir, "config.json")
+        with open(config_path, "w", encoding="utf-8") as config_file:
+            json.dump(config, config_file, ensure_ascii=False)
+
+        # Бот импортируется только после подготовки config.json
+        os.environ["NELEGAL_CONFIG"] = config_path
+        os.environ["NO_PROXY"] = "127.0.0.1,localhost"
+        import main as app
+
+        self.latencies = defaultdict(list)
+        self.kinds = {}
+        process = app._process_new_updates
+
+        # Время обработчика без ожидания в очереди диспетчера
+        def timed_process(updates):
+            start = time.perf_counter()
+            try:
+                process(updates)
+            finally:
+                elapsed = time.perf_counter() - start
+                for update in updates:
+                    self.latencies[self.kinds.pop(update.update_id, "other")].append(elapsed)
+
+        app._process_new_updates = timed_process
+
+        self.persist_times = []
+        write = app.user_store._write
+
+        def timed_write(records, rewrite, edited):
+            start = time.perf_counter()
+            try:
+                return write(records, rewrite, edited)
+            finally:
+                self.persist_times.append(time.perf_counter() - start)
+
+        app.user_store._write = timed_write
+        return app
+
+    # Пользователи с уже накопленными записями info_message
+    def seed_users(self, user_ids, entries):
+        for user_id in user_ids:
+            user = self.app.User(user_id)
+            user.info_message = [
+                {"user_text": f"Старая заметка {i}", "forwarded_text": f"Текст поста {i} " * 5,
+                 "link": f"https://t.me/c/1000/{i}"}
+                for i in range(entries)
+            ]
+            self.app.user_data[user_id] = user
+            self.app.user_store.mark_dirty(user)
+
+    def wait_idle(self, timeout=600):
+        deadline = time.monotonic() + timeout
+        ack_delay = self.app.send_queue.ack_delay
+        while time.monotonic() < deadline:
+            dispatcher, send_queue = self.app.dispatcher, self.app.send_queue
+            if not (dispatcher.queue_depth or dispatcher.in_flight or send_queue.queue_depth):
+                # Отложенные подтверждения уходят через ack_delay
+                time.sleep(ack_delay + 0.05)
+                if not (dispatcher.queue_depth or dispatcher.in_flight or send_queue.queue_depth):
+                    return True
+            time.sleep(0.01)
+        logger.warning("Бот не завершил обработку за отведённое время.")
+        return False
+
+    def run_phase(self, name, updates, users=0, entries=0):
+        app = self.app
+        self.latencies.clear()
+        self.persist_times.clear()
+        telegram_before = dict(self.telegram.calls)
+        openai_before = self.openai.calls["chat.completions"]
+        rss_before = rss_mb()
+
+        start = time.perf_counter()
+        batch = self.args.batch
+        for i in range(0, len(updates), batch):
+            chunk = updates[i:i + batch]
+            for update in chunk:
+                self.kinds[update["update_id"]] = classify(update)
+            app.bot.process_new_updates([app.types.Update.de_json(update) for update in chunk])
+        self.wait_idle()
+        wall = time.perf_counter() - start
+
+        flush_start = time.perf_counter()
+        app.user_store.flush()
+        final_flush = time.perf_counter() - flush_start
+
+        all_latencies = [value for values in self.latencies.values() for value in values]
+        return {
+            "phase": name,
+            "users": users,
+            "entries": entries,
+            "updates": len(updates),
+            "wall_s": wall,
+            "throughput": len(updates) / wall if wall else 0.0,
+            "latency": self._latency_stats(all_latencies),
+            "latency_by_kind": {kind: self._latency_stats(values) for kind, values in sorted(self.latencies.items())},
+            "persistence_s": sum(self.persist_times),
+            "persistence_writes": len(self.persist_times),
+            "final_flush_ms": final_flush * 1000,
+            "rss_mb": rss_mb(),
+            "rss_growth_mb": rss_mb() - rss_before,
+            "openai_calls": self.openai.calls["chat.completions"] - openai_before,
+            "telegram_calls": {method: count - telegram_before.get(method, 0)
+                               for method, count in self.telegram.calls.items()
+                               if count - telegram_before.get(method, 0)}
+        }
+
+    @staticmethod
+    def _latency_stats(values):
+        return {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000
+        }
+
+    def synthetic_phase(self, users, entries):
+        user_ids = list(range(self.next_user_id, self.next_user_id + users))
+        self.next_user_id += users
+        self.seed_users(user_ids, entries)
+        sessions = [
+            self.factory.session(user_id, self.args.messages, self.args.show_info_burst, self.args.gpt_questions)
+            for user_id in user_ids
+        ]
+        return self.run_phase(f"users={users} entries={entries}", interleave(sessions), users, entries)
+
+    def close(self):
+        self.app.dispatcher.shutdown()
+        self.app.send_queue.close()
+        self.app.user_store.close()
+        if self.app.retriever is not None:
+            self.app.retriever.close()
+        self.telegram.stop()
+        self.openai.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def format_report(results, baseline=None):
+    previous = {result["phase"]: result for result in (baseline or [])}
+    lines = []
+    for result in results:
+        latency = result["latency"]
+        lines.append(f"== {result['phase']}: {result['updates']} обновлений за {result['wall_s']:.2f} с")
+        lines.append(f"   пропускная способность: {result['throughput']:.1f} обн/с"
+                     + _delta(result, previous.get(result["phase"]), lambda r: r["throughput"]))
+        lines.append(f"   обработчик: p50 {latency['p50_ms']:.1f} мс, p95 {latency['p95_ms']:.1f} мс, "
+                     f"p99 {latency['p99_ms']:.1f} мс"
+                     + _delta(result, previous.get(result["phase"]), lambda r: r["latency"]["p95_ms"], "p95 "))
+        for kind, stats in result["latency_by_kind"].items():
+            lines.append(f"     {kind:<10} n={stats['count']:<6} p50 {stats['p50_ms']:.1f} мс, "
+                         f"p95 {stats['p95_ms']:.1f} мс, p99 {stats['p99_ms']:.1f} мс")
+        lines.append(f"   хранилище: {result['persistence_s'] * 1000:.1f} мс на {result['persistence_writes']} записей, "
+                     f"финальный сброс {result['final_flush_ms']:.1f} мс")
+        lines.append(f"   память: {result['rss_mb']:.1f} МБ (прирост {result['rss_growth_mb']:+.1f} МБ)")
+        lines.append(f"   вызовы: OpenAI {result['openai_calls']}, Telegram {result['telegram_calls']}")
+    return "\n".join(lines)
+
+
+def _delta(result, previous, metric, label=""):
+    if not previous or not metric(previous):
+        return ""
+    change = (metric(result) - metric(previous)) / metric(previous) * 100
+    return f" ({label}{change:+.1f}% к базовому прогону)"
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на двойниках Bot API и OpenAI")
+    parser.add_argument("--users", default="10,100", help="числа пользователей по фазам через запятую")
+    parser.add_argument("--entries", default="0,100", help="длины info_message по фазам через запятую")
+    parser.add_argument("--messages", type=int, default=9, help="сообщений в режиме 'info' на пользователя")
+    parser.add_argument("--show-info-burst", type=int, default=3, help="нажатий 'Show Info' подряд")
+    parser.add_argument("--gpt-questions", type=int, default=1, help="вопросов в режиме 'gpt'")
+    parser.add_argument("--replay", help="файл с записанными обновлениями (JSON на строку)")
+    parser.add_argument("--batch", type=int, default=100, help="обновлений в одной пачке, как у getUpdates")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="задержка OpenAI до первого токена, с")
+    parser.add_argument("--token-delay", type=float, default=0.005, help="пауза между токенами, с")
+    parser.add_argument("--completion-tokens", type=int, default=200, help="длина ответа OpenAI в токенах")
+    parser.add_argument("--jitter", type=float, default=0.2, help="разброс задержек OpenAI в долях")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument("--config", help="JSON с дополнительными настройками бота")
+    parser.add_argument("--output", default="bench_output.txt", help="куда дописать текстовый отчёт")
+    parser.add_argument("--json", help="куда сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="JSON прошлого прогона для сравнения")
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    bench = Bench(args)
+    # Логи бота на каждое сообщение искажают замеры
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = []
+    try:
+        if args.replay:
+            results.append(bench.run_phase(f"replay {os.path.basename(args.replay)}", load_replay(args.replay)))
+        else:
+            for entries in [int(value) for value in args.entries.split(",")]:
+                for users in [int(value) for value in args.users.split(",")]:
+                    results.append(bench.synthetic_phase(users, entries))
+    finally:
+        bench.close()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+    report = format_report(results, baseline)
+    print(report)
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as output:
+            output.write(f"# {time.strftime('%Y-%m-%d %H:%M:%S')} {' '.join(sys.argv[1:])}\n{report}\n\n")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    run()
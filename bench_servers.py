@@ -0,0 +1,201 @@
+import json
+import time
+import random
+import threading
+import logging
+from collections import Counter
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Локальные двойники Bot API и OpenAI для нагрузочного теста (bench.py)
+
+
+class _FakeServer:
+    """Общая часть двойников: ThreadingHTTPServer в фоновом потоке."""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    @property
+    def base_url(self):
+        return f"http://{self.address[0]}:{self.address[1]}"
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def handle(self, request):
+        raise NotImplementedError
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.handle(self)
+
+            def do_POST(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# Чтение параметров запроса: строка запроса, форма или JSON
+def read_params(request):
+    url = urlsplit(request.path)
+    params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+    length = int(request.headers.get("Content-Length", 0) or 0)
+    body = request.rfile.read(length) if length else b""
+    content_type = request.headers.get("Content-Type", "")
+    if body and "json" in content_type:
+        params.update(json.loads(body))
+    elif body and "multipart" not in content_type:
+        params.update({key: values[-1] for key, values in parse_qs(body.decode("utf-8")).items()})
+    return url.path, params
+
+
+def send_json(request, payload, status=200):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    request.send_response(status)
+    request.send_header("Content-Type", "application/json")
+    request.send_header("Content-Length", str(len(body)))
+    request.end_headers()
+    request.wfile.write(body)
+
+
+class FakeTelegramServer(_FakeServer):
+    """
+    Двойник Bot API: отвечает на sendMessage/editMessageText и прочие методы
+    без ограничений частоты, считает вызовы по методам. latency - задержка
+    ответа в секундах. Адрес для TELEGRAM_API_URL - api_url.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        super().__init__(host, port)
+        self.latency = latency
+        self._message_id = 0
+
+    @property
+    def api_url(self):
+        return self.base_url + "/bot{0}/{1}"
+
+    def handle(self, request):
+        path, params = read_params(request)
+        method = path.rsplit("/", 1)[-1]
+        self._count(method)
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            with self._lock:
+                self._message_id += 1
+                message_id = self._message_id
+            result = {
+                "message_id": int(params.get("message_id", message_id)),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", "")
+            }
+        elif method == "getUpdates":
+            result = []
+        else:
+            result = True
+        send_json(request, {"ok": True, "result": result})
+
+
+class FakeOpenAIServer(_FakeServer):
+    """
+    Двойник OpenAI /v1/chat/completions.
+
+    latency - время до первого токена, token_delay - пауза между токенами,
+    completion_tokens - длина ответа в токенах (jitter - разброс задержек в
+    долях). Поддерживает stream=True (SSE). Адрес для OPENAI_BASE_URL - api_url.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.5, token_delay=0.01,
+                 completion_tokens=200, jitter=0.2):
+        super().__init__(host, port)
+        self.latency = latency
+        self.token_delay = token_delay
+        self.completion_tokens = completion_tokens
+        self.jitter = jitter
+        self.prompt_tokens = 0
+
+    @property
+    def api_url(self):
+        return self.base_url + "/v1"
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def handle(self, request):
+        path, params = read_params(request)
+        if not path.endswith("/chat/completions"):
+            send_json(request, {"error": {"message": "not found"}}, status=404)
+            return
+        self._count("chat.completions")
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in params.get("messages", [])) // 4 + 1
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+        tokens = ["слово "] * self.completion_tokens
+        base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": params.get("model", "gpt-4o")}
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens + len(tokens)}
+
+        self._sleep(self.latency)
+        if not params.get("stream"):
+            self._sleep(self.token_delay * len(tokens))
+            send_json(request, dict(base, object="chat.completion", usage=usage, choices=[{
+                "index": 0, "finish_reason": "stop",
+                "message": {"role": "assistant", "content": "".join(tokens)}
+            }]))
+            return
+
+        request.send_response(200)
+        request.send_header("Content-Type", "text/event-stream")
+        request.send_header("Transfer-Encoding", "chunked")
+        request.end_headers()
+
+        def event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            request.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            request.wfile.flush()
+
+        for token in tokens:
+            event(json.dumps(dict(base, object="chat.completion.chunk", choices=[{
+                "index": 0, "finish_reason": None, "delta": {"content": token}
+            }]), ensure_ascii=False))
+            self._sleep(self.token_delay)
+        event(json.dumps(dict(base, object="chat.completion.chunk", choices=[{
+            "index": 0, "finish_reason": "stop", "delta": {}
+        }])))
+        if (params.get("stream_options") or {}).get("include_usage"):
+            event(json.dumps(dict(base, object="chat.completion.chunk", choices=[], usage=usage)))
+        event("[DONE]")
+        request.wfile.write(b"0\r\n\r\n")
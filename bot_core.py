@@ -0,0 +1,851 @@
+import os
+import json
+import re
+import time
+import asyncio
+import inspect
+import logging
+from telebot import types, util
+from gpt_history import ConversationWindow
+from metrics import timed, UPDATES
+from bot_logging import body
+from llm_gateway import LLMError
+from streaming import StreamingReply, AsyncStreamingReply, split_message
+from send_queue import QueuedBot, AsyncQueuedBot
+from search import search_settings, search_entries, format_search_results, parse_page, format_page
+from media import media_refs, describe_media
+from ingest import DedupIndex, message_text, render_text, forward_source, merge_entry
+
+logger = logging.getLogger(__name__)
+
+# Общая часть синхронного (main.py) и асинхронного (async_main.py) запуска бота:
+# конфигурация, состояние пользователя, клавиатуры, подготовка запросов к GPT
+# и обработчики команд и режимов (BotHandlers)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Путь к config.json можно переопределить переменной окружения NELEGAL_CONFIG
+# (например, для нагрузочного теста bench.py)
+CONFIG_PATH = os.environ.get("NELEGAL_CONFIG", os.path.join(SCRIPT_DIR, "config.json"))
+
+# Прокси по умолчанию для Telegram и OpenAI (пустая строка - без прокси)
+DEFAULT_PROXY = "http://127.0.0.1:2080"
+
+# Функция загрузки конфигурации из config.json
+def load_config():
+    config_path = CONFIG_PATH
+    logger.info("Пытаюсь загрузить конфигурацию из: %s", config_path)
+    if os.path.exists(config_path):
+        with open(config_path, "r", encoding='utf-8') as config_file:
+            try:
+                config = json.load(config_file)
+                logger.info("Конфигурация успешно загружена.")
+                return config
+            except json.JSONDecodeError as e:
+                logger.error("Ошибка при разборе config.json: %s", e)
+                return {}
+    else:
+        logger.error("Файл config.json не найден.")
+        return {}
+
+# Функция сохранения конфигурации в config.json
+def save_config(config):
+    config_path = CONFIG_PATH
+    # Пишем во временный файл и подменяем, чтобы не оставить config.json недописанным
+    tmp_path = config_path + ".tmp"
+    with open(tmp_path, "w", encoding='utf-8') as config_file:
+        json.dump(config, config_file, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, config_path)
+    logger.info("Конфигурация сохранена.")
+
+# Проверка наличия необходимых ключей в конфигурации
+def check_config(config):
+    missing_keys = []
+    if "TELEGRAM_BOT_TOKEN" not in config:
+        missing_keys.append("TELEGRAM_BOT_TOKEN")
+    if "OPENAI_API_KEY" not in config:
+        missing_keys.append("OPENAI_API_KEY")
+
+    if missing_keys:
+        raise KeyError(f"Отсутствуют ключи в config.json: {', '.join(missing_keys)}")
+
+# Адрес прокси из config.json
+def get_proxy(config):
+    return config.get("proxy", DEFAULT_PROXY) or None
+
+# Гиперссылки в HTML-разметке (для записей, сохранённых в этом виде)
+HTML_LINK_REGEX = re.compile(r'<a href="([^"]+)">([^<]+)</a>')
+
+# Настройки окна истории для режима 'gpt' (задаются через configure())
+gpt_history_settings = {}
+
+# Применение настроек из config.json к общей части
+def configure(config):
+    gpt_history_settings.clear()
+    gpt_history_settings.update(config.get("gpt_history", {}))
+    search_settings.update(config.get("search", {}))
+
+# Создание новой истории диалога с GPT
+def new_conversation():
+    return ConversationWindow(
+        token_budget=gpt_history_settings.get("token_budget", 6000),
+        keep_recent=gpt_history_settings.get("keep_recent", 4)
+    )
+
+# Пустая текущая запись режима 'info'
+def empty_info_message():
+    return {
+        'user_text': None,
+        'forwarded_text': 'Неизвестно',
+        'link': 'Неизвестно',
+        'source': None,
+        'media': [],
+        'timestamp': None
+    }
+
+# Класс для хранения состояния пользователя. __slots__ экономит память,
+# а история GPT и индекс повторов создаются только при первом обращении
+class User:
+    __slots__ = ('user_id', 'mode', '_history', 'info_message', 'current_info_message', '_dedup', '_edited')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.mode = 'main'
+        self._history = None
+        self.info_message = []
+        self.current_info_message = empty_info_message()
+        self._dedup = None
+        self._edited = None
+
+    @property
+    def history_for_gpt_mode(self):
+        if self._history is None:
+            self._history = new_conversation()
+        return self._history
+
+    @history_for_gpt_mode.setter
+    def history_for_gpt_mode(self, history):
+        self._history = history
+
+    # Позиция уже сохранённой записи того же поста (или None)
+    def find_duplicate(self, entry):
+        index = self._dedup
+        # info_message мог быть заменён или укорочен (например, 'Clear Info')
+        if index is None or index.entries is not self.info_message or index.size > len(self.info_message):
+            index = self._dedup = DedupIndex(self.info_message)
+        else:
+            index.update()
+        return index.find(entry)
+
+    # Отметка записи, изменённой на месте (её нужно перезаписать в хранилище)
+    def mark_edited(self, position):
+        if self._edited is None:
+            self._edited = set()
+        self._edited.add(position)
+
+    # Позиции изменённых на месте записей с прошлого сохранения (см. UserStore.flush)
+    def take_edited(self):
+        edited, self._edited = self._edited, None
+        return edited
+
+    # Состояние, которого нет в хранилище: незавершённая запись 'info' и
+    # история 'Ask GPT'. Передаётся новому процессу при перезапуске
+    # обработчика (см. supervisor.py); None, если передавать нечего
+    def handoff_state(self):
+        history = self._history.export() if self._history is not None else None
+        if current_entry(self.current_info_message) is None and not (history and (history['turns'] or history['summary'])):
+            return None
+        return {
+            'user_id': self.user_id,
+            'mode': self.mode,
+            'current_info_message': self.current_info_message,
+            'history': history
+        }
+
+    def restore_handoff(self, state):
+        self.mode = state['mode']
+        self.current_info_message = state['current_info_message']
+        if state['history'] is not None:
+            self._history = new_conversation()
+            self._history.restore(state['history'])
+
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'mode': self.mode,
+            'info_message': self.info_message
+        }
+
+    @staticmethod
+    def from_dict(data):
+        user = User(data['user_id'])
+        user.mode = data.get('mode', 'main')
+        user.info_message = list(data.get('info_message', []))
+        return user
+
+# Запись, в которую превратится текущая запись режима 'info' (или None, если она пуста)
+def current_entry(current):
+    if not (current['user_text'] or current['forwarded_text'] != 'Неизвестно' or current.get('media')):
+        return None
+    entry = {
+        'user_text': current['user_text'] if current['user_text'] else 'Неизвестно',
+        'forwarded_text': current['forwarded_text'],
+        'link': current['link']
+    }
+    if current.get('source'):
+        entry['source'] = current['source']
+    if current.get('media'):
+        entry['media'] = current['media']
+    return entry
+
+# Перенос текущей записи в info_message. Повторно пересланный пост не
+# добавляется заново: комментарий дописывается к прежней записи.
+# Возвращает True, если info_message изменился
+def flush_current_info(user):
+    entry = current_entry(user.current_info_message)
+    changed = False
+    if entry is not None:
+        position = user.find_duplicate(entry) if entry['forwarded_text'] != 'Неизвестно' else None
+        if position is None:
+            user.info_message.append(entry)
+            changed = True
+        else:
+            changed = merge_entry(user.info_message[position], entry)
+            if changed:
+                user.mark_edited(position)
+            logger.info("Повторно пересланный пост объединён с записью %d пользователя %s", position, user.user_id,
+                        extra={"event": "info_entry_merged"})
+    user.current_info_message = empty_info_message()
+    return changed
+
+# Вытеснение пользователя из памяти (см. UserCache): незавершённая запись
+# режима 'info' переносится в info_message и сохраняется
+def evict_user(store, user):
+    if flush_current_info(user):
+        store.mark_dirty(user)
+
+# Создание клавиатуры главного меню
+main_menu_keyboard = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
+button_add_info = types.KeyboardButton('Add Info')
+button_ask_gpt = types.KeyboardButton('Ask GPT')
+main_menu_keyboard.add(button_add_info, button_ask_gpt)
+
+# Создание клавиатуры для выхода в главное меню
+exit_keyboard = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
+exit_button = types.KeyboardButton('Exit to main menu')
+exit_keyboard.add(exit_button)
+
+# Создание клавиатуры для режима сбора информации
+info_keyboard = types.ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
+show_info_button = types.KeyboardButton('Show Info')
+clear_info_button = types.KeyboardButton('Clear Info')  # Добавлена кнопка 'Clear Info'
+info_keyboard.add(show_info_button, clear_info_button, exit_button)
+
+# Клавиатура текущего режима (для ответов на команды вне основного обработчика)
+def mode_keyboard(mode):
+    if mode == 'main':
+        return main_menu_keyboard
+    if mode == 'info':
+        return info_keyboard
+    return exit_keyboard
+
+
+# Функция для конвертации гиперссылок в формат 'слово (ссылка)'
+def convert_links(text):
+    if '<a ' not in text:
+        return text
+    return HTML_LINK_REGEX.sub(r'\2 (\1)', text)
+
+# Функция для форматирования одной сохранённой записи
+def format_entry(entry):
+    if isinstance(entry, dict):
+        user_text = entry.get('user_text', 'Неизвестно')
+        forwarded_text = entry.get('forwarded_text', 'Неизвестно')
+        link = entry.get('link', 'Неизвестно')
+    elif isinstance(entry, (list, tuple)):
+        try:
+            user_text, forwarded_text, link = entry
+        except ValueError:
+            user_text, forwarded_text, link = "Неизвестно", "Неизвестно", "Неизвестно"
+    else:
+        user_text, forwarded_text, link = "Неизвестно", "Неизвестно", "Неизвестно"
+
+    text = (
+        f"1. Мой текст:\n{user_text}\n"
+        f"2. Текст пересылаемого поста:\n{forwarded_text}\n"
+        f"3. Ссылка на пост:\n{link}"
+    )
+    # Вложения: расшифровки и описания, полученные из медиа (см. media.py)
+    media = entry.get('media') if isinstance(entry, dict) else None
+    if media:
+        text += "\n4. Вложения:\n" + "\n".join(describe_media(ref) for ref in media)
+    return text
+
+# Записи для сводки 'Show Info' (с гиперссылками в формате 'слово (ссылка)').
+# include_current - вместе с ещё не перенесённой текущей записью, как её
+# добавит flush_current_info() (для заблаговременного расчёта сводки; повтор
+# уже сохранённого поста здесь не объединяется, и сводка просто пересчитается)
+@timed("structuring")
+def digest_entries(user, include_current=False):
+    entries = list(user.info_message)
+    if include_current:
+        entry = current_entry(user.current_info_message)
+        if entry is not None:
+            entries.append(entry)
+    return [convert_links(format_entry(entry)) for entry in entries]
+
+# Инструкция для GPT в режиме 'info'
+INFO_PROMPT = "Привет, твоя задача помогать мне структурировать, анализировать и форматировать получаемую информацию. Я буду присылать тебе инофрмацию запросов вот такого формата:  1. Мой текст: Текст моего сообщения, проанализировав который ты поймешь, что нужно с ним сделать. Добавить в Календарь, Напоминание, Заметки, другую информацию или что-то еще. 2. Текст пересылаемого поста: Неизвестно  ( это означает что поста нет ) 3. Ссылка на пост: Неизвестно  ( так как поста нет, то нет и ссылки ) 1. Мой текст: Мое сообщение связанное с потом, например я хочу вечером поставить эти видео себе на обои. 2. Текст пересылаемого поста: (если текста нет, то просто ссылка) 3. Ссылка на пост: https://t.me/c/2107490410/2732 1. Мой текст: Неизвестно  ( моего сообщений нет, значит я хочу просто получить информацию о посте. попробуй кратко изложить о чем этот пост, а также понять для чего я тебе его прислал) 2. Текст пересылаемого поста: Apple AirPods 2 13900 > от 7800 https://fas.st/3BG5c4?erid=25H8d7vbP8SRTvJ4Q27doN 3. Ссылка на пост: https://t.me/c/1785748423/2313  Формать вывода должен быть следующим:  ❗️ Важное ❗️ ➕ текст важных сообщений, которые я помечаю словом важно 🔔 Напоминания ➕Дата, время, действие ➖ ( отмена напоминания)  событие 📅 Календарь ➕ Дата 07:00, 21 числа, тип календаря [Учеба,Рабочий,Домашние дела,Ученики,События,Зал,Дела], у Яузы с кентами ( можно перефразировать) ➕ 17:00, завтра ( дату напиши) , Рабочий , совещание 🗒 Заметки ➕ папка [[Заметки,Документы,Проекты,Жизнь,Работа] если пишется проекто то я указываю название и ты тоже указывай в красивом формате, тоже самое с Работой. - заметка фильмы: «Атака Титанов: Последняя Атака» выйдет в российских кинотеатрах, мировая премьера 8 ноября. ➕ Проекты nelegal - хочу изменить бота, информация по ссылке: [нет доступа к материалу] ( ссылку все равно присылай даже если нет доступа к ней) (нужен смайлик) Другая информация ➕ Я хочу почитать книгу вечером ➕ нужно начать ходит в зал 📎 Информация связанная с постами --- (сний кружок смайлик) Мое сообщение на тему поста (смайлик связанный с темой поста) Заголовок поста, который ты сам напишешь проанализируя пост Ссылка: (https://t.me/c/1103688715/20974) --- (сний кружок смайлик) Мое сообщение на тему поста (Нет текста или нельзя проанализировать пост, просто ссылка идет) (красный кружок смайлик)Ссылка: (https://t.me/c/2192407202/2794) --- (Нет текста или нельзя проанализировать пост, просто ссылка идет) (красный кружок смайлик)Ссылка: (https://t.me/c/2192407202/2794)  Разделители и оформление можешь придумать сам. После того как ты получишь это сообщение, ответь лишь Готов к работе. и тогда я начну присылать информацию, на которую ты всегда отвечаешь на основе полученной информации. Если информация связанная с потом идет в заметки, указывай сразу в заметках пост, а снизу не указывай."
+
+# Сообщения для запроса в режиме 'info'
+def build_info_messages(user_message):
+    history_openai_format = [
+        {
+            "role": "user",
+            "content": INFO_PROMPT
+        }
+    ]
+
+    history_openai_format.append({"role": "assistant", "content": "Готов к работе."})
+    history_openai_format.append({"role": "user", "content": user_message})
+    return history_openai_format
+
+# Заголовок сообщения с сохранёнными записями, относящимися к вопросу в режиме 'gpt'
+NOTES_PREFIX = "Мои сохранённые записи, которые могут относиться к вопросу:\n\n"
+
+# Сообщение с записями для запроса в режиме 'gpt' (в историю диалога не попадает)
+def build_notes_message(notes):
+    return {"role": "system", "content": NOTES_PREFIX + "\n\n".join(notes)}
+
+# Сообщения для сжатия старой части диалога 'gpt' в краткое содержание
+def build_summary_messages(summary, messages):
+    dialog = "\n\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    return [
+        {
+            "role": "system",
+            "content": "Сожми диалог пользователя с ассистентом в краткое содержание. "
+                       "Сохрани факты, договорённости и вопросы, которые ещё обсуждаются."
+        },
+        {
+            "role": "user",
+            "content": f"Предыдущее краткое содержание:\n{summary or 'Нет'}\n\nНовые реплики:\n{dialog}"
+        }
+    ]
+
+# Обновлённая функция для генерации ссылки на исходное сообщение
+def get_message_link(message):
+    """
+    Генерирует ссылку на исходное сообщение из канала или группы, откуда было переслано сообщение.
+    Использует forward_from_chat.id (начинается с -100) и forward_from_message_id.
+    Предполагается, что все сообщения, обрабатываемые в режиме 'info', являются пересланными из каналов или групп.
+    """
+    if not message.forward_from_chat or not message.forward_from_message_id:
+        # Сообщение не переслано из канала или группы
+        logger.debug("Сообщение не переслано из канала или группы.")
+        return None
+
+    original_chat_id = message.forward_from_chat.id
+    original_message_id = message.forward_from_message_id
+
+    # Удаляем префикс '-100' из chat_id
+    chat_id_str = str(original_chat_id)[4:]
+
+    # Генерируем ссылку
+    return f"https://t.me/c/{chat_id_str}/{original_message_id}"
+
+# Сохранение текста сообщения (или подписи к медиа) в текущую запись режима 'info'
+def save_info_text(user, message):
+    # Скрытые гиперссылки раскрываются до strip(): смещения entities считаются от начала текста
+    text = render_text(*message_text(message)).strip()
+    media = user.current_info_message.setdefault('media', [])
+    known = {ref['id'] for ref in media}
+    media.extend(ref for ref in media_refs(message) if ref['id'] not in known)
+
+    if message.forward_from or message.forward_from_chat:
+        # Обработка пересланного сообщения. У альбома подпись есть только у
+        # одного файла, поэтому пустая подпись не затирает уже сохранённый текст
+        if text or user.current_info_message['forwarded_text'] == 'Неизвестно':
+            user.current_info_message['forwarded_text'] = text
+        user.current_info_message['source'] = forward_source(message)
+        logger.info("Сохранён текст пересланного сообщения для пользователя %s: %s", user.user_id, body(text),
+                    extra={"event": "info_text_saved"})
+        # Генерация ссылки
+        link = get_message_link(message)
+        if link:
+            user.current_info_message['link'] = link
+            logger.debug("Сгенерирована ссылка: %s для пользователя %s", link, user.user_id)
+        else:
+            user.current_info_message['link'] = "Неизвестно"
+            logger.info("Не удалось сгенерировать ссылку для пересланного сообщения у пользователя %s", user.user_id)
+    else:
+        # Обработка собственного сообщения пользователя
+        if text or not user.current_info_message['user_text']:
+            user.current_info_message['user_text'] = text
+        logger.info("Сохранён мой текст для пользователя %s: %s", user.user_id, body(text), extra={"event": "info_text_saved"})
+
+# Типы сообщений, которые принимает основной обработчик
+CONTENT_TYPES = ['text', 'photo', 'video', 'document', 'audio', 'voice', 'sticker', 'video_note']
+
+# Выполнение шагов обработчика BotHandlers в синхронном боте: каждый шаг
+# уже выполнен к моменту yield, его результат просто возвращается обратно
+def run_steps(steps):
+    result = None
+    while True:
+        try:
+            result = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+
+# То же в цикле событий (AsyncBotHandlers): шаг-корутина дожидается, а её
+# ошибка (в том числе отмена задачи) передаётся обратно в обработчик
+async def run_steps_async(steps):
+    result, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        result, error = step, None
+        if inspect.isawaitable(step):
+            try:
+                result = await step
+            except BaseException as e:
+                result, error = None, e
+
+
+class BotHandlers:
+    """
+    Команды и режимы бота ('main', 'info', 'gpt') для main.py.
+
+    Обработчики - генераторы шагов: всё, чего нужно дождаться (отправка
+    сообщения, запрос к GPT, чтение хранилища), выдаётся через yield, и
+    результат возвращается в обработчик. Здесь шаги выполняются сразу
+    (run_steps), а в AsyncBotHandlers те же обработчики работают в цикле
+    событий (run_steps_async), поэтому логика режимов написана один раз.
+    """
+
+    def __init__(self, llm, send_queue, user_data, user_store, digest_cache, retriever=None, media_pipeline=None,
+                 digest_scheduler=None, streaming=True, edit_interval=1.5, digest_top_k=30):
+        self.llm = llm
+        self.send_queue = send_queue
+        self.user_data = user_data
+        self.user_store = user_store
+        self.digest_cache = digest_cache
+        self.retriever = retriever
+        self.media_pipeline = media_pipeline
+        self.digest_scheduler = digest_scheduler
+        self.streaming = streaming
+        self.edit_interval = edit_interval
+        self.digest_top_k = digest_top_k
+
+    # Работа с диском и базой (в асинхронном боте - в отдельном потоке)
+    def offload(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def get_user(self, user_id):
+        return self.user_data.get(user_id)
+
+    # Запрос к OpenAI (модель и температура берутся по режиму mode).
+    # Если указан stream_chat_id, ответ выводится в этот чат по мере генерации,
+    # иначе возвращается целиком. При недоступности OpenAI - LLMError
+    def complete_chat(self, messages, mode, stream_chat_id=None, reply_markup=None):
+        if stream_chat_id is None:
+            return self.llm.complete(messages, mode)
+
+        with self.llm.stream(messages, mode) as chunks:
+            reply = StreamingReply(QueuedBot(self.send_queue), stream_chat_id, reply_markup=reply_markup,
+                                   edit_interval=self.edit_interval)
+            return reply.run(chunks)
+
+    # Вытеснение пользователя из памяти: незавершённая запись сохраняется,
+    # а его сводка и векторы освобождаются вместе с ним
+    def release_user(self, user):
+        evict_user(self.user_store, user)
+        self.digest_cache.forget(user.user_id)
+        if self.retriever is not None:
+            self.retriever.forget(user.user_id)
+
+    # Отправка длинного текста несколькими сообщениями (лимит Telegram - 4096 символов)
+    def send_long_message(self, chat_id, text, reply_markup=None):
+        parts = split_message(text)
+        for i, part in enumerate(parts):
+            yield self.send_queue.send_message(chat_id, part, reply_markup=reply_markup if i == len(parts) - 1 else None)
+
+    # Записи пользователя, ближайшие к запросу (в формате format_entry, в порядке добавления)
+    def relevant_entries(self, user, query, top_k=None):
+        if self.retriever is None or not user.info_message:
+            return []
+        texts = [format_entry(entry) for entry in user.info_message]
+        return [texts[position] for position in sorted(self.retriever.search(user.user_id, texts, query, top_k))]
+
+    # Полнотекстовый поиск; несохранённые записи пользователя сначала пишутся в базу, чтобы попасть в индекс
+    def run_search(self, user, query):
+        if self.user_store.pending_user(user.user_id) is not None:
+            self.user_store.flush()
+        return search_entries(self.user_store, user, query)
+
+    # Выбор записей для сводки по теме
+    def topic_entries(self, user, topic):
+        if self.retriever is not None:
+            return self.relevant_entries(user, topic, self.digest_top_k)
+        # Без numpy записи выбираются полнотекстовым поиском
+        positions = sorted(position for position, _ in self.run_search(user, topic))
+        return [format_entry(user.info_message[position]) for position in positions if position < len(user.info_message)]
+
+    # Фоновый расчёт сводки 'Show Info' после паузы в режиме 'info' (см. digest_scheduler.py).
+    # Результат не сохраняется, если за время запроса записи изменились
+    def precompute_digest(self, user, is_current):
+        # Тексты вложений могут читаться из SQLite
+        entries = yield self.offload(digest_entries, user, include_current=True)
+        if not entries:
+            return
+        info_with_links, cached_answer = yield self.offload(self.digest_cache.prepare, user.user_id, entries)
+        if cached_answer is not None:
+            return
+        answer = yield self.complete_chat(build_info_messages(info_with_links), 'info')
+        if not is_current():
+            logger.info("Сводка для пользователя %s устарела и отброшена", user.user_id, extra={"event": "digest_discarded"})
+            return
+        yield self.offload(self.digest_cache.store_digest, user.user_id, entries, info_with_links, answer)
+        logger.info("Сводка для пользователя %s подготовлена заранее", user.user_id, extra={"event": "digest_precomputed"})
+
+    # Запрос в режиме 'gpt'
+    def request_gpt_mode(self, user, user_message, stream_chat_id=None):
+        history = user.history_for_gpt_mode
+        history_openai_format = history.messages(user_message)
+        # В запрос попадают только записи, относящиеся к вопросу, а не вся история
+        notes = yield self.offload(self.relevant_entries, user, user_message)
+        if notes:
+            history_openai_format.insert(-1, build_notes_message(notes))
+
+        assistant_message = yield self.complete_chat(history_openai_format, 'gpt', stream_chat_id, reply_markup=exit_keyboard)
+
+        history.add("user", user_message)
+        history.add("assistant", assistant_message)
+
+        return assistant_message
+
+    # Сжатие старой части диалога 'gpt' в краткое содержание
+    def fold_history(self, history):
+        folded = history.take_overflow()
+        if not folded:
+            return
+        summary = None
+        try:
+            summary = yield self.complete_chat(build_summary_messages(history.summary, folded), 'summary')
+        except Exception as e:
+            # Без краткого содержания старые реплики просто отбрасываются
+            logger.error("Не удалось сжать историю диалога: %s", e)
+        history.apply_summary(summary, len(folded))
+
+    # Пользователь из памяти или хранилища; новый создаётся без записи на диск
+    def get_or_create_user(self, user_id):
+        user = yield self.get_user(user_id)
+        if user is None:
+            user = self.user_data[user_id] = User(user_id)
+        return user
+
+    # Команда /start
+    def start(self, message):
+        user_id = message.from_user.id
+        if (yield self.get_user(user_id)) is None:
+            self.user_data[user_id] = User(user_id)
+            self.user_store.mark_dirty(self.user_data[user_id])
+            logger.info("Создан новый пользователь с ID: %s", user_id, extra={"event": "user_created"})
+        yield self.send_queue.send_message(
+            message.chat.id,
+            text=f"Привет, {message.from_user.first_name}! Меня зовут nelegal.",
+            reply_markup=main_menu_keyboard
+        )
+
+    # Команда /search <запрос>: поиск по сохранённым записям без запроса к GPT
+    def search(self, message):
+        user_id = message.from_user.id
+        user = yield from self.get_or_create_user(user_id)
+        # Незавершённая запись режима 'info' завершается, чтобы команда её учитывала
+        if flush_current_info(user):
+            self.user_store.mark_dirty(user)
+        query = util.extract_arguments(message.text).strip()
+        if not query:
+            yield self.send_queue.send_message(message.chat.id, text="Использование: /search <запрос>", reply_markup=mode_keyboard(user.mode))
+            return
+
+        results = yield self.offload(self.run_search, user, query)
+        yield from self.send_long_message(message.chat.id, format_search_results(user.info_message, query, results),
+                                          reply_markup=mode_keyboard(user.mode))
+        logger.info("Поиск пользователя %s: %s, найдено: %d", user_id, body(query), len(results), extra={"event": "search"})
+
+    # Команда /list [страница]: постраничный просмотр сохранённых записей
+    def list_entries(self, message):
+        user_id = message.from_user.id
+        user = yield from self.get_or_create_user(user_id)
+        if flush_current_info(user):
+            self.user_store.mark_dirty(user)
+        page, pages = parse_page(util.extract_arguments(message.text), user.info_message)
+        yield from self.send_long_message(message.chat.id, format_page(user.info_message, page, pages), reply_markup=mode_keyboard(user.mode))
+        logger.info("Пользователь %s открыл страницу %d из %d", user_id, page, pages, extra={"event": "list"})
+
+    # Команда /digest <тема>: сводка только по записям, относящимся к теме
+    def digest(self, message):
+        user_id = message.from_user.id
+        user = yield from self.get_or_create_user(user_id)
+        if flush_current_info(user):
+            self.user_store.mark_dirty(user)
+        topic = util.extract_arguments(message.text).strip()
+        if not topic:
+            yield self.send_queue.send_message(message.chat.id, text="Использование: /digest <тема>", reply_markup=mode_keyboard(user.mode))
+            return
+
+        notes = yield self.offload(self.topic_entries, user, topic)
+        if not notes:
+            yield self.send_queue.send_message(message.chat.id, text=f"Записей по теме «{topic}» не найдено.", reply_markup=mode_keyboard(user.mode))
+            return
+
+        logger.info("Сводка по теме для пользователя %s: %s, записей: %d", user_id, body(topic), len(notes), extra={"event": "topic_digest"})
+        try:
+            if self.streaming:
+                yield self.complete_chat(build_info_messages("\n\n".join(notes)), 'info', message.chat.id)
+            else:
+                answer = yield self.complete_chat(build_info_messages("\n\n".join(notes)), 'info')
+                yield from self.send_long_message(message.chat.id, answer, reply_markup=mode_keyboard(user.mode))
+        except LLMError as e:
+            yield self.send_queue.send_message(message.chat.id, text=str(e), reply_markup=mode_keyboard(user.mode))
+
+    # Основной обработчик сообщений
+    def handle_message(self, message):
+        user_id = message.from_user.id
+
+        # Инициализируем данные пользователя, если их нет
+        user = yield self.get_user(user_id)
+        if user is None:
+            user = self.user_data[user_id] = User(user_id)
+            logger.info("Создан новый пользователь с ID: %s", user_id, extra={"event": "user_created"})
+
+        UPDATES.inc(mode=user.mode)
+
+        # Историю целиком не логируем: только размер, и лишь на уровне DEBUG
+        logger.debug("Сообщение от пользователя %s в режиме '%s', записей в info_message: %d", user_id, user.mode,
+                     len(user.info_message), extra={"event": "update"})
+
+        # Режим работы бота
+        if user.mode == 'main':
+            yield from self._main_mode(user, message)
+        elif user.mode == 'info':
+            yield from self._info_mode(user, message)
+        elif user.mode == 'gpt':
+            yield from self._gpt_mode(user, message)
+        else:
+            user.mode = 'main'
+            yield self.send_queue.send_message(
+                message.chat.id,
+                text="Произошла ошибка. Вы были возвращены в главное меню.",
+                reply_markup=main_menu_keyboard
+            )
+            logger.error("Пользователь %s был возвращён в главное меню из неизвестного режима.", user_id)
+
+        # Помечаем пользователя изменённым, запись на диск идёт пачкой в фоне
+        self.user_store.mark_dirty(user)
+
+    def _main_mode(self, user, message):
+        if message.text == 'Add Info':
+            user.mode = 'info'
+            yield self.send_queue.send_message(
+                message.chat.id,
+                text="Вы вошли в режим добавления информации. Все ваши сообщения будут сохранены.",
+                reply_markup=exit_keyboard
+            )
+            logger.info("Пользователь %s переключился в режим 'info'", user.user_id, extra={"event": "mode_switch"})
+        elif message.text == 'Ask GPT':
+            user.mode = 'gpt'
+            user.history_for_gpt_mode = new_conversation()  # Инициализируем историю GPT
+            yield self.send_queue.send_message(
+                message.chat.id,
+                text="Вы вошли в режим общения с GPT. Задавайте свои вопросы.",
+                reply_markup=exit_keyboard
+            )
+            logger.info("Пользователь %s переключился в режим 'gpt'", user.user_id, extra={"event": "mode_switch"})
+        else:
+            yield self.send_queue.send_message(
+                message.chat.id,
+                text="Пожалуйста, выберите одну из опций меню.",
+                reply_markup=main_menu_keyboard
+            )
+            logger.info("Пользователь %s выбрал неизвестную опцию в режиме 'main'", user.user_id, extra={"event": "unknown_option"})
+
+    def _info_mode(self, user, message):
+        user_id = user.user_id
+        now = time.time()
+        time_window = 1  # Время в секундах для сброса текущего сообщения
+
+        # Проверка временного окна для группировки сообщений
+        if user.current_info_message['timestamp'] is not None and (now - user.current_info_message['timestamp'] > time_window):
+            if flush_current_info(user):
+                logger.info("Добавлена запись в info_message для пользователя %s", user_id, extra={"event": "info_entry_added"})
+
+        user.current_info_message['timestamp'] = now
+
+        if message.text == 'Exit to main menu':
+            # Обработка выхода в главное меню
+            if flush_current_info(user):
+                logger.info("Добавлена запись в info_message при выходе для пользователя %s", user_id, extra={"event": "info_entry_added"})
+
+            user.mode = 'main'
+            if self.digest_scheduler is not None:
+                self.digest_scheduler.cancel(user_id)
+            yield self.send_queue.send_message(
+                message.chat.id,
+                text="Вы вышли из режима добавления информации.",
+                reply_markup=main_menu_keyboard
+            )
+            logger.info("Пользователь %s вышел из режима 'info' в 'main'", user_id, extra={"event": "mode_switch"})
+
+        elif message.text == 'Show Info':
+            yield from self._show_info(user, message)
+
+        elif message.text == 'Clear Info':
+            # Обработка команды 'Clear Info'
+            if user.info_message:
+                user.info_message = user.info_message[:1]  # Оставляем только первое сообщение
+                # Список укорочен, поэтому записи пользователя в хранилище переписываются целиком
+                self.user_store.mark_dirty(user, rewrite=True)
+                if self.digest_scheduler is not None:
+                    self.digest_scheduler.touch(user)
+                yield self.send_queue.send_message(
+                    message.chat.id,
+                    text="История очищена, оставлено только первое сообщение.",
+                    reply_markup=info_keyboard
+                )
+                logger.info("Пользователь %s очистил историю 'info_message', оставив только первое сообщение.", user_id, extra={"event": "clear_info"})
+            else:
+                yield self.send_queue.send_message(
+                    message.chat.id,
+                    text="Нет сохраненной информации для очистки.",
+                    reply_markup=info_keyboard
+                )
+                logger.info("Пользователь %s попытался очистить историю, но 'info_message' пуст.", user_id, extra={"event": "clear_info"})
+
+        else:
+            # Обрабатываем сообщения и группируем их
+            if message.content_type in CONTENT_TYPES:
+                save_info_text(user, message)
+                if self.media_pipeline is not None:
+                    # Проверка кэша артефактов может читать SQLite
+                    yield self.offload(self.media_pipeline.submit, message)
+                if self.digest_scheduler is not None:
+                    self.digest_scheduler.touch(user)
+
+                # Подтверждения подряд идущих сообщений склеиваются в одно
+                self.send_queue.acknowledge(
+                    message.chat.id,
+                    text="Информация сохранена. Введите следующее сообщение или нажмите 'Exit to main menu'.",
+                    batch_text="Сохранено сообщений: {count}. Введите следующее сообщение или нажмите 'Exit to main menu'.",
+                    reply_markup=info_keyboard
+                )
+
+            else:
+                yield self.send_queue.send_message(
+                    message.chat.id,
+                    text="Тип сообщения не поддерживается в этом режиме. Отправьте текст или медиа.",
+                    reply_markup=info_keyboard
+                )
+                logger.warning("Пользователь %s отправил неподдерживаемый тип сообщения.", user_id)
+
+    # Обработка команды 'Show Info'
+    def _show_info(self, user, message):
+        user_id = user.user_id
+        if flush_current_info(user):
+            logger.info("Добавлена запись в info_message перед показом информации для пользователя %s", user_id, extra={"event": "info_entry_added"})
+
+        if not user.info_message:
+            yield self.send_queue.send_message(
+                message.chat.id,
+                text="Нет сохраненной информации.",
+                reply_markup=info_keyboard
+            )
+            logger.info("Пользователь %s запросил показ информации, но список пуст.", user_id, extra={"event": "show_info"})
+            return
+
+        if self.digest_scheduler is not None:
+            # Если сводка уже считается в фоне, дожидаемся её вместо повторного запроса
+            yield self.digest_scheduler.wait(user_id, timeout=self.llm.timeout)
+            self.digest_scheduler.cancel(user_id)
+        # Форматирование (тексты вложений) и кэш могут читать SQLite
+        entries = yield self.offload(digest_entries, user)
+        # Из кэша берётся готовая сводка или запрос только с новыми записями
+        info_with_links, cached_answer = yield self.offload(self.digest_cache.prepare, user_id, entries)
+        try:
+            if cached_answer is not None:
+                yield from self.send_long_message(message.chat.id, cached_answer)
+            else:
+                if self.streaming:
+                    answer = yield self.complete_chat(build_info_messages(info_with_links), 'info', message.chat.id)
+                else:
+                    answer = yield self.complete_chat(build_info_messages(info_with_links), 'info')
+                    yield from self.send_long_message(message.chat.id, answer)
+                yield self.offload(self.digest_cache.store_digest, user_id, entries, info_with_links, answer)
+        except LLMError as e:
+            yield self.send_queue.send_message(message.chat.id, text=str(e), reply_markup=info_keyboard)
+        # Оставляем info_message после показа
+        yield self.send_queue.send_message(
+            message.chat.id,
+            text="Информация показана. Введите следующее сообщение или нажмите 'Exit to main menu'.",
+            reply_markup=info_keyboard
+        )
+        logger.info("Пользователь %s запросил показ информации.", user_id, extra={"event": "show_info"})
+
+    def _gpt_mode(self, user, message):
+        user_id = user.user_id
+        if message.content_type != "text":
+            yield self.send_queue.send_message(
+                message.chat.id,
+                text="В режиме общения с GPT поддерживается только текстовые сообщения.",
+                reply_markup=exit_keyboard
+            )
+            logger.warning("Пользователь %s попытался отправить неподдерживаемый тип сообщения в режиме 'gpt'.", user_id)
+        elif message.text == "Exit to main menu":
+            user.mode = "main"
+            user.history_for_gpt_mode = None  # Очищаем историю GPT
+            yield self.send_queue.send_message(
+                message.chat.id,
+                text="До свидания.",
+                reply_markup=main_menu_keyboard
+            )
+            logger.info("Пользователь %s вышел из режима 'gpt' в 'main'", user_id, extra={"event": "mode_switch"})
+        else:
+            user_message = message.text
+            logger.info("Пользователь %s отправил сообщение для GPT: %s", user_id, body(user_message), extra={"event": "gpt_question"})
+            try:
+                if self.streaming:
+                    yield from self.request_gpt_mode(user, user_message, stream_chat_id=message.chat.id)
+                else:
+                    response_text = yield from self.request_gpt_mode(user, user_message)
+                    yield from self.send_long_message(message.chat.id, response_text, reply_markup=exit_keyboard)
+            except LLMError as e:
+                yield self.send_queue.send_message(message.chat.id, text=str(e), reply_markup=exit_keyboard)
+            else:
+                # Сжимаем историю уже после ответа, чтобы не задерживать его
+                yield from self.fold_history(user.history_for_gpt_mode)
+                logger.info("Ответ GPT для пользователя %s отправлен.", user_id, extra={"event": "gpt_answer"})
+
+
+class AsyncBotHandlers(BotHandlers):
+    """BotHandlers для async_main.py: ожидание Telegram и OpenAI без блокировки цикла событий."""
+
+    def offload(self, func, *args, **kwargs):
+        return asyncio.to_thread(func, *args, **kwargs)
+
+    # Пользователь из памяти или из хранилища (чтение базы - вне цикла событий)
+    def get_user(self, user_id):
+        user = self.user_data.cached(user_id)
+        if user is not None:
+            return user
+        return asyncio.to_thread(self.user_data.get, user_id)
+
+    async def complete_chat(self, messages, mode, stream_chat_id=None, reply_markup=None):
+        if stream_chat_id is None:
+            return await self.llm.complete(messages, mode)
+
+        async with self.llm.stream(messages, mode) as chunks:
+            reply = AsyncStreamingReply(AsyncQueuedBot(self.send_queue), stream_chat_id, reply_markup=reply_markup,
+                                        edit_interval=self.edit_interval)
+            return await reply.run(chunks)
@@ -0,0 +1,149 @@
+import re
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+logger = logging.getLogger(__name__)
+
+# Логирование бота: обработчики только кладут запись в очередь
+# (QueueHandler), а форматирование в JSON и запись в файл/консоль делает
+# отдельный поток (QueueListener). Тексты пользователей попадают в лог
+# только через body(): по умолчанию лишь их длина, иначе - обрезанный текст.
+
+# Стандартные поля LogRecord, которые не считаются пользовательскими
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "event"}
+
+# Токены Telegram и ключи OpenAI, которые не должны попасть в лог
+SECRET_REGEX = re.compile(r'\b\d{6,}:[A-Za-z0-9_-]{30,}\b|\bsk-[A-Za-z0-9_-]{16,}')
+
+# Настройки тел сообщений (задаются через setup_logging())
+body_settings = {"log_bodies": False, "limit": 200}
+
+
+class body:
+    """
+    Текст пользователя для лога. Превращается в строку только при
+    форматировании записи, то есть если уровень логирования включён.
+    Без "log_bodies" в лог попадает только длина текста.
+    """
+
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        text = self.text if isinstance(self.text, str) else str(self.text)
+        if not body_settings["log_bodies"]:
+            return f"<{len(text)} симв.>"
+        limit = body_settings["limit"]
+        return text if len(text) <= limit else text[:limit] + f"… (+{len(text) - limit} симв.)"
+
+
+def redact(text):
+    return SECRET_REGEX.sub("<скрыто>", text)
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись лога одной строкой JSON: время, уровень, логгер, событие, сообщение и поля extra."""
+
+    def format(self, record):
+        data = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact(record.getMessage())
+        }
+        event = getattr(record, "event", None)
+        if event:
+            data["event"] = event
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                data[key] = value if isinstance(value, (int, float, bool, type(None))) else redact(str(value))
+        if record.exc_info:
+            data["exc_info"] = redact(self.formatException(record.exc_info))
+        return json.dumps(data, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """Обычный текстовый формат, но со скрытием токенов."""
+
+    def format(self, record):
+        return redact(super().format(record))
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Выборочная запись частых событий: rates = {"событие": доля}. Событие
+    задаётся через extra={"event": ...}; записи без события и ошибки
+    (WARNING и выше) пропускаются всегда.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, "event", None))
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < rate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись, а не ждёт."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # Очередь внутри процесса, поэтому запись передаётся как есть: сообщение,
+    # аргументы и исключение форматируются уже в потоке QueueListener
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Настройка логирования по секции "logging" в config.json. Возвращает QueueListener
+def setup_logging(config):
+    settings = config.get("logging", {})
+    body_settings["log_bodies"] = settings.get("log_bodies", False)
+    body_settings["limit"] = settings.get("body_limit", 200)
+
+    if settings.get("format", "json") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if settings.get("file"):
+        output = logging.handlers.WatchedFileHandler(settings["file"], encoding="utf-8")
+    else:
+        output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(formatter)
+
+    handler = DroppingQueueHandler(queue.Queue(settings.get("queue_size", 10000)))
+    if settings.get("sampling"):
+        handler.addFilter(SamplingFilter(settings["sampling"]))
+    listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, str(settings.get("level", "INFO")).upper(), logging.INFO))
+    for name, level in settings.get("levels", {}).items():
+        logging.getLogger(name).setLevel(getattr(logging, str(level).upper(), logging.INFO))
+
+    listener.start()
+    # Дописываем оставшиеся в очереди записи при завершении
+    atexit.register(listener.stop)
+    return listener
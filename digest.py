@@ -0,0 +1,111 @@
+import hashlib
+import threading
+import logging
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Разделитель записей при подсчёте хэша (не встречается в обычном тексте)
+ENTRY_SEPARATOR = "\x1e"
+
+# Запрос на дополнение уже готовой сводки новыми записями
+INCREMENTAL_TEMPLATE = (
+    "Ранее ты уже подготовил для меня такой результат:\n\n"
+    "{digest}\n\n"
+    "С тех пор появились новые записи:\n\n"
+    "{new_entries}\n\n"
+    "Добавь новые записи в предыдущий результат, сохранив формат вывода, "
+    "и пришли полный обновлённый результат."
+)
+
+
+# Хэш содержимого списка отформатированных записей
+def entries_hash(entries):
+    digest = hashlib.sha256()
+    for entry in entries:
+        digest.update(entry.encode('utf-8'))
+        digest.update(ENTRY_SEPARATOR.encode('utf-8'))
+    return digest.hexdigest()
+
+
+class DigestCache:
+    """
+    Кэш сводок 'Show Info'.
+
+    Для каждого пользователя хранится последняя сводка вместе с хэшем записей,
+    по которым она построена. Если записи не менялись, сводка отдаётся без
+    запроса к GPT. Если в конец списка только добавились записи, GPT получает
+    предыдущую сводку и новые записи, а не всю историю целиком.
+    """
+
+    def __init__(self, store=None, incremental=True):
+        self.store = store
+        self.incremental = incremental
+        self._records = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'incremental': 0, 'tokens_saved': 0}
+
+    def _get(self, user_id):
+        with self._lock:
+            if user_id in self._records:
+                return self._records[user_id]
+        record = self.store.load_digest(user_id) if self.store is not None else None
+        with self._lock:
+            self._records[user_id] = record
+        return record
+
+    def _put(self, user_id, record):
+        with self._lock:
+            self._records[user_id] = record
+        if self.store is not None:
+            self.store.save_digest(user_id, record)
+
+    # Пользователь вытеснен из памяти (см. UserCache): сводка остаётся только в хранилище
+    def forget(self, user_id):
+        if self.store is not None:
+            with self._lock:
+                self._records.pop(user_id, None)
+
+    def _count(self, name, tokens_saved=0):
+        with self._lock:
+            self.stats[name] += 1
+            self.stats['tokens_saved'] += max(tokens_saved, 0)
+            stats = dict(self.stats)
+        logger.info(
+            "Кэш сводок: %s, сэкономлено токенов %d. "
+            "Всего: попаданий %d, промахов %d, дополнений %d, сэкономлено токенов %d",
+            name, max(tokens_saved, 0), stats['hits'], stats['misses'], stats['incremental'], stats['tokens_saved'],
+            extra={"event": "digest_cache"}
+        )
+
+    # Текст запроса к GPT для записей: полный или только с новыми записями.
+    # Возвращает (текст запроса, готовая сводка из кэша или None)
+    def prepare(self, user_id, entries):
+        key = entries_hash(entries)
+        record = self._get(user_id)
+
+        if record is not None and record['key'] == key:
+            self._count('hits', record['tokens'])
+            return None, record['digest']
+
+        count = record['entry_count'] if record is not None else 0
+        if (self.incremental and 0 < count < len(entries)
+                and entries_hash(entries[:count]) == record['key']):
+            new_entries = "\n\n".join(entries[count:])
+            prompt = INCREMENTAL_TEMPLATE.format(digest=record['digest'], new_entries=new_entries)
+            old_tokens = count_tokens("\n\n".join(entries[:count]))
+            self._count('incremental', old_tokens - count_tokens(record['digest']))
+            return prompt, None
+
+        self._count('misses')
+        return "\n\n".join(entries).strip(), None
+
+    # Сохранение новой сводки для записей
+    def store_digest(self, user_id, entries, prompt, digest):
+        tokens = count_tokens(prompt) + count_tokens(digest)
+        self._put(user_id, {
+            'key': entries_hash(entries),
+            'entry_count': len(entries),
+            'digest': digest,
+            'tokens': tokens
+        })
@@ -0,0 +1,192 @@
+import time
+import heapq
+import asyncio
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Заблаговременный расчёт сводки 'Show Info': когда пользователь в режиме
+# 'info' перестаёт присылать сообщения, сводка считается в фоне и кладётся
+# в DigestCache, так что нажатие 'Show Info' обычно отвечает из кэша.
+
+
+class DigestScheduler:
+    """
+    Планировщик фонового расчёта сводок для синхронного запуска (main.py).
+
+    touch(user) после каждого изменения записей откладывает расчёт на
+    idle_after секунд и делает прежний расчёт неактуальным: ещё не
+    начатый отменяется, а результат уже идущего отбрасывается. Одновременно
+    идёт не больше max_concurrent расчётов; пока busy() возвращает True
+    (например, GPT занят ответами пользователям), расчёт откладывается на
+    retry_interval секунд.
+
+    compute(user, is_current) считает и сохраняет сводку; is_current()
+    сообщает, не изменились ли записи с момента постановки в очередь.
+    """
+
+    def __init__(self, compute, idle_after=60, max_concurrent=1, busy=None, retry_interval=5):
+        self.compute = compute
+        self.idle_after = idle_after
+        self.busy = busy
+        self.retry_interval = retry_interval
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="digest")
+        # Номер последнего изменения по пользователям, ждущим расчёта или считающимся
+        self._latest = {}
+        self._counter = 0
+        # Очередь (срок, номер, user_id, пользователь); устаревшие отметки пропускаются
+        self._due = []
+        self._running = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="digest-scheduler", daemon=True)
+        self._thread.start()
+
+    # Записи пользователя изменились: расчёт откладывается до паузы
+    def touch(self, user):
+        with self._cond:
+            self._counter += 1
+            self._latest[user.user_id] = self._counter
+            heapq.heappush(self._due, (time.monotonic() + self.idle_after, self._counter, user.user_id, user))
+            self._cond.notify()
+
+    # Отмена ещё не начатого расчёта и отказ от результата идущего
+    def cancel(self, user_id):
+        with self._cond:
+            self._latest.pop(user_id, None)
+
+    # Ожидание уже идущего расчёта по тем же записям (чтобы не спрашивать GPT дважды)
+    def wait(self, user_id, timeout=None):
+        with self._cond:
+            running = self._running.get(user_id)
+            if running is None or running[0] != self._latest.get(user_id):
+                return False
+        return running[1].wait(timeout)
+
+    def _is_current(self, user_id, generation):
+        with self._cond:
+            return self._latest.get(user_id) == generation
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped and (not self._due or self._due[0][0] > time.monotonic()):
+                    self._cond.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                if self._stopped:
+                    return
+                item = heapq.heappop(self._due)
+                _, generation, user_id, user = item
+                if self._latest.get(user_id) != generation:
+                    continue
+                # Расчёт по этому пользователю уже идёт или GPT занят - откладываем
+                if user_id in self._running or (self.busy is not None and self.busy()):
+                    heapq.heappush(self._due, (time.monotonic() + self.retry_interval,) + item[1:])
+                    continue
+                self._running[user_id] = (generation, threading.Event())
+            self._pool.submit(self._run, user, generation)
+
+    def _run(self, user, generation):
+        try:
+            if self._is_current(user.user_id, generation):
+                self.compute(user, lambda: self._is_current(user.user_id, generation))
+        except Exception as e:
+            logger.error("Ошибка фонового расчёта сводки для пользователя %s: %s", user.user_id, e)
+        finally:
+            with self._cond:
+                _, done = self._running.pop(user.user_id)
+                if self._latest.get(user.user_id) == generation:
+                    del self._latest[user.user_id]
+            done.set()
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncDigestScheduler:
+    """
+    То же для asyncio (async_main.py): на каждого пользователя - задача,
+    которая ждёт idle_after секунд и считает сводку. touch() и cancel()
+    отменяют прежнюю задачу, в том числе уже идущий запрос к GPT.
+    """
+
+    def __init__(self, compute, idle_after=60, max_concurrent=1, busy=None, retry_interval=5):
+        self.compute = compute
+        self.idle_after = idle_after
+        self.busy = busy
+        self.retry_interval = retry_interval
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._tasks = {}
+        self._running = set()
+
+    def touch(self, user):
+        self.cancel(user.user_id)
+        task = asyncio.get_running_loop().create_task(self._delayed(user))
+        self._tasks[user.user_id] = task
+        task.add_done_callback(lambda done: self._forget(user.user_id, done))
+
+    def cancel(self, user_id):
+        task = self._tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+
+    # Ожидание уже идущего расчёта; ещё не начатый отменяется
+    async def wait(self, user_id, timeout=None):
+        task = self._tasks.get(user_id)
+        if task is None:
+            return False
+        if task not in self._running:
+            self.cancel(user_id)
+            return False
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.CancelledError:
+            # Отменён сам ожидающий обработчик (например, при остановке) - отмену не глотаем
+            current = asyncio.current_task()
+            if current is not None and current.cancelling():
+                raise
+            return False
+        except Exception:
+            # В том числе TimeoutError: сводка не готова, её посчитает вызывающий
+            return False
+        return True
+
+    def _forget(self, user_id, task):
+        self._running.discard(task)
+        if self._tasks.get(user_id) is task:
+            del self._tasks[user_id]
+
+    async def _delayed(self, user):
+        await asyncio.sleep(self.idle_after)
+        while self.busy is not None and self.busy():
+            await asyncio.sleep(self.retry_interval)
+        async with self._slots:
+            task = asyncio.current_task()
+            self._running.add(task)
+            try:
+                # Пока задача не отменена, записи не менялись
+                await self.compute(user, lambda: self._tasks.get(user.user_id) is task)
+            except Exception as e:
+                logger.error("Ошибка фонового расчёта сводки для пользователя %s: %s", user.user_id, e)
+
+    def close(self):
+        for user_id in list(self._tasks):
+            self.cancel(user_id)
+
+
+# Настройки по секции "digest" в config.json (по умолчанию фоновый расчёт выключен)
+def create_digest_scheduler(config, compute, busy=None, scheduler_class=DigestScheduler):
+    settings = config.get("digest", {})
+    if not settings.get("precompute", False):
+        return None
+    return scheduler_class(
+        compute,
+        idle_after=settings.get("idle_after", 60),
+        max_concurrent=settings.get("max_concurrent", 1),
+        busy=busy,
+        retry_interval=settings.get("retry_interval", 5)
+    )
@@ -0,0 +1,154 @@
+import time
+import asyncio
+import threading
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from metrics import DISPATCH_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedDispatcher:
+    """
+    Выполняет обработчики на ограниченном пуле потоков.
+
+    Задачи с одинаковым ключом (user_id) выполняются строго по очереди,
+    поэтому состояние одного пользователя никогда не меняется из двух потоков
+    сразу. Задачи разных пользователей выполняются параллельно.
+    Если в очереди и в работе уже max_queue задач, submit() блокируется -
+    так медленные обработчики притормаживают приём обновлений.
+    """
+
+    def __init__(self, max_workers=8, max_queue=1000):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="handler")
+        self._slots = threading.BoundedSemaphore(max_queue)
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._in_flight = 0
+
+    @property
+    def queue_depth(self):
+        return self._queued
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def submit(self, key, func, *args, **kwargs):
+        self._slots.acquire()
+        with self._lock:
+            queue = self._queues.get(key)
+            idle = queue is None
+            if idle:
+                queue = self._queues[key] = deque()
+            queue.append((func, args, kwargs, time.monotonic()))
+            self._queued += 1
+        # Если по ключу ничего не выполняется, запускаем его очередь
+        if idle:
+            self._executor.submit(self._run_next, key)
+
+    # Выполняет одну задачу ключа и ставит следующую в конец пула,
+    # чтобы один активный пользователь не занимал поток надолго
+    def _run_next(self, key):
+        with self._lock:
+            func, args, kwargs, queued_at = self._queues[key].popleft()
+            self._queued -= 1
+            self._in_flight += 1
+        DISPATCH_WAIT_SECONDS.observe(time.monotonic() - queued_at)
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            logger.exception("Ошибка в обработчике для ключа %s: %s", key, e)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                has_more = bool(self._queues[key])
+                if not has_more:
+                    del self._queues[key]
+            self._slots.release()
+        if has_more:
+            self._executor.submit(self._run_next, key)
+
+    def shutdown(self, wait=True):
+        # Дожидаемся, пока очереди всех ключей опустеют
+        while wait and (self._queued or self._in_flight):
+            time.sleep(0.05)
+        self._executor.shutdown(wait=wait)
+
+
+class AsyncKeyedDispatcher:
+    """
+    Вариант KeyedDispatcher для asyncio: обработчик каждого обновления - задача
+    в цикле событий. Задачи одного ключа ждут завершения предыдущей задачи
+    этого ключа, одновременно выполняется не больше max_in_flight задач, а
+    submit() ждёт, пока в очереди и в работе меньше max_queue задач.
+    """
+
+    def __init__(self, max_in_flight=1000, max_queue=10000):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self._slots = asyncio.Semaphore(max_queue)
+        self._running = asyncio.Semaphore(max_in_flight)
+        self._tails = {}
+        self._tasks = set()
+        self._in_flight = 0
+
+    @property
+    def queue_depth(self):
+        return len(self._tasks) - self._in_flight
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    async def submit(self, key, func, *args, **kwargs):
+        await self._slots.acquire()
+        task = asyncio.create_task(self._run(key, self._tails.get(key), func, args, kwargs, time.monotonic()))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key, previous, func, args, kwargs, queued_at):
+        try:
+            if previous is not None:
+                # Ошибка предыдущей задачи уже залогирована, здесь важен только порядок
+                await asyncio.wait([previous])
+            async with self._running:
+                DISPATCH_WAIT_SECONDS.observe(time.monotonic() - queued_at)
+                self._in_flight += 1
+                try:
+                    await func(*args, **kwargs)
+                finally:
+                    self._in_flight -= 1
+        except Exception as e:
+            logger.exception("Ошибка в обработчике для ключа %s: %s", key, e)
+        finally:
+            self._slots.release()
+            if self._tails.get(key) is asyncio.current_task():
+                del self._tails[key]
+
+    async def shutdown(self):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+
+# Определение ключа очереди для обновления Telegram
+def update_user_id(update):
+    for field in ('message', 'edited_message', 'callback_query', 'inline_query'):
+        event = getattr(update, field, None)
+        if event is not None and getattr(event, 'from_user', None) is not None:
+            return event.from_user.id
+    return update.update_id
+
+
+# То же для обновления в виде JSON (до разбора в types.Update), см. supervisor.py
+def raw_update_user_id(update):
+    for field in ('message', 'edited_message', 'callback_query', 'inline_query'):
+        event = update.get(field)
+        if event is not None and event.get('from') is not None:
+            return event['from']['id']
+    return update['update_id']
@@ -0,0 +1,83 @@
+import logging
+from collections import deque
+from tokens import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Заголовок сообщения с кратким содержанием старой части диалога
+SUMMARY_PREFIX = "Краткое содержание предыдущей части нашего разговора:\n"
+
+
+class ConversationWindow:
+    """
+    История диалога 'Ask GPT' с ограничением по токенам.
+
+    Реплики хранятся в deque вместе с числом токенов, поэтому добавление
+    реплики не копирует историю. Когда история превышает token_budget,
+    самые старые реплики сворачиваются в краткое содержание (take_overflow
+    и apply_summary), пока история не уменьшится до половины бюджета.
+    Сворачивание идёт крупными порциями, поэтому начало запроса (краткое
+    содержание и старые реплики) долго не меняется и кэширование промпта
+    на стороне OpenAI продолжает срабатывать.
+    """
+
+    def __init__(self, token_budget=6000, keep_recent=4, model="gpt-4o"):
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.model = model
+        self.turns = deque()
+        self.tokens = 0
+        self.summary = None
+        self._summary_tokens = 0
+
+    def __len__(self):
+        return len(self.turns)
+
+    def add(self, role, content):
+        tokens = count_tokens(content, self.model)
+        self.turns.append(({"role": role, "content": content}, tokens))
+        self.tokens += tokens
+
+    # Сообщения для запроса: краткое содержание, реплики и новый вопрос
+    def messages(self, user_message=None):
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": SUMMARY_PREFIX + self.summary})
+        messages.extend(message for message, _ in self.turns)
+        if user_message is not None:
+            messages.append({"role": "user", "content": user_message})
+        return messages
+
+    @property
+    def total_tokens(self):
+        return self.tokens + self._summary_tokens
+
+    # Старые реплики, которые нужно свернуть, чтобы история уложилась в бюджет.
+    # Реплики убираются из истории; краткое содержание задаётся через apply_summary()
+    def take_overflow(self):
+        if self.total_tokens <= self.token_budget or len(self.turns) <= self.keep_recent:
+            return []
+
+        folded = []
+        target = self.token_budget // 2
+        while len(self.turns) > self.keep_recent and self.total_tokens > target:
+            message, tokens = self.turns.popleft()
+            self.tokens -= tokens
+            folded.append(message)
+        return folded
+
+    def apply_summary(self, summary, folded_count=0):
+        if summary is not None:
+            self.summary = summary
+        self._summary_tokens = count_tokens(self.summary, self.model) if self.summary else 0
+        logger.info("Свёрнуто реплик истории GPT: %s, токенов в истории: %s", folded_count, self.total_tokens)
+
+    # Реплики и краткое содержание для передачи истории в другой процесс (см. supervisor.py)
+    def export(self):
+        return {'summary': self.summary, 'turns': [message for message, _ in self.turns]}
+
+    def restore(self, state):
+        for message in state.get('turns', ()):
+            self.add(message['role'], message['content'])
+        self.summary = state.get('summary')
+        self._summary_tokens = count_tokens(self.summary, self.model) if self.summary else 0
@@ -0,0 +1,133 @@
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Разбор входящих сообщений режима 'info' по entities Telegram (без регулярных
+# выражений по всему тексту) и индекс повторно пересланных постов.
+
+# Тексты короче этого не сравниваются по хешу: короткие подписи вроде "👍"
+# часто совпадают у разных постов
+MIN_HASH_TEXT = 20
+
+
+# Текст сообщения или подпись к медиа вместе с их entities
+def message_text(message):
+    if message.content_type == 'text':
+        return message.text or '', message.entities or []
+    return message.caption or '', message.caption_entities or []
+
+
+# Смещения entities задаются в UTF-16 code units, поэтому текст режется в этой кодировке
+def _entity_slice(encoded, entity):
+    return encoded[entity.offset * 2:(entity.offset + entity.length) * 2].decode('utf-16-le')
+
+
+# Текст, в котором скрытые гиперссылки раскрыты в формат 'слово (ссылка)'
+def render_text(text, entities):
+    text_links = sorted((entity for entity in entities if entity.type == 'text_link' and entity.url),
+                        key=lambda entity: entity.offset)
+    if not text_links:
+        return text
+    encoded = text.encode('utf-16-le')
+    parts = []
+    position = 0
+    for entity in text_links:
+        start = entity.offset * 2
+        end = start + entity.length * 2
+        if start < position:
+            # Вложенные или пересекающиеся entities не раскрываем повторно
+            continue
+        parts.append(encoded[position:end].decode('utf-16-le'))
+        if entity.url not in _entity_slice(encoded, entity):
+            parts.append(f" ({entity.url})")
+        position = end
+    parts.append(encoded[position:].decode('utf-16-le'))
+    return "".join(parts)
+
+
+# Источник пересланного поста: [id чата, id сообщения] или None
+def forward_source(message):
+    if not message.forward_from_chat or not message.forward_from_message_id:
+        return None
+    return [message.forward_from_chat.id, message.forward_from_message_id]
+
+
+# Хеш текста поста без учёта регистра и пробелов (или None для коротких текстов)
+def content_hash(text):
+    if not text or text == 'Неизвестно':
+        return None
+    normalized = " ".join(text.split()).casefold()
+    if len(normalized) < MIN_HASH_TEXT:
+        return None
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+# Ключи записи в индексе повторов: источник поста и хеш его текста
+def entry_keys(entry):
+    if not isinstance(entry, dict):
+        return []
+    keys = []
+    source = entry.get('source')
+    if source:
+        keys.append(('source', tuple(source)))
+    text_hash = content_hash(entry.get('forwarded_text'))
+    if text_hash:
+        keys.append(('hash', text_hash))
+    return keys
+
+
+class DedupIndex:
+    """
+    Индекс записей info_message по источнику пересланного поста и хешу его
+    текста. Строится один раз при первом обращении, затем в него
+    добавляются только новые записи из конца списка.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.size = 0
+        self._positions = {}
+        self.update()
+
+    # Индексация записей, добавленных после прошлого обращения
+    def update(self):
+        for position in range(self.size, len(self.entries)):
+            for key in entry_keys(self.entries[position]):
+                self._positions.setdefault(key, position)
+        self.size = len(self.entries)
+
+    # Позиция ранее сохранённого того же поста (или None)
+    def find(self, entry):
+        for key in entry_keys(entry):
+            position = self._positions.get(key)
+            if position is not None:
+                return position
+        return None
+
+
+# Объединение повторно пересланного поста с уже сохранённой записью:
+# комментарий пользователя дописывается к прежнему. Возвращает True, если запись изменилась
+def merge_entry(entry, new):
+    changed = False
+    comment = new.get('user_text')
+    if comment and comment != 'Неизвестно':
+        current = entry.get('user_text')
+        if not current or current == 'Неизвестно':
+            entry['user_text'] = comment
+            changed = True
+        elif comment not in current.split('\n'):
+            entry['user_text'] = f"{current}\n{comment}"
+            changed = True
+    if entry.get('link', 'Неизвестно') == 'Неизвестно' and new.get('link', 'Неизвестно') != 'Неизвестно':
+        entry['link'] = new['link']
+        changed = True
+    if not entry.get('source') and new.get('source'):
+        entry['source'] = new['source']
+        changed = True
+    known = {ref['id'] for ref in entry.get('media', ())}
+    added = [ref for ref in new.get('media', ()) if ref['id'] not in known]
+    if added:
+        entry['media'] = entry.get('media', []) + added
+        changed = True
+    return changed
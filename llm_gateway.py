@@ -0,0 +1,456 @@
+import time
+import random
+import asyncio
+import threading
+import logging
+import openai
+from metrics import STAGE_SECONDS, LLM_REQUESTS, record_usage
+
+logger = logging.getLogger(__name__)
+
+# Модель и температура по умолчанию для всех режимов
+DEFAULT_MODE_SETTINGS = {"model": "gpt-4o", "temperature": 0.8}
+
+# Сообщения пользователю, когда ответ от OpenAI получить не удалось
+UNAVAILABLE_MESSAGE = "GPT сейчас перегружен или недоступен. Попробуйте, пожалуйста, через пару минут."
+FAILED_MESSAGE = "Не удалось получить ответ от GPT. Попробуйте ещё раз."
+
+
+class LLMError(Exception):
+    """Запрос к OpenAI не удался; str(e) можно показать пользователю."""
+
+    def __init__(self, message=FAILED_MESSAGE, cause=None):
+        super().__init__(message)
+        self.cause = cause
+
+
+class CircuitOpenError(LLMError):
+    """OpenAI считается недоступным, запрос не отправлялся."""
+
+    def __init__(self):
+        super().__init__(UNAVAILABLE_MESSAGE)
+
+
+# Ошибки, после которых имеет смысл повторить запрос: 429, 5xx, таймауты и обрывы соединения
+def is_retryable(error):
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+# Пауза из заголовка Retry-After ответа OpenAI, если он есть
+def get_retry_after(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+# Файл для повторной отправки: (имя, открытый файл) перематывается в начало
+def rewind(file):
+    file[1].seek(0)
+    return file
+
+
+class CircuitBreaker:
+    """
+    Предохранитель: после failure_threshold ошибок подряд запросы не
+    отправляются reset_timeout секунд. Затем пропускается один пробный
+    запрос; если он успешен, работа возобновляется.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # Метка запроса, который сейчас выполняется как пробный
+        self._probe = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    # Можно ли отправить запрос: (разрешён, метка). Метка не None только у
+    # пробного запроса, она нужна для release_probe()
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True, None
+            if state == 'half-open' and self._probe is None:
+                self._probe = object()
+                return True, self._probe
+            return False, None
+
+    def record_success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info("OpenAI снова отвечает, предохранитель закрыт.")
+            self.failures = 0
+            self.opened_at = None
+            self._probe = None
+
+    # Пробный запрос probe завершился без ответа OpenAI (например, задача
+    # отменена): следующий запрос снова будет пробным. Если за это время
+    # пробным стал другой запрос, его место не освобождается
+    def release_probe(self, probe):
+        with self._lock:
+            if self._probe is probe:
+                self._probe = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probe is not None or self.failures >= self.failure_threshold:
+                if self._probe is not None or self.opened_at is None:
+                    logger.warning("OpenAI недоступен (%s ошибок подряд), запросы приостановлены на %s с", self.failures, self.reset_timeout)
+                self.opened_at = time.monotonic()
+                self._probe = None
+
+
+class LLMGateway:
+    """
+    Единая точка вызова OpenAI.
+
+    У каждого вызова есть общий срок timeout секунд на все попытки. Ошибки
+    429/5xx и таймауты повторяются с экспоненциальной паузой со случайным
+    разбросом, одновременно выполняется не больше max_in_flight запросов,
+    а предохранитель (CircuitBreaker) при деградации OpenAI сразу отвечает
+    CircuitOpenError. Модель и температура задаются для каждого режима
+    ('info', 'gpt', 'summary') в modes.
+
+    Клиент OpenAI следует создавать с max_retries=0: повторами занимается шлюз.
+    """
+
+    def __init__(self, client, modes=None, timeout=60, max_retries=3, backoff_base=0.5,
+                 backoff_max=8, max_in_flight=16, breaker=None):
+        self.client = client
+        self.modes = modes or {}
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_in_flight = max_in_flight
+        self.breaker = breaker or CircuitBreaker()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    # Модель и температура для режима
+    def settings(self, mode):
+        settings = dict(DEFAULT_MODE_SETTINGS)
+        settings.update(self.modes.get("default", {}))
+        settings.update(self.modes.get(mode, {}))
+        return settings
+
+    # Пауза перед повтором attempt (с нуля): случайная в пределах экспоненты
+    def _backoff(self, attempt, error):
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # Решение после ошибки: пауза перед следующей попыткой или LLMError
+    def _on_error(self, error, attempt, deadline, mode):
+        if isinstance(error, LLMError):
+            return error
+        retryable = is_retryable(error)
+        if retryable:
+            self.breaker.record_failure()
+        elif isinstance(error, openai.APIStatusError):
+            # OpenAI ответил (например, 400), сам сервис работает
+            self.breaker.record_success()
+        # Прочие ошибки возникли до ответа OpenAI и о его состоянии ничего не говорят
+        if retryable and self.breaker.state == 'open':
+            # Пока шли повторы, предохранитель сработал: дальше не ждём
+            return CircuitOpenError()
+        if retryable and attempt < self.max_retries:
+            delay = self._backoff(attempt, error)
+            if time.monotonic() + delay < deadline:
+                logger.warning("Ошибка OpenAI в режиме '%s' (%s), повтор через %.1f с", mode, error, delay)
+                return delay
+        logger.error("Запрос к OpenAI в режиме '%s' не удался: %s", mode, error)
+        return LLMError(cause=error)
+
+    def _request(self, messages, mode, deadline, **kwargs):
+        settings = self.settings(mode)
+        return dict(
+            model=settings["model"],
+            messages=messages,
+            temperature=settings["temperature"],
+            timeout=max(deadline - time.monotonic(), 0.1),
+            **kwargs
+        )
+
+    # Занимает место в семафоре; возвращает время начала запроса для метрик
+    # и метку пробного запроса предохранителя (None, если запрос обычный)
+    def _acquire(self, deadline, mode):
+        if not self._slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+            logger.warning("Слишком много одновременных запросов к OpenAI, запрос отклонён.")
+            LLM_REQUESTS.inc(mode=mode, outcome="rejected")
+            raise LLMError(UNAVAILABLE_MESSAGE)
+        return self._started(mode)
+
+    def _started(self, mode):
+        allowed, probe = self.breaker.allow()
+        if not allowed:
+            self._slots.release()
+            LLM_REQUESTS.inc(mode=mode, outcome="circuit_open")
+            raise CircuitOpenError()
+        with self._lock:
+            self._in_flight += 1
+        return time.perf_counter(), probe
+
+    def _release(self, mode, started, outcome):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage="llm")
+        LLM_REQUESTS.inc(mode=mode, outcome=outcome)
+
+    def _create(self, messages, mode, deadline, probe, **kwargs):
+        return self._retry(
+            lambda: self.client.chat.completions.create(**self._request(messages, mode, deadline, **kwargs)),
+            mode, deadline, probe
+        )
+
+    # Вызов call() с повторами после ошибок 429/5xx и учётом в предохранителе.
+    # probe - метка пробного запроса, если этот запрос пробный
+    def _retry(self, call, mode, deadline, probe):
+        attempt = 0
+        try:
+            while True:
+                try:
+                    response = call()
+                    self.breaker.record_success()
+                    return response
+                except Exception as e:
+                    result = self._on_error(e, attempt, deadline, mode)
+                    if isinstance(result, LLMError):
+                        raise result from e
+                    time.sleep(result)
+                    attempt += 1
+        finally:
+            # Ответ или ошибка OpenAI уже освободили пробный запрос; иначе (отмена,
+            # ошибка до отправки) его место освобождается здесь
+            if probe is not None:
+                self.breaker.release_probe(probe)
+
+    # Ответ целиком
+    def complete(self, messages, mode="default"):
+        deadline = time.monotonic() + self.timeout
+        started, probe = self._acquire(deadline, mode)
+        outcome = "error"
+        try:
+            response = self._create(messages, mode, deadline, probe)
+            outcome = "ok"
+        finally:
+            self._release(mode, started, outcome)
+        record_usage(mode, getattr(response, 'usage', None))
+        return response.choices[0].message.content
+
+    # Расшифровка аудио моделью model; file - (имя файла, открытый файл).
+    # Файл отправляется по частям и перед каждой попыткой перематывается в начало
+    def transcribe(self, file, model, mode="transcription"):
+        deadline = time.monotonic() + self.timeout
+        started, probe = self._acquire(deadline, mode)
+        outcome = "error"
+        try:
+            response = self._retry(lambda: self.client.audio.transcriptions.create(
+                model=model, file=rewind(file), timeout=max(deadline - time.monotonic(), 0.1)
+            ), mode, deadline, probe)
+            outcome = "ok"
+        finally:
+            self._release(mode, started, outcome)
+        return response.text
+
+    # Потоковый ответ: with gateway.stream(...) as chunks: for chunk in chunks: ...
+    # Соединение устанавливается (с повторами) при входе в with, поэтому при
+    # недоступности OpenAI ошибка возникает до отправки заглушки в чат.
+    # Обрыв посреди ответа не повторяется: часть текста уже показана
+    def stream(self, messages, mode="default"):
+        return CompletionStream(self, messages, mode)
+
+
+class CompletionStream:
+    """Потоковый ответ LLMGateway: место в семафоре занято до выхода из with."""
+
+    def __init__(self, gateway, messages, mode):
+        self.gateway = gateway
+        self.messages = messages
+        self.mode = mode
+        self._response = None
+        self._started = None
+
+    # Параметры потокового запроса: последним кусочком OpenAI присылает usage
+    STREAM_KWARGS = {"stream": True, "stream_options": {"include_usage": True}}
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.gateway.timeout
+        self._started, probe = self.gateway._acquire(deadline, self.mode)
+        try:
+            self._response = self.gateway._create(self.messages, self.mode, deadline, probe, **self.STREAM_KWARGS)
+        except BaseException:
+            self.gateway._release(self.mode, self._started, "error")
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        close = getattr(self._response, 'close', None)
+        if close is not None:
+            close()
+        self.gateway._release(self.mode, self._started, "ok" if exc_type is None else "error")
+
+    def _content(self, chunk):
+        if getattr(chunk, 'usage', None):
+            record_usage(self.mode, chunk.usage)
+        if chunk.choices and chunk.choices[0].delta.content:
+            return chunk.choices[0].delta.content
+        return None
+
+    def __iter__(self):
+        try:
+            for chunk in self._response:
+                content = self._content(chunk)
+                if content:
+                    yield content
+        except Exception as e:
+            if is_retryable(e):
+                self.gateway.breaker.record_failure()
+            logger.error("Потоковый ответ OpenAI в режиме '%s' оборвался: %s", self.mode, e)
+            raise LLMError(cause=e) from e
+
+
+class AsyncLLMGateway(LLMGateway):
+    """LLMGateway для AsyncOpenAI: те же правила, ожидание без блокировки цикла событий."""
+
+    def __init__(self, client, **kwargs):
+        super().__init__(client, **kwargs)
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+
+    async def _acquire(self, deadline, mode):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            logger.warning("Слишком много одновременных запросов к OpenAI, запрос отклонён.")
+            LLM_REQUESTS.inc(mode=mode, outcome="rejected")
+            raise LLMError(UNAVAILABLE_MESSAGE)
+        return self._started(mode)
+
+    async def _create(self, messages, mode, deadline, probe, **kwargs):
+        return await self._retry(
+            lambda: self.client.chat.completions.create(**self._request(messages, mode, deadline, **kwargs)),
+            mode, deadline, probe
+        )
+
+    async def _retry(self, call, mode, deadline, probe):
+        attempt = 0
+        try:
+            while True:
+                try:
+                    response = await call()
+                    self.breaker.record_success()
+                    return response
+                except Exception as e:
+                    result = self._on_error(e, attempt, deadline, mode)
+                    if isinstance(result, LLMError):
+                        raise result from e
+                    await asyncio.sleep(result)
+                    attempt += 1
+        finally:
+            # Отмена (CancelledError) - не ошибка OpenAI, но пробный запрос нужно освободить
+            if probe is not None:
+                self.breaker.release_probe(probe)
+
+    async def complete(self, messages, mode="default"):
+        deadline = time.monotonic() + self.timeout
+        started, probe = await self._acquire(deadline, mode)
+        outcome = "error"
+        try:
+            response = await self._create(messages, mode, deadline, probe)
+            outcome = "ok"
+        finally:
+            self._release(mode, started, outcome)
+        record_usage(mode, getattr(response, 'usage', None))
+        return response.choices[0].message.content
+
+    async def transcribe(self, file, model, mode="transcription"):
+        deadline = time.monotonic() + self.timeout
+        started, probe = await self._acquire(deadline, mode)
+        outcome = "error"
+        try:
+            response = await self._retry(lambda: self.client.audio.transcriptions.create(
+                model=model, file=rewind(file), timeout=max(deadline - time.monotonic(), 0.1)
+            ), mode, deadline, probe)
+            outcome = "ok"
+        finally:
+            self._release(mode, started, outcome)
+        return response.text
+
+    # Потоковый ответ: async with gateway.stream(...) as chunks: async for chunk in chunks: ...
+    def stream(self, messages, mode="default"):
+        return AsyncCompletionStream(self, messages, mode)
+
+
+class AsyncCompletionStream(CompletionStream):
+    """CompletionStream для AsyncLLMGateway."""
+
+    async def __aenter__(self):
+        deadline = time.monotonic() + self.gateway.timeout
+        self._started, probe = await self.gateway._acquire(deadline, self.mode)
+        try:
+            self._response = await self.gateway._create(self.messages, self.mode, deadline, probe, **self.STREAM_KWARGS)
+        except BaseException:
+            self.gateway._release(self.mode, self._started, "error")
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        close = getattr(self._response, 'close', None)
+        if close is not None:
+            await close()
+        self.gateway._release(self.mode, self._started, "ok" if exc_type is None else "error")
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._response:
+                content = self._content(chunk)
+                if content:
+                    yield content
+        except Exception as e:
+            if is_retryable(e):
+                self.gateway.breaker.record_failure()
+            logger.error("Потоковый ответ OpenAI в режиме '%s' оборвался: %s", self.mode, e)
+            raise LLMError(cause=e) from e
+
+
+# Создание шлюза по секции "llm" в config.json
+def create_llm_gateway(config, client, gateway_class=LLMGateway):
+    settings = config.get("llm", {})
+    return gateway_class(
+        client,
+        modes=settings.get("modes", {}),
+        timeout=settings.get("timeout", 60),
+        max_retries=settings.get("max_retries", 3),
+        backoff_base=settings.get("backoff_base", 0.5),
+        backoff_max=settings.get("backoff_max", 8),
+        max_in_flight=settings.get("max_in_flight", 16),
+        breaker=CircuitBreaker(
+            failure_threshold=settings.get("breaker_threshold", 5),
+            reset_timeout=settings.get("breaker_reset", 30)
+        )
+    )
@@ -0,0 +1,282 @@
+import os
+import base64
+import asyncio
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Обработка медиа режима 'info': файл скачивается пулом потоков по частям
+# во временный файл, из него получается текст (расшифровка голосового,
+# описание картинки, начало текстового документа), и этот текст сохраняется
+# по file_unique_id. В записи хранится только ссылка на файл, а текст
+# подставляется в format_entry() из кэша артефактов.
+
+# Типы медиа, которые попадают в записи, и их подписи в format_entry()
+MEDIA_TITLES = {
+    'photo': 'фото',
+    'video': 'видео',
+    'document': 'документ',
+    'voice': 'голосовое сообщение',
+    'video_note': 'видеосообщение'
+}
+
+# Что делать с файлом каждого типа
+TRANSCRIBE_KINDS = ('voice', 'video_note', 'video')
+VISION_KINDS = ('photo',)
+
+VISION_PROMPT = (
+    "Опиши, что изображено на картинке, в 1-3 предложениях. "
+    "Если на ней есть текст, перепиши его дословно."
+)
+
+DEFAULT_API_URL = "https://api.telegram.org/bot{0}/{1}"
+DEFAULT_FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+
+
+class ArtefactCache:
+    """
+    Тексты, полученные из медиа, по file_unique_id: недавние в памяти
+    (включая отметку "нет текста"), остальные в хранилище пользователей.
+    """
+
+    def __init__(self, max_items=10000):
+        self.store = None
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_unique_id):
+        with self._lock:
+            if file_unique_id in self._items:
+                self._items.move_to_end(file_unique_id)
+                return self._items[file_unique_id]
+        record = self.store.load_media(file_unique_id) if self.store is not None else None
+        self._remember(file_unique_id, record)
+        return record
+
+    def put(self, file_unique_id, record):
+        self._remember(file_unique_id, record)
+        if self.store is not None:
+            self.store.save_media(file_unique_id, record)
+
+    def _remember(self, file_unique_id, record):
+        with self._lock:
+            self._items[file_unique_id] = record
+            self._items.move_to_end(file_unique_id)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+ARTEFACTS = ArtefactCache()
+
+
+# Ссылки на медиа сообщения для записи: [{'id': file_unique_id, 'kind': тип}]
+def media_refs(message):
+    media = _message_media(message)
+    if media is None:
+        return []
+    kind, item = media
+    return [{'id': item.file_unique_id, 'kind': kind}]
+
+
+def _message_media(message):
+    kind = message.content_type
+    if kind == 'photo' and message.photo:
+        # Самый крупный из вариантов размера
+        return kind, message.photo[-1]
+    item = getattr(message, kind, None) if kind in MEDIA_TITLES else None
+    if item is None or not getattr(item, 'file_unique_id', None):
+        return None
+    return kind, item
+
+
+# Строка вложения для format_entry(): тип и извлечённый текст, если он уже есть
+def describe_media(ref):
+    title = MEDIA_TITLES.get(ref.get('kind'), 'файл')
+    record = ARTEFACTS.get(ref['id']) if ref.get('id') else None
+    if record and record.get('text'):
+        return f"[{title}] {record['text']}"
+    return f"[{title}]"
+
+
+class MediaPipeline:
+    """
+    Пул из workers потоков, которые скачивают и обрабатывают медиа.
+
+    Каждый файл обрабатывается один раз: если текст по file_unique_id уже
+    есть или файл обрабатывается прямо сейчас, задача не ставится. В
+    очереди не больше max_pending файлов, лишние пропускаются. Файлы больше
+    max_file_size не скачиваются: размер проверяется по сообщению, ответу
+    getFile и заголовку Content-Length (Bot API отдаёт не больше 20 МБ).
+
+    Запросы к OpenAI идут через шлюз llm (общие с ответами пользователям
+    сроки, повторы, ограничение числа запросов и предохранитель). Если шлюз
+    асинхронный (AsyncLLMGateway), нужно задать loop - цикл событий, в
+    котором он работает.
+    """
+
+    def __init__(self, token, llm, workers=2, max_pending=100, chunk_size=65536,
+                 max_file_size=20 * 1024 * 1024, api_url=None, file_url=None, proxy=None,
+                 transcription_model="whisper-1", document_chars=4000, timeout=60, artefacts=ARTEFACTS):
+        self.token = token
+        self.llm = llm
+        self.chunk_size = chunk_size
+        self.max_file_size = max_file_size
+        self.api_url = api_url or DEFAULT_API_URL
+        self.file_url = file_url or DEFAULT_FILE_URL
+        self.transcription_model = transcription_model
+        self.document_chars = document_chars
+        self.timeout = timeout
+        self.artefacts = artefacts
+        self.loop = None
+        self.session = requests.Session()
+        if proxy:
+            self.session.proxies = {"http": proxy, "https": proxy}
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="media")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._in_progress = set()
+        self._lock = threading.Lock()
+
+    # Постановка медиа сообщения в обработку. Возвращает True, если задача поставлена
+    def submit(self, message):
+        media = _message_media(message)
+        if media is None:
+            return False
+        kind, item = media
+        file_unique_id = item.file_unique_id
+        if getattr(item, 'file_size', None) and item.file_size > self.max_file_size:
+            logger.info("Файл %s пропущен: %d байт", file_unique_id, item.file_size, extra={"event": "media_skipped"})
+            return False
+        if self.artefacts.get(file_unique_id) is not None:
+            return False
+        with self._lock:
+            if file_unique_id in self._in_progress:
+                return False
+            if not self._slots.acquire(blocking=False):
+                logger.warning("Очередь обработки медиа переполнена, файл %s пропущен", file_unique_id)
+                return False
+            self._in_progress.add(file_unique_id)
+        self._pool.submit(self._process, kind, item.file_id, file_unique_id, getattr(item, 'mime_type', None))
+        return True
+
+    def _process(self, kind, file_id, file_unique_id, mime_type):
+        path = None
+        try:
+            with STAGE_SECONDS.time(stage="media"):
+                path = self._download(file_id)
+                text = self._extract(kind, path, mime_type)
+            self.artefacts.put(file_unique_id, {'kind': kind, 'text': text})
+            logger.info("Обработан файл %s (%s): %d симв.", file_unique_id, kind, len(text or ''),
+                        extra={"event": "media_processed"})
+        except Exception as e:
+            # Текст не сохраняется: при повторной пересылке файл обработается заново
+            logger.error("Не удалось обработать файл %s (%s): %s", file_unique_id, kind, e)
+        finally:
+            if path is not None:
+                os.unlink(path)
+            with self._lock:
+                self._in_progress.discard(file_unique_id)
+            self._slots.release()
+
+    # Скачивание по частям во временный файл; возвращает его путь
+    def _download(self, file_id):
+        response = self.session.get(self.api_url.format(self.token, "getFile"), params={"file_id": file_id},
+                                    timeout=self.timeout)
+        response.raise_for_status()
+        result = response.json()["result"]
+        file_path = result["file_path"]
+        # В сообщении размер указан не всегда: проверяем ещё до скачивания
+        self._check_size(result.get("file_size"))
+
+        fd, path = tempfile.mkstemp(prefix="nelegal-media-", suffix=os.path.splitext(file_path)[1])
+        try:
+            with os.fdopen(fd, "wb") as output, \
+                    self.session.get(self.file_url.format(self.token, file_path), stream=True,
+                                     timeout=self.timeout) as download:
+                download.raise_for_status()
+                self._check_size(int(download.headers.get("Content-Length") or 0))
+                size = 0
+                for chunk in download.iter_content(self.chunk_size):
+                    size += len(chunk)
+                    self._check_size(size)
+                    output.write(chunk)
+        except BaseException:
+            os.unlink(path)
+            raise
+        return path
+
+    def _check_size(self, size):
+        if size and size > self.max_file_size:
+            raise ValueError(f"файл больше {self.max_file_size} байт")
+
+    def _extract(self, kind, path, mime_type):
+        if kind in TRANSCRIBE_KINDS:
+            return self._transcribe(path)
+        if kind in VISION_KINDS or (kind == 'document' and (mime_type or '').startswith('image/')):
+            return self._describe_image(path, mime_type or 'image/jpeg')
+        if kind == 'document' and (mime_type or '').startswith('text/'):
+            with open(path, encoding='utf-8', errors='replace') as document:
+                return document.read(self.document_chars).strip()
+        return None
+
+    # Вызов метода шлюза из потока пула (у асинхронного шлюза - в его цикле событий)
+    def _call_llm(self, method, *args):
+        result = getattr(self.llm, method)(*args)
+        if self.loop is not None:
+            result = asyncio.run_coroutine_threadsafe(result, self.loop).result()
+        return result
+
+    # Файл отправляется из открытого файла по частям, а не читается в память целиком
+    def _transcribe(self, path):
+        with open(path, "rb") as audio:
+            return self._call_llm('transcribe', (os.path.basename(path), audio), self.transcription_model).strip()
+
+    def _describe_image(self, path, mime_type):
+        data = self._read_base64(path)
+        return self._call_llm('complete', [{"role": "user", "content": [
+            {"type": "text", "text": VISION_PROMPT},
+            {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{data}"}}
+        ]}], 'vision').strip()
+
+    # Картинка передаётся OpenAI внутри запроса (data URL), поэтому файл
+    # кодируется по частям: в памяти остаётся только base64, без копии файла
+    def _read_base64(self, path):
+        parts = []
+        with open(path, "rb") as image:
+            # Кратно 3 байтам: части кодируются без дополнения и просто склеиваются
+            for chunk in iter(lambda: image.read(max(self.chunk_size // 3, 1) * 3), b""):
+                parts.append(base64.b64encode(chunk).decode("ascii"))
+        return "".join(parts)
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Создание пайплайна по секции "media" в config.json (по умолчанию выключен).
+# llm - тот же шлюз OpenAI, через который идут ответы пользователям
+def create_media_pipeline(config, store, llm, proxy=None):
+    settings = config.get("media", {})
+    # Уже полученные тексты показываются и при выключенной обработке
+    ARTEFACTS.store = store
+    if not settings.get("enabled", False):
+        return None
+    return MediaPipeline(
+        config["TELEGRAM_BOT_TOKEN"],
+        llm,
+        workers=settings.get("workers", 2),
+        max_pending=settings.get("max_pending", 100),
+        chunk_size=settings.get("chunk_size", 65536),
+        max_file_size=settings.get("max_file_size", 20 * 1024 * 1024),
+        api_url=config.get("TELEGRAM_API_URL"),
+        file_url=config.get("TELEGRAM_FILE_URL"),
+        proxy=proxy,
+        transcription_model=settings.get("transcription_model", "whisper-1"),
+        document_chars=settings.get("document_chars", 4000),
+        timeout=settings.get("timeout", 60)
+    )
@@ -0,0 +1,306 @@
+import sys
+import time
+import bisect
+import inspect
+import functools
+import threading
+import logging
+from collections import Counter as _Counter
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Метрики в текстовом формате Prometheus без сторонних зависимостей.
+# Значения хранятся в словарях под одной блокировкой на метрику, поэтому
+# запись метрики в горячем пути обходится в несколько микросекунд.
+
+# Границы корзин гистограмм времени, секунды
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Общая часть метрик: имя, описание, имена меток и значения по меткам."""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self.labelnames, key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, labelnames, key, extra, value in self.samples():
+            lines.append(f"{name}{_format_labels(labelnames, key, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Текущее значение; set_function() - значение вычисляется при каждом запросе /metrics."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, func, **labels):
+        with self._lock:
+            self._functions[self._key(labels)] = func
+
+    def samples(self):
+        samples = super().samples()
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, func in functions:
+            try:
+                samples.append((self.name, self.labelnames, key, (), func()))
+            except Exception as e:
+                logger.debug("Метрика %s: ошибка вычисления значения: %s", self.name, e)
+        return samples
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Счётчики по корзинам (последняя - +Inf), сумма
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    # Замер блока кода: with histogram.time(stage="llm"): ...
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", self.labelnames, key, (("le", _format_value(bound)),), cumulative))
+            samples.append((f"{self.name}_sum", self.labelnames, key, (), total))
+            samples.append((f"{self.name}_count", self.labelnames, key, (), cumulative))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+# Метрики бота
+STAGE_SECONDS = Histogram(
+    "nelegal_stage_duration_seconds",
+    "Время этапов обработки: dispatch (обработчик целиком), structuring, retrieval, llm, media, persistence, send",
+    ["stage"]
+)
+DISPATCH_WAIT_SECONDS = Histogram(
+    "nelegal_dispatch_wait_seconds", "Время ожидания обновления в очереди диспетчера"
+)
+UPDATES = Counter("nelegal_updates_total", "Обработанные сообщения по режимам", ["mode"])
+LLM_REQUESTS = Counter("nelegal_llm_requests_total", "Запросы к OpenAI по режимам и результату", ["mode", "outcome"])
+LLM_TOKENS = Counter("nelegal_llm_tokens_total", "Токены OpenAI по режимам (prompt/completion)", ["mode", "type"])
+QUEUE_DEPTH = Gauge("nelegal_queue_depth", "Задач в очередях (dispatcher, send_queue, store)", ["queue"])
+IN_FLIGHT = Gauge("nelegal_in_flight", "Выполняемые сейчас задачи (dispatcher, llm)", ["component"])
+
+
+# Декоратор замера этапа; работает и для обычных, и для async-функций
+def timed(stage):
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with STAGE_SECONDS.time(stage=stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage=stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Учёт токенов из поля usage ответа OpenAI
+def record_usage(mode, usage):
+    if usage is None:
+        return
+    LLM_TOKENS.inc(getattr(usage, "prompt_tokens", 0) or 0, mode=mode, type="prompt")
+    LLM_TOKENS.inc(getattr(usage, "completion_tokens", 0) or 0, mode=mode, type="completion")
+
+
+class SamplingProfiler:
+    """
+    Выборочный профилировщик для отладки в продакшене: во время profile()
+    каждые interval секунд снимает стеки всех потоков через
+    sys._current_frames(). Результат - "свёрнутые" стеки (формат
+    flamegraph.pl / speedscope): "файл:функция;... число_выборок".
+    Пока профилирование не запрошено, накладных расходов нет.
+    """
+
+    def __init__(self, interval=0.01, max_seconds=60):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+
+    def profile(self, seconds):
+        seconds = min(seconds, self.max_seconds)
+        stacks = _Counter()
+        own = threading.get_ident()
+        # Одновременно идёт только одно профилирование
+        with self._lock:
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                        frame = frame.f_back
+                    stacks[";".join(reversed(stack))] += 1
+                time.sleep(self.interval)
+        return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+
+class MetricsServer:
+    """
+    HTTP-сервер метрик: GET /metrics - все метрики в формате Prometheus,
+    GET /debug/profile?seconds=N - выборочное профилирование (если включено).
+    """
+
+    def __init__(self, host="127.0.0.1", port=9100, registry=None, profiler=None):
+        self.registry = registry or REGISTRY
+        self.profiler = profiler
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if url.path == "/metrics":
+                    self._reply(200, server.registry.render(), "text/plain; version=0.0.4; charset=utf-8")
+                elif url.path == "/debug/profile" and server.profiler is not None:
+                    try:
+                        seconds = float(parse_qs(url.query).get("seconds", ["10"])[0])
+                    except ValueError:
+                        self._reply(400, "seconds должно быть числом\n")
+                        return
+                    self._reply(200, server.profiler.profile(seconds))
+                else:
+                    self._reply(404, "not found\n")
+
+            def _reply(self, status, text, content_type="text/plain; charset=utf-8"):
+                body = text.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("Metrics: " + format, *args)
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info("Метрики доступны на http://%s:%s/metrics", self.address[0], self.address[1])
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# Запуск сервера метрик по секции "metrics" в config.json (по умолчанию выключен)
+def start_metrics_server(config):
+    settings = config.get("metrics", {})
+    if not settings.get("enabled", False):
+        return None
+    profiler = None
+    if settings.get("profiler", False):
+        profiler = SamplingProfiler(interval=settings.get("profile_interval", 0.01))
+    server = MetricsServer(settings.get("listen", "127.0.0.1"), settings.get("port", 9100), profiler=profiler)
+    server.start()
+    return server
@@ -0,0 +1,232 @@
+import os
+import math
+import zlib
+import hashlib
+import importlib
+import threading
+import logging
+from collections import Counter, OrderedDict
+from storage import WORD_REGEX
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# numpy необязателен: без него выбор записей по смыслу отключается
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Отбор сохранённых записей, относящихся к вопросу. Каждая запись (в виде
+# format_entry) превращается в вектор один раз; векторы пользователя лежат
+# в файле, отображённом в память (numpy.memmap), и на запрос считается
+# косинусная близость сразу по всей матрице.
+
+
+class HashingEmbedder:
+    """
+    Векторизатор без сети и обученных моделей: слова и их буквенные
+    триграммы (устойчивость к окончаниям) хешируются в dim корзин со
+    знаком, вес - 1 + log(частота). Веса IDF применяются при поиске.
+    """
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    @staticmethod
+    def _features(text):
+        for word in WORD_REGEX.findall(text.casefold()):
+            yield word
+            if len(word) > 3:
+                padded = f"#{word}#"
+                for i in range(len(padded) - 2):
+                    yield padded[i:i + 3]
+
+    def embed(self, texts):
+        rows, buckets, weights = [], [], []
+        for row, text in enumerate(texts):
+            for feature, count in Counter(self._features(text)).items():
+                rows.append(row)
+                buckets.append(zlib.crc32(feature.encode('utf-8')))
+                weights.append(1.0 + math.log(count))
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        if rows:
+            buckets = np.array(buckets, dtype=np.uint32)
+            # Старший бит хеша задаёт знак, чтобы коллизии в среднем гасили друг друга
+            signs = np.where(buckets & 0x80000000, 1.0, -1.0)
+            np.add.at(matrix, (np.array(rows), buckets % self.dim), signs * np.array(weights))
+        return matrix
+
+
+# Ключ текста записи: по нему видно, что запись изменилась и её вектор нужно пересчитать
+def _text_key(text):
+    key = int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+    # 0 означает пустую строку матрицы
+    return key or 1
+
+
+class _UserVectors:
+    """Векторы записей одного пользователя: матрица (capacity, dim) и ключи строк в файлах .npy."""
+
+    def __init__(self, path, dim):
+        self.path = path
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.keys = None
+        self.open()
+
+    # Открытие уже сохранённых файлов (в том числе после вытеснения из Retriever)
+    def open(self):
+        if self.keys is None and os.path.exists(self._file("vec")):
+            self.vectors = np.load(self._file("vec"), mmap_mode='r+')
+            self.keys = np.load(self._file("key"), mmap_mode='r+')
+
+    def _file(self, kind):
+        return f"{self.path}.{kind}.npy"
+
+    @property
+    def capacity(self):
+        return 0 if self.keys is None else len(self.keys)
+
+    # Увеличение файлов вдвое (с копированием уже посчитанных строк)
+    def reserve(self, size):
+        if size <= self.capacity:
+            return
+        capacity = max(64, self.capacity * 2, size)
+        vectors = np.lib.format.open_memmap(self._file("vec") + ".tmp", mode='w+', dtype=np.float32,
+                                            shape=(capacity, self.dim))
+        keys = np.lib.format.open_memmap(self._file("key") + ".tmp", mode='w+', dtype=np.uint64, shape=(capacity,))
+        if self.keys is not None:
+            vectors[:self.capacity] = self.vectors
+            keys[:self.capacity] = self.keys
+        vectors.flush()
+        keys.flush()
+        self.close()
+        os.replace(self._file("vec") + ".tmp", self._file("vec"))
+        os.replace(self._file("key") + ".tmp", self._file("key"))
+        self.vectors, self.keys = vectors, keys
+
+    def close(self):
+        if self.keys is not None:
+            self.vectors.flush()
+            self.keys.flush()
+        self.vectors = self.keys = None
+
+
+class Retriever:
+    """
+    Выбор top_k записей пользователя, ближайших к запросу.
+
+    При каждом поиске ключи строк матрицы сверяются с текущими записями и
+    векторизуются только новые и изменённые записи (после 'Clear Info' лишние строки
+    обнуляются). Открытые файлы держатся для max_open недавних
+    пользователей. Записи с близостью ниже min_score не выбираются.
+    """
+
+    def __init__(self, embedder, path, top_k=8, min_score=0.05, max_open=256):
+        self.embedder = embedder
+        self.path = os.path.join(path, embedder.name)
+        self.top_k = top_k
+        self.min_score = min_score
+        self.max_open = max_open
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def _user(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                user = self._users[user_id] = _UserVectors(os.path.join(self.path, str(user_id)), self.embedder.dim)
+            self._users.move_to_end(user_id)
+            evicted = []
+            while len(self._users) > self.max_open:
+                evicted.append(self._users.popitem(last=False)[1])
+        for old in evicted:
+            with old.lock:
+                old.close()
+        return user
+
+    # Векторизация новых и изменённых записей. Возвращает матрицу (len(texts), dim)
+    def _sync(self, vectors, texts):
+        keys = np.fromiter((_text_key(text) for text in texts), dtype=np.uint64, count=len(texts))
+        vectors.open()
+        vectors.reserve(len(texts))
+        stale = np.flatnonzero(vectors.keys[:len(texts)] != keys)
+        if len(stale):
+            vectors.vectors[stale] = self.embedder.embed([texts[i] for i in stale])
+            vectors.keys[stale] = keys[stale]
+            logger.debug("Векторизовано записей: %d из %d", len(stale), len(texts))
+        # Строки удалённых записей (например, после 'Clear Info')
+        vectors.keys[len(texts):] = 0
+        return vectors.vectors[:len(texts)]
+
+    # Позиции записей, наиболее близких к запросу, по убыванию близости
+    @timed("retrieval")
+    def search(self, user_id, texts, query, top_k=None):
+        if not texts or not query:
+            return []
+        top_k = top_k or self.top_k
+        vectors = self._user(user_id)
+        with vectors.lock:
+            matrix = np.asarray(self._sync(vectors, texts))
+            # IDF по записям пользователя: слова, встречающиеся везде
+            # (например, заголовки format_entry), почти не влияют на близость
+            df = np.count_nonzero(matrix, axis=0)
+            idf = np.log((1.0 + len(texts)) / (1.0 + df)).astype(np.float32)
+            weighted = matrix * idf
+        query_vector = self.embedder.embed([query])[0] * idf
+        norms = np.linalg.norm(weighted, axis=1) * np.linalg.norm(query_vector)
+        scores = np.divide(weighted @ query_vector, norms, out=np.zeros(len(texts), dtype=np.float32), where=norms > 0)
+
+        count = min(top_k, len(texts))
+        best = np.argpartition(-scores, count - 1)[:count]
+        best = best[np.argsort(-scores[best])]
+        return [int(position) for position in best if scores[position] >= self.min_score]
+
+    # Пользователь вытеснен из памяти (см. UserCache): его файлы закрываются
+    def forget(self, user_id):
+        with self._lock:
+            vectors = self._users.pop(user_id, None)
+        if vectors is not None:
+            with vectors.lock:
+                vectors.close()
+
+    def close(self):
+        with self._lock:
+            users, self._users = list(self._users.values()), OrderedDict()
+        for vectors in users:
+            with vectors.lock:
+                vectors.close()
+
+
+# Векторизатор по секции "retrieval": "hashing" или путь "модуль:класс"
+# к своему классу с атрибутами name, dim и методом embed(texts)
+def load_embedder(settings):
+    embedder = settings.get("embedder", "hashing")
+    if embedder == "hashing":
+        return HashingEmbedder(settings.get("dim", 512))
+    module_name, _, class_name = embedder.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)(**settings.get("embedder_options", {}))
+
+
+# Создание Retriever по секции "retrieval" в config.json (None - выбор записей отключён)
+def create_retriever(config, base_dir):
+    settings = config.get("retrieval", {})
+    if not settings.get("enabled", True):
+        return None
+    if np is None:
+        logger.warning("numpy не установлен: выбор записей по смыслу отключён")
+        return None
+    path = settings.get("path", "vectors")
+    if not os.path.isabs(path):
+        path = os.path.join(base_dir, path)
+    return Retriever(
+        load_embedder(settings),
+        path,
+        top_k=settings.get("top_k", 8),
+        min_score=settings.get("min_score", 0.05),
+        max_open=settings.get("max_open", 256)
+    )
@@ -0,0 +1,104 @@
+import logging
+from storage import WORD_REGEX
+
+logger = logging.getLogger(__name__)
+
+# Команды /search и /list: поиск по сохранённым записям без запроса к GPT
+# и постраничный просмотр. Поиск идёт по индексу хранилища (FTS5 в SQLite),
+# а если хранилище поиск не поддерживает - перебором записей в памяти.
+
+# Настройки поиска из секции "search" (задаются через bot_core.configure())
+search_settings = {"results": 10, "page_size": 20, "preview": 150}
+
+
+def _fields(entry):
+    if isinstance(entry, dict):
+        return entry.get('user_text'), entry.get('forwarded_text'), entry.get('link')
+    if isinstance(entry, (list, tuple)) and len(entry) == 3:
+        return tuple(entry)
+    return None, None, None
+
+
+# Краткое содержание записи в одну строку: текст пользователя и начало поста
+def entry_preview(entry, limit=None):
+    limit = limit or search_settings["preview"]
+    user_text, forwarded_text, _ = _fields(entry)
+    parts = [text for text in (user_text, forwarded_text) if text and text != 'Неизвестно']
+    preview = " — ".join(" ".join(text.split()) for text in parts) or "(пусто)"
+    return preview if len(preview) <= limit else preview[:limit].rstrip() + "…"
+
+
+def _entry_link(entry):
+    link = _fields(entry)[2]
+    return link if link and link != 'Неизвестно' else None
+
+
+# Поиск перебором (для хранилищ без индекса): записи, содержащие все слова запроса
+def scan_entries(entries, query, limit):
+    words = [word.casefold() for word in WORD_REGEX.findall(query)]
+    if not words:
+        return []
+    scored = []
+    for position, entry in enumerate(entries):
+        text = " ".join(value for value in _fields(entry) if value).casefold()
+        if all(word in text for word in words):
+            scored.append((-sum(text.count(word) for word in words), position))
+    scored.sort()
+    return [(position, entry_preview(entries[position])) for _, position in scored[:limit]]
+
+
+# Поиск по записям пользователя: список (позиция, фрагмент) по убыванию релевантности
+def search_entries(store, user, query):
+    limit = search_settings["results"]
+    results = store.search(user.user_id, query, limit)
+    if results is None:
+        results = scan_entries(user.info_message, query, limit)
+    return results
+
+
+# Текст ответа на /search
+def format_search_results(entries, query, results):
+    if not results:
+        return f"По запросу «{query}» ничего не найдено."
+    lines = [f"Результаты по запросу «{query}»:"]
+    for position, fragment in results:
+        line = f"{position + 1}. {' '.join(fragment.split())}"
+        link = _entry_link(entries[position]) if position < len(entries) else None
+        if link:
+            line += f"\n{link}"
+        lines.append(line)
+    return "\n\n".join(lines)
+
+
+# Номер страницы из аргумента /list (по умолчанию - последняя, с новыми записями)
+def parse_page(argument, entries):
+    pages = max(1, -(-len(entries) // search_settings["page_size"]))
+    try:
+        page = int(argument)
+    except (TypeError, ValueError):
+        page = pages
+    return min(max(page, 1), pages), pages
+
+
+# Текст страницы /list: форматируются только записи этой страницы
+def format_page(entries, page, pages):
+    if not entries:
+        return "Нет сохраненной информации."
+    size = search_settings["page_size"]
+    start = (page - 1) * size
+    lines = [f"Записи {start + 1}–{min(start + size, len(entries))} из {len(entries)} (страница {page} из {pages}):"]
+    for position in range(start, min(start + size, len(entries))):
+        entry = entries[position]
+        line = f"{position + 1}. {entry_preview(entry)}"
+        link = _entry_link(entry)
+        if link:
+            line += f" ({link})"
+        lines.append(line)
+    navigation = []
+    if page > 1:
+        navigation.append(f"назад: /list {page - 1}")
+    if page < pages:
+        navigation.append(f"вперёд: /list {page + 1}")
+    if navigation:
+        lines.append("Страницы: " + ", ".join(navigation))
+    return "\n".join(lines)
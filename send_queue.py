@@ -0,0 +1,356 @@
+import time
+import asyncio
+import threading
+import logging
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from telebot.apihelper import ApiTelegramException
+from streaming import get_retry_after
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Сколько секунд ждать до появления токена
+    def delay(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class SendQueue:
+    """
+    Очередь исходящих вызовов Telegram API.
+
+    Все отправки идут через неё: для каждого чата и для бота в целом
+    действуют свои ограничители частоты, а при ответе 429 чат ставится на
+    паузу на retry_after секунд и вызов повторяется. Вызовы в один чат
+    выполняются строго по порядку. Подтверждения сохранения, пришедшие в
+    один чат подряд, склеиваются в одно сообщение "Сохранено записей: N".
+    """
+
+    def __init__(self, bot, per_chat_rate=1.0, per_chat_burst=3, global_rate=30,
+                 workers=4, ack_delay=1.5, max_retries=5):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.ack_delay = ack_delay
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()
+        self._buckets = {}
+        self._retry_at = {}
+        self._busy = set()
+        self._acks = {}
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"send-queue-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def queue_depth(self):
+        return self._pending
+
+    # Постановка произвольного вызова в очередь чата; возвращает Future
+    def submit(self, chat_id, func, *args, **kwargs):
+        future = Future()
+        with self._cond:
+            # Отложенное подтверждение должно уйти раньше следующего сообщения
+            self._flush_ack(chat_id)
+            self._enqueue(chat_id, (func, args, kwargs, future, 0))
+        return future
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.submit(chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    # Подтверждение с задержкой: если в течение ack_delay придут ещё
+    # подтверждения в тот же чат, отправится одно общее сообщение
+    def acknowledge(self, chat_id, text, batch_text=None, reply_markup=None):
+        with self._cond:
+            ack = self._acks.setdefault(chat_id, {'count': 0})
+            ack['count'] += 1
+            ack['text'] = text
+            ack['batch_text'] = batch_text or text
+            ack['reply_markup'] = reply_markup
+            ack['deadline'] = time.monotonic() + self.ack_delay
+            self._cond.notify()
+
+    def _enqueue(self, chat_id, job, front=False):
+        queue = self._chats.setdefault(chat_id, deque())
+        if front:
+            queue.appendleft(job)
+        else:
+            queue.append(job)
+        self._pending += 1
+        self._cond.notify()
+
+    def _flush_ack(self, chat_id):
+        ack = self._acks.pop(chat_id, None)
+        if ack is None:
+            return
+        text = ack['text'] if ack['count'] == 1 else ack['batch_text'].format(count=ack['count'])
+        self._enqueue(chat_id, (
+            self.bot.send_message, (chat_id, text), {'reply_markup': ack['reply_markup']}, Future(), 0
+        ))
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        return bucket
+
+    # Выбор следующего вызова, который можно выполнить прямо сейчас.
+    # Возвращает (чат, вызов) или (None, сколько секунд подождать)
+    def _next_job(self):
+        now = time.monotonic()
+        wait = None
+
+        for chat_id in [c for c, ack in self._acks.items() if ack['deadline'] <= now]:
+            self._flush_ack(chat_id)
+        for ack in self._acks.values():
+            wait = ack['deadline'] - now if wait is None else min(wait, ack['deadline'] - now)
+
+        global_delay = self._global.delay(now)
+        for chat_id, queue in self._chats.items():
+            if not queue or chat_id in self._busy:
+                continue
+            delay = max(self._retry_at.get(chat_id, 0) - now, self._bucket(chat_id).delay(now), global_delay)
+            if delay <= 0:
+                self._global.consume(now)
+                self._bucket(chat_id).consume(now)
+                self._busy.add(chat_id)
+                self._pending -= 1
+                # Чат уходит в конец, чтобы остальные чаты не ждали
+                self._chats.move_to_end(chat_id)
+                return chat_id, queue.popleft()
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                chat_id, job = self._next_job()
+                while chat_id is None:
+                    if self._closed and not self._pending and not self._acks:
+                        return
+                    self._cond.wait(timeout=job)
+                    chat_id, job = self._next_job()
+
+            func, args, kwargs, future, attempt = job
+            retry_after = None
+            try:
+                with STAGE_SECONDS.time(stage="send"):
+                    result = func(*args, **kwargs)
+                future.set_result(result)
+            except ApiTelegramException as e:
+                retry_after = get_retry_after(e) if attempt < self.max_retries else None
+                if retry_after is not None:
+                    logger.warning("Telegram ограничил отправку в чат %s, повтор через %s с", chat_id, retry_after)
+                else:
+                    logger.error("Ошибка отправки в чат %s: %s", chat_id, e)
+                    future.set_exception(e)
+            except Exception as e:
+                logger.error("Ошибка отправки в чат %s: %s", chat_id, e)
+                future.set_exception(e)
+
+            with self._cond:
+                self._busy.discard(chat_id)
+                if retry_after is not None:
+                    self._retry_at[chat_id] = time.monotonic() + retry_after
+                    self._enqueue(chat_id, (func, args, kwargs, future, attempt + 1), front=True)
+                elif not self._chats.get(chat_id):
+                    # Чат без сообщений больше не нужен
+                    self._chats.pop(chat_id, None)
+                    self._retry_at.pop(chat_id, None)
+                    bucket = self._bucket(chat_id)
+                    if bucket.delay(time.monotonic()) == 0 and bucket.tokens >= bucket.capacity and chat_id not in self._acks:
+                        self._buckets.pop(chat_id, None)
+                self._cond.notify_all()
+
+    # Отправка всего, что осталось в очереди, и остановка потоков
+    def close(self, timeout=30):
+        with self._cond:
+            self._closed = True
+            for chat_id in list(self._acks):
+                self._flush_ack(chat_id)
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+
+
+class QueuedBot:
+    """
+    Обёртка для кода, которому нужен результат вызова сразу (например,
+    message_id заглушки при потоковом выводе): вызовы идут через очередь,
+    а метод дожидается ответа Telegram.
+    """
+
+    def __init__(self, send_queue):
+        self.send_queue = send_queue
+        self.bot = send_queue.bot
+
+    def send_message(self, chat_id, text, **kwargs):
+        return self.send_queue.send_message(chat_id, text, **kwargs).result()
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return self.send_queue.submit(
+            chat_id, self.bot.edit_message_text, text, chat_id, message_id, **kwargs
+        ).result()
+
+
+class AsyncSendQueue:
+    """
+    Вариант SendQueue для AsyncTeleBot.
+
+    Вызовы в один чат выполняются по очереди (asyncio.Lock на чат), перед
+    каждым вызовом ждём токены ограничителей чата и бота, при ответе 429
+    ждём retry_after и повторяем. Подтверждения склеиваются так же, как в
+    SendQueue.
+    """
+
+    def __init__(self, bot, per_chat_rate=1.0, per_chat_burst=3, global_rate=30,
+                 ack_delay=1.5, max_retries=5):
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.ack_delay = ack_delay
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        self._locks = {}
+        self._waiting = {}
+        self._acks = {}
+        self._tasks = set()
+        self._pending = 0
+
+    @property
+    def queue_depth(self):
+        return self._pending
+
+    async def call(self, chat_id, func, *args, **kwargs):
+        # Отложенное подтверждение должно уйти раньше следующего сообщения
+        await self._flush_ack(chat_id)
+        return await self._call(chat_id, func, args, kwargs)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.call(chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    async def _call(self, chat_id, func, args, kwargs):
+        self._pending += 1
+        self._waiting[chat_id] = self._waiting.get(chat_id, 0) + 1
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            async with lock:
+                for attempt in range(self.max_retries + 1):
+                    await self._wait_turn(chat_id)
+                    try:
+                        with STAGE_SECONDS.time(stage="send"):
+                            return await func(*args, **kwargs)
+                    except Exception as e:
+                        retry_after = get_retry_after(e) if attempt < self.max_retries else None
+                        if retry_after is None:
+                            logger.error("Ошибка отправки в чат %s: %s", chat_id, e)
+                            raise
+                        logger.warning("Telegram ограничил отправку в чат %s, повтор через %s с", chat_id, retry_after)
+                        await asyncio.sleep(retry_after)
+        finally:
+            self._pending -= 1
+            self._waiting[chat_id] -= 1
+            if not self._waiting[chat_id]:
+                # Чат без сообщений больше не нужен
+                del self._waiting[chat_id]
+                del self._locks[chat_id]
+                bucket = self._buckets.get(chat_id)
+                if bucket is not None and bucket.delay(time.monotonic()) == 0 and bucket.tokens >= bucket.capacity:
+                    del self._buckets[chat_id]
+
+    # Ожидание токенов ограничителей чата и бота
+    async def _wait_turn(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        while True:
+            now = time.monotonic()
+            delay = max(bucket.delay(now), self._global.delay(now))
+            if delay <= 0:
+                bucket.consume(now)
+                self._global.consume(now)
+                return
+            await asyncio.sleep(delay)
+
+    def acknowledge(self, chat_id, text, batch_text=None, reply_markup=None):
+        ack = self._acks.get(chat_id)
+        if ack is None:
+            ack = self._acks[chat_id] = {'count': 0}
+        else:
+            ack['task'].cancel()
+        ack['count'] += 1
+        ack['text'] = text
+        ack['batch_text'] = batch_text or text
+        ack['reply_markup'] = reply_markup
+        ack['task'] = asyncio.create_task(self._ack_later(chat_id))
+        self._tasks.add(ack['task'])
+        ack['task'].add_done_callback(self._tasks.discard)
+
+    async def _ack_later(self, chat_id):
+        await asyncio.sleep(self.ack_delay)
+        await self._flush_ack(chat_id)
+
+    async def _flush_ack(self, chat_id):
+        ack = self._acks.pop(chat_id, None)
+        if ack is None:
+            return
+        if ack['task'] is not asyncio.current_task():
+            ack['task'].cancel()
+        text = ack['text'] if ack['count'] == 1 else ack['batch_text'].format(count=ack['count'])
+        try:
+            await self._call(chat_id, self.bot.send_message, (chat_id, text), {'reply_markup': ack['reply_markup']})
+        except Exception as e:
+            # Подтверждение ждёт только очередь, поэтому ошибка не передаётся дальше, но
+            # в логе должно остаться, сколько сообщений пользователь не увидел подтверждёнными
+            logger.error("Подтверждение в чат %s не отправлено (сообщений: %d): %s", chat_id, ack['count'], e,
+                         extra={"event": "ack_failed"})
+
+    # Отправка отложенных подтверждений перед остановкой
+    async def close(self):
+        await asyncio.gather(*(self._flush_ack(chat_id) for chat_id in list(self._acks)))
+
+
+class AsyncQueuedBot:
+    """То же, что QueuedBot, для AsyncSendQueue."""
+
+    def __init__(self, send_queue):
+        self.send_queue = send_queue
+        self.bot = send_queue.bot
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self.send_queue.send_message(chat_id, text, **kwargs)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return await self.send_queue.call(
+            chat_id, self.bot.edit_message_text, text, chat_id, message_id, **kwargs
+        )
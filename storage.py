@@ -0,0 +1,546 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+import logging
+from metrics import STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Поля записи info_message, которые хранятся в отдельных колонках.
+# Остальные ключи записи сохраняются в колонке extra в виде JSON.
+ENTRY_FIELDS = ('user_text', 'forwarded_text', 'link')
+
+# Ключи User.to_dict(), которые хранятся в отдельных колонках/таблицах
+USER_FIELDS = ('user_id', 'mode', 'info_message')
+
+# Полнотекстовый индекс записей info_message (FTS5 с внешним содержимым:
+# текст хранится только в info_entries, индекс обновляется триггерами)
+FTS_SCHEMA = """
+    CREATE VIRTUAL TABLE info_entries_fts USING fts5(
+        user_text, forwarded_text, link,
+        content='info_entries', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    );
+    CREATE TRIGGER info_entries_fts_insert AFTER INSERT ON info_entries BEGIN
+        INSERT INTO info_entries_fts (rowid, user_text, forwarded_text, link)
+        VALUES (new.id, new.user_text, new.forwarded_text, new.link);
+    END;
+    CREATE TRIGGER info_entries_fts_delete AFTER DELETE ON info_entries BEGIN
+        INSERT INTO info_entries_fts (info_entries_fts, rowid, user_text, forwarded_text, link)
+        VALUES ('delete', old.id, old.user_text, old.forwarded_text, old.link);
+    END;
+    CREATE TRIGGER info_entries_fts_update AFTER UPDATE ON info_entries BEGIN
+        INSERT INTO info_entries_fts (info_entries_fts, rowid, user_text, forwarded_text, link)
+        VALUES ('delete', old.id, old.user_text, old.forwarded_text, old.link);
+        INSERT INTO info_entries_fts (rowid, user_text, forwarded_text, link)
+        VALUES (new.id, new.user_text, new.forwarded_text, new.link);
+    END;
+    INSERT INTO info_entries_fts (info_entries_fts) VALUES ('rebuild');
+"""
+
+# Слова запроса (остальные символы синтаксиса FTS5 отбрасываются)
+WORD_REGEX = re.compile(r'\w+')
+
+
+# Запрос FTS5 из текста пользователя: все слова, каждое как префикс
+def fts_query(text):
+    return " ".join(f'"{word}"*' for word in WORD_REGEX.findall(text))
+
+
+class UserStore:
+    """
+    Базовое хранилище данных пользователей.
+
+    Работает со словарями User.to_dict()/User.from_dict(). Обработчики только
+    помечают пользователя изменённым через mark_dirty(), а запись на диск
+    происходит пачкой в flush(): по таймеру или после flush_every обновлений.
+    """
+
+    def __init__(self, flush_interval=2.0, flush_every=50):
+        self.flush_interval = flush_interval
+        self.flush_every = flush_every
+        self._dirty = {}
+        self._flushing = {}
+        self._rewrite = set()
+        self._edited = {}
+        self._updates = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    # Сколько пользователей ждут записи на диск
+    @property
+    def dirty_count(self):
+        return len(self._dirty)
+
+    # Изменённый пользователь, который ещё не записан на диск (или None)
+    def pending_user(self, user_id):
+        with self._lock:
+            return self._dirty.get(user_id) or self._flushing.get(user_id)
+
+    # Пользователь вытеснен из памяти: служебные данные о нём можно не хранить
+    def forget(self, user_id):
+        pass
+
+    def load_all(self):
+        raise NotImplementedError
+
+    def load_user(self, user_id):
+        raise NotImplementedError
+
+    def is_empty(self):
+        raise NotImplementedError
+
+    def get_meta(self, key):
+        return None
+
+    def set_meta(self, key, value):
+        pass
+
+    # Последняя сводка 'Show Info' пользователя (см. digest.py)
+    def load_digest(self, user_id):
+        return None
+
+    # Текст, полученный из медиа, по file_unique_id (см. media.py)
+    def load_media(self, file_unique_id):
+        return None
+
+    def save_media(self, file_unique_id, record):
+        pass
+
+    # Полнотекстовый поиск по записям пользователя: список (позиция, фрагмент)
+    # по убыванию релевантности. None - хранилище не поддерживает поиск
+    def search(self, user_id, query, limit=10):
+        return None
+
+    def save_digest(self, user_id, record):
+        pass
+
+    # edited - позиции записей info_message, изменённых на месте, по user_id
+    def _write(self, records, rewrite, edited):
+        raise NotImplementedError
+
+    # Пометка пользователя изменённым. rewrite=True означает, что info_message
+    # был изменён не только добавлением в конец (например, 'Clear Info').
+    def mark_dirty(self, user, rewrite=False):
+        with self._lock:
+            self._dirty[user.user_id] = user
+            if rewrite:
+                self._rewrite.add(user.user_id)
+            self._updates += 1
+            need_flush = self._updates >= self.flush_every
+        if need_flush:
+            # Запись идёт в фоновом потоке, чтобы обработчик (или цикл asyncio) не ждал диск
+            if self._thread is not None:
+                self._wakeup.set()
+            else:
+                self.flush()
+
+    # Запись всех изменённых пользователей одной транзакцией
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                dirty, self._dirty = self._dirty, {}
+                rewrite, self._rewrite = self._rewrite, set()
+                edited, self._edited = self._edited, {}
+                self._updates = 0
+                self._flushing = dirty
+            if not dirty:
+                return
+            records = {}
+            for user_id, user in dirty.items():
+                # Позиции забираются до to_dict(), чтобы изменение между ними не потерялось
+                take_edited = getattr(user, 'take_edited', None)
+                positions = take_edited() if take_edited is not None else None
+                if positions:
+                    edited.setdefault(user_id, set()).update(positions)
+                data = user.to_dict()
+                data['info_message'] = list(data.get('info_message', []))
+                records[user_id] = data
+            try:
+                with STAGE_SECONDS.time(stage="persistence"):
+                    self._write(records, rewrite, edited)
+                logger.info("Сохранены данные пользователей: %d", len(records), extra={"event": "store_flush"})
+            except Exception as e:
+                # Возвращаем пользователей в очередь, чтобы не потерять изменения
+                logger.error("Ошибка при сохранении данных пользователей: %s", e)
+                with self._lock:
+                    for user_id, user in dirty.items():
+                        self._dirty.setdefault(user_id, user)
+                    self._rewrite |= rewrite
+                    for user_id, positions in edited.items():
+                        self._edited.setdefault(user_id, set()).update(positions)
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    # Фоновый поток, периодически сбрасывающий изменения на диск
+    def start(self):
+        if self._thread is not None or not self.flush_interval:
+            return
+        self._thread = threading.Thread(target=self._flush_loop, name="user-store-flush", daemon=True)
+        self._thread.start()
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+class SQLiteUserStore(UserStore):
+    """
+    Хранилище в SQLite (режим WAL): одна строка на пользователя в users и
+    одна строка на запись info_message в info_entries. При сохранении
+    дописываются только новые записи, а не весь список целиком.
+    """
+
+    def __init__(self, path, flush_interval=2.0, flush_every=50):
+        super().__init__(flush_interval, flush_every)
+        self.path = path
+        self._db_lock = threading.Lock()
+        # Сколько записей info_message и какой режим уже лежат в базе
+        self._persisted = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+        self.fts = self._create_fts()
+
+    def _create_tables(self):
+        with self._db_lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    mode TEXT NOT NULL DEFAULT 'main',
+                    data TEXT
+                );
+                CREATE TABLE IF NOT EXISTS info_entries (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    user_text TEXT,
+                    forwarded_text TEXT,
+                    link TEXT,
+                    extra TEXT
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS info_entries_user_position
+                    ON info_entries (user_id, position);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS digests (
+                    user_id INTEGER PRIMARY KEY,
+                    key TEXT NOT NULL,
+                    entry_count INTEGER NOT NULL,
+                    digest TEXT NOT NULL,
+                    tokens INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE TABLE IF NOT EXISTS media (
+                    file_unique_id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    text TEXT
+                );
+            """)
+
+    # Индекс создаётся один раз и заполняется по уже сохранённым записям
+    def _create_fts(self):
+        with self._db_lock:
+            exists = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'info_entries_fts'"
+            ).fetchone()
+            if exists:
+                return True
+            try:
+                with self._conn:
+                    self._conn.executescript("BEGIN;" + FTS_SCHEMA + "COMMIT;")
+            except sqlite3.OperationalError as e:
+                # SQLite собран без FTS5
+                logger.warning("Полнотекстовый поиск недоступен: %s", e)
+                return False
+        logger.info("Создан полнотекстовый индекс записей")
+        return True
+
+    def get_meta(self, key):
+        with self._db_lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key, value):
+        with self._db_lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False))
+            )
+
+    def load_digest(self, user_id):
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT key, entry_count, digest, tokens FROM digests WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'key': row[0], 'entry_count': row[1], 'digest': row[2], 'tokens': row[3]}
+
+    def save_digest(self, user_id, record):
+        with self._db_lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO digests (user_id, key, entry_count, digest, tokens) VALUES (?, ?, ?, ?, ?)",
+                (user_id, record['key'], record['entry_count'], record['digest'], record['tokens'])
+            )
+
+    def load_media(self, file_unique_id):
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT kind, text FROM media WHERE file_unique_id = ?", (file_unique_id,)
+            ).fetchone()
+        return {'kind': row[0], 'text': row[1]} if row else None
+
+    def save_media(self, file_unique_id, record):
+        with self._db_lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO media (file_unique_id, kind, text) VALUES (?, ?, ?)",
+                (file_unique_id, record['kind'], record['text'])
+            )
+
+    def search(self, user_id, query, limit=10):
+        if not self.fts:
+            return None
+        match = fts_query(query)
+        if not match:
+            return []
+        with self._db_lock:
+            return self._conn.execute(
+                "SELECT e.position, snippet(info_entries_fts, -1, '«', '»', '…', 16) "
+                "FROM info_entries_fts JOIN info_entries e ON e.id = info_entries_fts.rowid "
+                "WHERE info_entries_fts MATCH ? AND e.user_id = ? "
+                "ORDER BY bm25(info_entries_fts) LIMIT ?",
+                (match, user_id, limit)
+            ).fetchall()
+
+    def is_empty(self):
+        with self._db_lock:
+            return self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None
+
+    def _row_to_dict(self, user_id, mode, data):
+        user = json.loads(data) if data else {}
+        user['user_id'] = user_id
+        user['mode'] = mode
+        user['info_message'] = []
+        return user
+
+    @staticmethod
+    def _entry_from_row(user_text, forwarded_text, link, extra):
+        entry = json.loads(extra) if extra else {}
+        entry.update({'user_text': user_text, 'forwarded_text': forwarded_text, 'link': link})
+        return entry
+
+    def load_user(self, user_id):
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT user_id, mode, data FROM users WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            user = self._row_to_dict(*row)
+            rows = self._conn.execute(
+                "SELECT user_text, forwarded_text, link, extra FROM info_entries "
+                "WHERE user_id = ? ORDER BY position", (user_id,)
+            ).fetchall()
+        user['info_message'] = [self._entry_from_row(*r) for r in rows]
+        self._persisted[user_id] = (len(user['info_message']), user['mode'], row[2])
+        return user
+
+    # При следующей записи состояние пользователя будет прочитано из базы
+    def forget(self, user_id):
+        with self._db_lock:
+            self._persisted.pop(user_id, None)
+
+    def load_all(self):
+        users = {}
+        with self._db_lock:
+            for row in self._conn.execute("SELECT user_id, mode, data FROM users"):
+                users[row[0]] = self._row_to_dict(*row)
+                self._persisted[row[0]] = (0, row[1], row[2])
+            for user_id, user_text, forwarded_text, link, extra in self._conn.execute(
+                "SELECT user_id, user_text, forwarded_text, link, extra FROM info_entries "
+                "ORDER BY user_id, position"
+            ):
+                if user_id in users:
+                    users[user_id]['info_message'].append(
+                        self._entry_from_row(user_text, forwarded_text, link, extra)
+                    )
+        for user_id, user in users.items():
+            _, mode, data = self._persisted[user_id]
+            self._persisted[user_id] = (len(user['info_message']), mode, data)
+        return users
+
+    def _persisted_state(self, user_id):
+        if user_id not in self._persisted:
+            row = self._conn.execute(
+                "SELECT u.mode, u.data, (SELECT COUNT(*) FROM info_entries e WHERE e.user_id = u.user_id) "
+                "FROM users u WHERE u.user_id = ?", (user_id,)
+            ).fetchone()
+            self._persisted[user_id] = (row[2], row[0], row[1]) if row else (0, None, None)
+        return self._persisted[user_id]
+
+    def _write(self, records, rewrite, edited):
+        with self._db_lock, self._conn:
+            for user_id, user in records.items():
+                entries = user['info_message']
+                extra_user = {k: v for k, v in user.items() if k not in USER_FIELDS}
+                data = json.dumps(extra_user, ensure_ascii=False) if extra_user else None
+                count, mode, old_data = self._persisted_state(user_id)
+
+                if mode != user['mode'] or old_data != data or mode is None:
+                    self._conn.execute(
+                        "INSERT INTO users (user_id, mode, data) VALUES (?, ?, ?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET mode = excluded.mode, data = excluded.data",
+                        (user_id, user['mode'], data)
+                    )
+
+                # Список был перезаписан или укорочен - переписываем записи пользователя
+                if user_id in rewrite or len(entries) < count:
+                    self._conn.execute("DELETE FROM info_entries WHERE user_id = ?", (user_id,))
+                    count = 0
+
+                # Изменённые на месте записи (повторно пересланный пост) обновляются по позиции
+                positions = sorted(position for position in edited.get(user_id, ()) if position < count)
+                if positions:
+                    self._conn.executemany(
+                        "UPDATE info_entries SET user_text = ?, forwarded_text = ?, link = ?, extra = ? "
+                        "WHERE user_id = ? AND position = ?",
+                        [row[2:] + row[:2] for row in
+                         (self._entry_row(user_id, position, entries[position]) for position in positions)]
+                    )
+
+                self._conn.executemany(
+                    "INSERT INTO info_entries (user_id, position, user_text, forwarded_text, link, extra) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [self._entry_row(user_id, position, entry)
+                     for position, entry in enumerate(entries[count:], start=count)]
+                )
+                self._persisted[user_id] = (len(entries), user['mode'], data)
+
+    @staticmethod
+    def _entry_row(user_id, position, entry):
+        if not isinstance(entry, dict):
+            entry = dict(zip(ENTRY_FIELDS, entry)) if isinstance(entry, (list, tuple)) else {}
+        extra = {k: v for k, v in entry.items() if k not in ENTRY_FIELDS}
+        return (
+            user_id, position,
+            entry.get('user_text'), entry.get('forwarded_text'), entry.get('link'),
+            json.dumps(extra, ensure_ascii=False) if extra else None
+        )
+
+    def close(self):
+        super().close()
+        with self._db_lock:
+            self._conn.close()
+
+
+class JsonUserStore(UserStore):
+    """
+    Прежний формат хранения: блок user_data в config.json. Запись также
+    идёт пачками и атомарно (через временный файл), но файл переписывается
+    целиком, поэтому для большого числа пользователей лучше SQLite.
+    """
+
+    def __init__(self, config, save_config, flush_interval=2.0, flush_every=50):
+        super().__init__(flush_interval, flush_every)
+        self.config = config
+        self.save_config = save_config
+        self.config.setdefault("user_data", {})
+
+    def is_empty(self):
+        return not self.config["user_data"]
+
+    def load_user(self, user_id):
+        return self.config["user_data"].get(str(user_id))
+
+    def load_all(self):
+        users = {}
+        for user_id_str, user_info in self.config["user_data"].items():
+            try:
+                users[int(user_id_str)] = user_info
+            except ValueError:
+                logger.error("Неверный user_id: %s", user_id_str)
+        return users
+
+    def _write(self, records, rewrite, edited):
+        for user_id, user in records.items():
+            self.config["user_data"][str(user_id)] = user
+        self.save_config(self.config)
+
+
+# Одноразовый перенос блока user_data из config.json в новое хранилище.
+# После переноса блок удаляется из config.json (save_config подменяет файл
+# целиком), чтобы при запуске не разбирать всех пользователей заново
+def migrate_from_config(config, store, save_config=None):
+    if isinstance(store, JsonUserStore):
+        return 0
+    migrated = 0
+    if not store.get_meta("migrated_from_config"):
+        user_data = config.get("user_data", {})
+        if user_data and store.is_empty():
+            records = {}
+            for user_id_str, user_info in user_data.items():
+                try:
+                    user_id = int(user_id_str)
+                except ValueError:
+                    logger.error("Неверный user_id: %s", user_id_str)
+                    continue
+                user_info = dict(user_info, user_id=user_id)
+                user_info.setdefault('mode', 'main')
+                user_info['info_message'] = list(user_info.get('info_message', []))
+                records[user_id] = user_info
+            store._write(records, set(records), {})
+            migrated = len(records)
+            logger.info("Перенесены данные пользователей из config.json: %s", migrated)
+        store.set_meta("migrated_from_config", True)
+    # Перенос уже записан в хранилище, блок в config.json больше не нужен
+    if "user_data" in config and save_config is not None:
+        user_data = config.pop("user_data")
+        try:
+            save_config(config)
+        except OSError as e:
+            config["user_data"] = user_data
+            logger.error("Не удалось удалить блок user_data из config.json: %s", e)
+        else:
+            logger.info("Блок user_data удалён из config.json", extra={"event": "config_user_data_removed"})
+    return migrated
+
+
+# Создание хранилища по секции "storage" из config.json
+def create_user_store(config, base_dir, save_config):
+    settings = config.get("storage", {})
+    backend = settings.get("backend", "sqlite")
+    flush_interval = settings.get("flush_interval", 2.0)
+    flush_every = settings.get("flush_every", 50)
+
+    if backend == "json":
+        store = JsonUserStore(config, save_config, flush_interval, flush_every)
+    elif backend == "sqlite":
+        path = settings.get("path", "users.db")
+        if not os.path.isabs(path):
+            path = os.path.join(base_dir, path)
+        store = SQLiteUserStore(path, flush_interval, flush_every)
+        migrate_from_config(config, store, save_config)
+    else:
+        raise ValueError(f"Неизвестный тип хранилища: {backend}")
+
+    logger.info("Используется хранилище пользователей: %s", backend)
+    return store
@@ -0,0 +1,155 @@
+import time
+import asyncio
+import logging
+from telebot.apihelper import ApiTelegramException
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+# Разбиение длинного текста на части не длиннее лимита Telegram.
+# По возможности режем по переносу строки, чтобы не разрывать абзацы.
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    parts.append(text)
+    return parts
+
+
+# Пауза из ответа Telegram 429 (для исключений синхронного и асинхронного telebot)
+def get_retry_after(error, default=1):
+    if getattr(error, 'error_code', None) != 429:
+        return None
+    return (getattr(error, 'result_json', None) or {}).get('parameters', {}).get('retry_after', default)
+
+
+class StreamingReply:
+    """
+    Постепенный вывод ответа в чат.
+
+    Сразу отправляет сообщение-заглушку и по мере прихода токенов меняет его
+    через edit_message_text, но не чаще раза в edit_interval секунд, чтобы не
+    упираться в ограничения Telegram на редактирование. Текст длиннее 4096
+    символов продолжается в новых сообщениях.
+    """
+
+    def __init__(self, bot, chat_id, reply_markup=None, edit_interval=1.5, placeholder="…"):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_markup = reply_markup
+        self.edit_interval = edit_interval
+        self.placeholder = placeholder
+        self.message_id = None
+        self.text = ""
+        self._done = ""
+        self._shown = ""
+        self._next_edit = 0
+
+    def run(self, chunks):
+        message = self.bot.send_message(self.chat_id, self.placeholder, reply_markup=self.reply_markup)
+        self.message_id = message.message_id
+        try:
+            for chunk in chunks:
+                self.text += chunk
+                self._roll_over()
+                if time.monotonic() >= self._next_edit:
+                    self._edit(self._current())
+        finally:
+            # Показываем всё, что успели получить, даже если поток оборвался
+            self._edit(self._current() or "Пустой ответ.", force=True)
+        return self.text
+
+    def _current(self):
+        return self.text[len(self._done):]
+
+    # Переход к новому сообщению, когда текущее упёрлось в лимит длины
+    def _roll_over(self):
+        while len(self._current()) > TELEGRAM_MESSAGE_LIMIT:
+            current = self._current()
+            head = split_message(current)[0]
+            self._edit(head, force=True)
+            # Переносы строк на стыке сообщений не переносим в следующее
+            rest = current[len(head):]
+            consumed = len(current) - len(rest.lstrip('\n'))
+            self._done = self.text[:len(self._done) + consumed]
+            message = self.bot.send_message(self.chat_id, self.placeholder)
+            self.message_id = message.message_id
+            self._shown = ""
+
+    def _edit(self, text, force=False):
+        if not text or text == self._shown:
+            return
+        if not force and time.monotonic() < self._next_edit:
+            return
+        try:
+            self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+            self._shown = text
+        except ApiTelegramException as e:
+            retry_after = get_retry_after(e, self.edit_interval)
+            if retry_after is not None:
+                self._next_edit = time.monotonic() + retry_after
+                logger.warning("Telegram ограничил редактирование в чате %s, пауза %s с", self.chat_id, retry_after)
+                if force:
+                    time.sleep(retry_after)
+                    self._edit(text, force=True)
+                return
+            if 'message is not modified' not in e.description:
+                raise
+        self._next_edit = time.monotonic() + self.edit_interval
+
+
+class AsyncStreamingReply(StreamingReply):
+    """StreamingReply для AsyncTeleBot и асинхронного потока кусочков ответа."""
+
+    async def run(self, chunks):
+        message = await self.bot.send_message(self.chat_id, self.placeholder, reply_markup=self.reply_markup)
+        self.message_id = message.message_id
+        try:
+            async for chunk in chunks:
+                self.text += chunk
+                await self._roll_over()
+                if time.monotonic() >= self._next_edit:
+                    await self._edit(self._current())
+        finally:
+            await self._edit(self._current() or "Пустой ответ.", force=True)
+        return self.text
+
+    async def _roll_over(self):
+        while len(self._current()) > TELEGRAM_MESSAGE_LIMIT:
+            current = self._current()
+            head = split_message(current)[0]
+            await self._edit(head, force=True)
+            rest = current[len(head):]
+            consumed = len(current) - len(rest.lstrip('\n'))
+            self._done = self.text[:len(self._done) + consumed]
+            message = await self.bot.send_message(self.chat_id, self.placeholder)
+            self.message_id = message.message_id
+            self._shown = ""
+
+    async def _edit(self, text, force=False):
+        if not text or text == self._shown:
+            return
+        if not force and time.monotonic() < self._next_edit:
+            return
+        try:
+            await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+            self._shown = text
+        except Exception as e:
+            retry_after = get_retry_after(e, self.edit_interval)
+            if retry_after is not None:
+                self._next_edit = time.monotonic() + retry_after
+                logger.warning("Telegram ограничил редактирование в чате %s, пауза %s с", self.chat_id, retry_after)
+                if force:
+                    await asyncio.sleep(retry_after)
+                    await self._edit(text, force=True)
+                return
+            if 'message is not modified' not in str(e):
+                raise
+        self._next_edit = time.monotonic() + self.edit_interval
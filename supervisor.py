@@ -0,0 +1,266 @@
+import os
+import time
+import queue
+import signal
+import secrets
+import logging
+import threading
+import multiprocessing
+import telebot
+from telebot import apihelper, types
+from storage import create_user_store
+from webhook import WebhookServer
+from dispatcher import raw_update_user_id
+from bot_logging import setup_logging
+from bot_core import SCRIPT_DIR, load_config, save_config, check_config, get_proxy, evict_user
+
+logger = logging.getLogger(__name__)
+
+# Запуск бота в нескольких процессах: этот процесс принимает обновления
+# (long polling или webhook) и раздаёт их процессам-обработчикам, в каждом
+# из которых работает тот же бот, что и в main.py. Обновления делятся по
+# user_id, поэтому каждый пользователь обрабатывается только одним процессом.
+#
+#   python supervisor.py    - запуск (секция "workers" в config.json)
+#   kill -HUP <pid>         - поочерёдный перезапуск обработчиков
+#   kill -TERM <pid>        - остановка
+
+# Команды обработчику в его очереди обновлений
+STOP = None
+RESTART = "restart"
+
+
+# Процесс-обработчик: обновления приходят из очереди, а не из Telegram.
+# states - состояние пользователей, переданное прежним процессом этой доли
+def run_worker(shard, processes, updates, handoff, states):
+    # Ctrl+C в терминале получает вся группа процессов: обработчик завершается
+    # только по команде из очереди, чтобы сохранить незавершённые записи
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.environ["NELEGAL_WORKER_PROCESSES"] = str(processes)
+    import main
+
+    for state in states:
+        user = main.user_data.get(state['user_id'])
+        if user is None:
+            user = main.user_data[state['user_id']] = main.User(state['user_id'])
+        user.restore_handoff(state)
+    if states:
+        logger.info("Обработчик %d принял состояние пользователей: %d", shard, len(states), extra={"event": "worker_handoff"})
+
+    while True:
+        update = updates.get()
+        if update is STOP or update == RESTART:
+            break
+        main.bot.process_new_updates([types.Update.de_json(update)])
+
+    # Дожидаемся обработки уже принятых обновлений
+    main.dispatcher.shutdown()
+    users = main.user_data.values()
+    if update == RESTART:
+        handoff.put([state for state in (user.handoff_state() for user in users) if state is not None])
+    else:
+        # Незавершённые записи режима 'info' сохраняются, как при вытеснении из памяти
+        for user in users:
+            evict_user(main.user_store, user)
+    # Отправка ответов и запись в хранилище завершаются обработчиками atexit в main.py
+
+
+class Supervisor:
+    """
+    Процессы-обработчики и раздача им обновлений по user_id % processes.
+
+    У каждого обработчика своя очередь (не больше max_pending обновлений,
+    дальше приём ждёт). При перезапуске (restart) обработчик дорабатывает
+    уже полученные обновления, передаёт новому процессу незавершённые записи
+    'info' и историю 'Ask GPT' своих пользователей и завершается; новые
+    обновления тем временем ждут в той же очереди. Неожиданно завершившийся
+    обработчик запускается заново без передачи состояния.
+    """
+
+    def __init__(self, processes, max_pending=1000, handoff_timeout=60):
+        self.processes = processes
+        self.max_pending = max_pending
+        self.handoff_timeout = handoff_timeout
+        # spawn, а не fork: у обработчика не должно быть копий потоков и соединений этого процесса
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue(max_pending) for _ in range(processes)]
+        # Передача состояния - через отдельную очередь каждой доли, чтобы опоздавшее
+        # состояние одного обработчика не досталось другому
+        self._handoffs = [self._context.Queue() for _ in range(processes)]
+        self._workers = [None] * processes
+        self._lock = threading.Lock()
+        self._restart = threading.Event()
+        self._stopping = False
+
+    def _start_worker(self, shard, states=()):
+        process = self._context.Process(
+            target=run_worker,
+            args=(shard, self.processes, self._queues[shard], self._handoffs[shard], list(states)),
+            name=f"worker-{shard}"
+        )
+        process.start()
+        self._workers[shard] = process
+        logger.info("Запущен обработчик %d (pid %s)", shard, process.pid, extra={"event": "worker_started"})
+
+    def start(self):
+        for shard in range(self.processes):
+            self._start_worker(shard)
+        threading.Thread(target=self._monitor, name="supervisor-monitor", daemon=True).start()
+
+    # Передача обновления (словарь в формате Bot API) обработчику его пользователя
+    def route(self, update):
+        self._queues[raw_update_user_id(update) % self.processes].put(update)
+
+    # Перезапуск из обработчика сигнала выполняется в потоке наблюдения
+    def request_restart(self):
+        self._restart.set()
+
+    # Поочерёдный перезапуск обработчиков (например, после обновления кода)
+    def restart(self):
+        with self._lock:
+            for shard in range(self.processes):
+                if self._stopping:
+                    return
+                self._queues[shard].put(RESTART)
+                states = self._receive_handoff(shard)
+                self._workers[shard].join()
+                self._start_worker(shard, states)
+                logger.info("Обработчик %d перезапущен, передано пользователей: %d", shard, len(states),
+                            extra={"event": "worker_restarted"})
+
+    def _receive_handoff(self, shard):
+        process = self._workers[shard]
+        deadline = time.monotonic() + self.handoff_timeout
+        while time.monotonic() < deadline:
+            alive = process.is_alive()
+            try:
+                return self._handoffs[shard].get(timeout=1)
+            except queue.Empty:
+                if not alive:
+                    break
+        logger.error("Обработчик %d не передал состояние пользователей, незавершённые записи потеряны", shard)
+        if process.is_alive():
+            process.terminate()
+        # Состояние, которое придёт с опозданием, не должно попасть к следующему процессу
+        self._handoffs[shard] = self._context.Queue()
+        return []
+
+    def _monitor(self):
+        while True:
+            if self._restart.wait(1):
+                self._restart.clear()
+                self.restart()
+            with self._lock:
+                if self._stopping:
+                    return
+                for shard, process in enumerate(self._workers):
+                    if process.is_alive():
+                        continue
+                    logger.error("Обработчик %d завершился с кодом %s, запускаем заново", shard, process.exitcode,
+                                 extra={"event": "worker_died"})
+                    # Процесс мог завершиться, удерживая блокировку очереди, поэтому очередь заменяется;
+                    # ещё не прочитанные им обновления теряются
+                    self._queues[shard] = self._context.Queue(self.max_pending)
+                    self._start_worker(shard)
+
+    # Остановка: обработчики дорабатывают полученные обновления и сохраняют данные
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            for updates in self._queues:
+                updates.put(STOP)
+            for process in self._workers:
+                process.join()
+        logger.info("Обработчики остановлены", extra={"event": "supervisor_stopped"})
+
+
+# Приём обновлений через long polling, пока не установлен stopped
+def poll_updates(token, supervisor, stopped, timeout=20):
+    offset = None
+    while not stopped.is_set():
+        try:
+            updates = apihelper.get_updates(token, offset=offset, timeout=timeout, long_polling_timeout=timeout + 5)
+        except Exception as e:
+            logger.error("Не удалось получить обновления: %s", e)
+            stopped.wait(3)
+            continue
+        for update in updates:
+            supervisor.route(update)
+            offset = update['update_id'] + 1
+    # Подтверждаем уже розданные обновления, чтобы Telegram не прислал их снова
+    if offset is not None:
+        try:
+            apihelper.get_updates(token, offset=offset, limit=1)
+        except Exception as e:
+            logger.warning("Не удалось подтвердить полученные обновления: %s", e)
+
+
+# Приём обновлений через webhook (как run_webhook в main.py), пока не установлен stopped
+def run_webhook(config, supervisor, stopped):
+    bot = telebot.TeleBot(config["TELEGRAM_BOT_TOKEN"], threaded=False)
+    settings = config.get("webhook", {})
+    path = settings.get("path", "/telegram")
+    secret_token = settings.get("secret_token") or secrets.token_urlsafe(32)
+    server = WebhookServer(
+        supervisor.route,
+        host=settings.get("listen", "127.0.0.1"),
+        port=settings.get("port", 8443),
+        path=path,
+        secret_token=secret_token,
+        max_pending=settings.get("max_pending", 1000)
+    )
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=settings["url"].rstrip("/") + path,
+        secret_token=secret_token,
+        max_connections=settings.get("max_connections", 40)
+    )
+    server.start()
+    stopped.wait()
+    server.stop()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    config = load_config()
+    check_config(config)
+    setup_logging(config)
+
+    # config.json переписывается целиком, поэтому хранилище json с несколькими процессами несовместимо
+    if config.get("storage", {}).get("backend", "sqlite") != "sqlite":
+        logger.error("Для запуска в нескольких процессах нужно хранилище sqlite (секция \"storage\")")
+        raise SystemExit(1)
+    # Таблицы, полнотекстовый индекс и перенос данных из config.json - один раз, до запуска обработчиков
+    create_user_store(config, SCRIPT_DIR, save_config).close()
+
+    proxy = get_proxy(config)
+    if proxy:
+        os.environ['HTTP_PROXY'] = proxy
+        os.environ['HTTPS_PROXY'] = proxy
+    if "TELEGRAM_API_URL" in config:
+        apihelper.API_URL = config["TELEGRAM_API_URL"]
+
+    settings = config.get("workers", {})
+    supervisor = Supervisor(
+        settings.get("processes", os.cpu_count() or 1),
+        max_pending=settings.get("max_pending", 1000),
+        handoff_timeout=settings.get("handoff_timeout", 60)
+    )
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopped.set())
+    signal.signal(signal.SIGHUP, lambda signum, frame: supervisor.request_restart())
+
+    supervisor.start()
+    logger.info("Запущено обработчиков: %d", supervisor.processes, extra={"event": "supervisor_started"})
+    try:
+        if config.get("ingestion", "polling") == "webhook":
+            run_webhook(config, supervisor, stopped)
+        else:
+            poll_updates(config["TELEGRAM_BOT_TOKEN"], supervisor, stopped)
+    finally:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    main()
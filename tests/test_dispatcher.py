@@ -0,0 +1,97 @@
+import time
+import random
+import asyncio
+import threading
+import unittest
+from dispatcher import KeyedDispatcher, AsyncKeyedDispatcher
+
+
+class KeyedDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = KeyedDispatcher(max_workers=4, max_queue=100)
+        self.addCleanup(self.dispatcher.shutdown)
+
+    def test_tasks_of_one_key_run_in_order(self):
+        done = {1: [], 2: [], 3: []}
+
+        def handle(key, number):
+            # Разная длительность, чтобы перестановка стала заметна
+            time.sleep(random.random() / 100)
+            done[key].append(number)
+
+        for number in range(20):
+            for key in done:
+                self.dispatcher.submit(key, handle, key, number)
+        self.dispatcher.shutdown()
+        self.assertEqual(done, {key: list(range(20)) for key in done})
+
+    def test_different_keys_run_in_parallel(self):
+        # Обе задачи ждут друг друга: при последовательном выполнении барьер не пройти
+        barrier = threading.Barrier(2, timeout=2)
+        passed = []
+
+        def handle(key):
+            barrier.wait()
+            passed.append(key)
+
+        self.dispatcher.submit(1, handle, 1)
+        self.dispatcher.submit(2, handle, 2)
+        self.dispatcher.shutdown()
+        self.assertEqual(sorted(passed), [1, 2])
+
+    def test_error_does_not_stop_key_queue(self):
+        done = []
+
+        def fail():
+            raise ValueError("boom")
+
+        self.dispatcher.submit(1, fail)
+        self.dispatcher.submit(1, done.append, "next")
+        self.dispatcher.shutdown()
+        self.assertEqual(done, ["next"])
+        self.assertEqual(self.dispatcher.queue_depth, 0)
+
+
+class AsyncKeyedDispatcherTest(unittest.TestCase):
+
+    def test_tasks_of_one_key_run_in_order(self):
+        done = {1: [], 2: []}
+
+        async def handle(key, number):
+            await asyncio.sleep(random.random() / 100)
+            done[key].append(number)
+
+        async def run():
+            dispatcher = AsyncKeyedDispatcher(max_in_flight=10, max_queue=100)
+            for number in range(20):
+                for key in done:
+                    await dispatcher.submit(key, handle, key, number)
+            await dispatcher.shutdown()
+
+        asyncio.run(run())
+        self.assertEqual(done, {key: list(range(20)) for key in done})
+
+    def test_error_does_not_stop_key_queue(self):
+        done = []
+
+        async def fail():
+            raise ValueError("boom")
+
+        async def append(value):
+            done.append(value)
+
+        async def run():
+            dispatcher = AsyncKeyedDispatcher()
+            await dispatcher.submit(1, fail)
+            await dispatcher.submit(1, append, "next")
+            await dispatcher.shutdown()
+            return dispatcher
+
+        dispatcher = asyncio.run(run())
+        self.assertEqual(done, ["next"])
+        self.assertEqual(dispatcher.in_flight, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
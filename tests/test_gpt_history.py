@@ -0,0 +1,65 @@
+import unittest
+from gpt_history import ConversationWindow, SUMMARY_PREFIX
+from tokens import count_tokens
+
+
+class ConversationWindowTest(unittest.TestCase):
+
+    def window(self, turns, token_budget=100, keep_recent=2):
+        history = ConversationWindow(token_budget=token_budget, keep_recent=keep_recent)
+        for i in range(turns):
+            history.add("user" if i % 2 == 0 else "assistant", "реплика номер %d с несколькими словами" % i)
+        return history
+
+    def test_nothing_is_folded_within_budget(self):
+        history = self.window(4, token_budget=10000)
+        self.assertEqual(history.take_overflow(), [])
+        self.assertEqual(len(history), 4)
+
+    def test_overflow_folds_oldest_turns_to_half_budget(self):
+        history = self.window(20)
+        self.assertGreater(history.total_tokens, 100)
+
+        folded = history.take_overflow()
+        self.assertEqual(folded[0]['content'], "реплика номер 0 с несколькими словами")
+        self.assertEqual(len(folded) + len(history), 20)
+        self.assertLessEqual(history.total_tokens, 50)
+        # Последняя реплика остаётся в истории
+        self.assertEqual(history.messages()[-1]['content'], "реплика номер 19 с несколькими словами")
+
+    def test_recent_turns_are_kept(self):
+        history = self.window(4, token_budget=1, keep_recent=3)
+        self.assertEqual(len(history.take_overflow()), 1)
+        self.assertEqual(len(history), 3)
+
+    def test_summary_is_counted_and_sent_first(self):
+        history = self.window(20)
+        folded = history.take_overflow()
+        tokens = history.total_tokens
+        history.apply_summary("кратко о начале разговора", len(folded))
+
+        self.assertEqual(history.total_tokens, tokens + count_tokens("кратко о начале разговора"))
+        messages = history.messages("новый вопрос")
+        self.assertEqual(messages[0], {"role": "system", "content": SUMMARY_PREFIX + "кратко о начале разговора"})
+        self.assertEqual(messages[-1], {"role": "user", "content": "новый вопрос"})
+
+    def test_failed_summary_keeps_previous_one(self):
+        history = self.window(20)
+        history.apply_summary("старое содержание", len(history.take_overflow()))
+        for i in range(20):
+            history.add("user", "ещё одна реплика номер %d" % i)
+        history.apply_summary(None, len(history.take_overflow()))
+        self.assertEqual(history.summary, "старое содержание")
+
+    def test_export_and_restore(self):
+        history = self.window(20)
+        history.apply_summary("содержание", len(history.take_overflow()))
+
+        restored = ConversationWindow(token_budget=100, keep_recent=2)
+        restored.restore(history.export())
+        self.assertEqual(restored.messages(), history.messages())
+        self.assertEqual(restored.total_tokens, history.total_tokens)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from telebot import types
+from bot_core import User, save_info_text, flush_current_info
+from ingest import render_text, message_text, content_hash, DedupIndex, merge_entry
+
+POST = "Смотри 👍 тут подробнее про новый релиз библиотеки"
+# Смещения entities - в UTF-16 code units: эмодзи занимает две
+LINK_OFFSET = len("Смотри 👍 тут ".encode('utf-16-le')) // 2
+
+next_message_id = [0]
+
+
+def message(text, forward_id=None, entities=None):
+    next_message_id[0] += 1
+    data = {
+        'message_id': next_message_id[0], 'date': 0, 'text': text,
+        'chat': {'id': 5, 'type': 'private'},
+        'from': {'id': 5, 'is_bot': False, 'first_name': 'T'}
+    }
+    if entities:
+        data['entities'] = entities
+    if forward_id:
+        data['forward_origin'] = {
+            'type': 'channel', 'date': 0, 'message_id': forward_id,
+            'chat': {'id': -1001234, 'type': 'channel', 'title': 'c'}
+        }
+    return types.Message.de_json(data)
+
+
+def link_entity():
+    return {'type': 'text_link', 'offset': LINK_OFFSET, 'length': len("подробнее"), 'url': 'https://ex.com/a'}
+
+
+class RenderTextTest(unittest.TestCase):
+
+    def test_text_link_after_emoji_is_expanded(self):
+        text = render_text(*message_text(message(POST, entities=[link_entity()])))
+        self.assertEqual(text, "Смотри 👍 тут подробнее (https://ex.com/a) про новый релиз библиотеки")
+
+    def test_visible_url_is_not_repeated(self):
+        entity = {'type': 'text_link', 'offset': 0, 'length': len("https://ex.com/a"), 'url': 'https://ex.com/a'}
+        self.assertEqual(render_text(*message_text(message("https://ex.com/a", entities=[entity]))), "https://ex.com/a")
+
+
+class DedupTest(unittest.TestCase):
+
+    def test_hash_ignores_case_and_spaces_but_not_short_texts(self):
+        self.assertEqual(content_hash(POST), content_hash("  " + POST.upper().replace(" ", "   ")))
+        self.assertIsNone(content_hash("👍"))
+
+    def test_index_finds_post_by_source_or_text(self):
+        entries = [{'user_text': 'заметка', 'forwarded_text': 'Неизвестно', 'link': 'Неизвестно'}]
+        index = DedupIndex(entries)
+        entries.append({'user_text': 'Неизвестно', 'forwarded_text': POST, 'link': 'Неизвестно', 'source': [-1001234, 77]})
+        index.update()
+
+        self.assertEqual(index.find({'forwarded_text': 'другой текст', 'source': [-1001234, 77]}), 1)
+        self.assertEqual(index.find({'forwarded_text': POST.lower(), 'source': [-1001234, 99]}), 1)
+        self.assertIsNone(index.find({'forwarded_text': 'другой текст', 'source': [-1001234, 99]}))
+
+    def test_merge_appends_new_comment_once(self):
+        entry = {'user_text': 'первый', 'forwarded_text': POST, 'link': 'Неизвестно'}
+        self.assertTrue(merge_entry(entry, {'user_text': 'второй', 'link': 'https://t.me/c/1234/77'}))
+        self.assertFalse(merge_entry(entry, {'user_text': 'второй', 'link': 'https://t.me/c/1234/77'}))
+        self.assertEqual(entry['user_text'], "первый\nвторой")
+        self.assertEqual(entry['link'], "https://t.me/c/1234/77")
+
+    # Повторная пересылка поста в режиме 'info' не создаёт новую запись
+    def test_repeated_forward_is_merged_into_saved_entry(self):
+        user = User(5)
+        for text, forward_id in [(POST, 77), ("первый", None)]:
+            save_info_text(user, message(text, forward_id, [link_entity()] if forward_id else None))
+        self.assertTrue(flush_current_info(user))
+        save_info_text(user, message("заметка"))
+        flush_current_info(user)
+
+        for text, forward_id in [(POST, 77), ("второй", None)]:
+            save_info_text(user, message(text, forward_id))
+        self.assertTrue(flush_current_info(user))
+
+        self.assertEqual(len(user.info_message), 2)
+        self.assertEqual(user.info_message[0]['user_text'], "первый\nвторой")
+        self.assertEqual(user.info_message[0]['source'], [-1001234, 77])
+        # Изменённая на месте запись будет переписана в хранилище по позиции
+        self.assertEqual(user.take_edited(), {0})
+
+
+if __name__ == "__main__":
+    unittest.main()
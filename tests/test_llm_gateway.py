@@ -0,0 +1,113 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from llm_gateway import AsyncLLMGateway, CircuitBreaker, CircuitOpenError, LLMError
+
+
+def completion(text):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=None)
+
+
+class FakeCompletions:
+    """Двойник client.chat.completions: зависает, пока hang=True, бросает error, иначе отвечает."""
+
+    def __init__(self):
+        self.hang = False
+        self.error = None
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        if self.hang:
+            await asyncio.Event().wait()
+        if self.error is not None:
+            raise self.error
+        return completion("ok")
+
+
+class CircuitBreakerProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.completions = FakeCompletions()
+        client = SimpleNamespace(chat=SimpleNamespace(completions=self.completions))
+        self.breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        self.gateway = AsyncLLMGateway(client, max_retries=0, breaker=self.breaker)
+
+    def test_cancelled_probe_is_released(self):
+        async def scenario():
+            self.breaker.record_failure()
+            self.assertEqual(self.breaker.state, 'half-open')
+
+            # Пробный запрос отменяется, не дождавшись ответа
+            self.completions.hang = True
+            probe = asyncio.create_task(self.gateway.complete([{"role": "user", "content": "?"}]))
+            await asyncio.sleep(0.01)
+            self.assertEqual(self.completions.calls, 1)
+            probe.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await probe
+
+            # Следующий запрос к работающему OpenAI проходит и закрывает предохранитель
+            self.completions.hang = False
+            answer = await self.gateway.complete([{"role": "user", "content": "?"}])
+            self.assertEqual(answer, "ok")
+            self.assertEqual(self.breaker.state, 'closed')
+            self.assertEqual(self.gateway.in_flight, 0)
+
+        asyncio.run(scenario())
+
+    def test_open_breaker_rejects_without_request(self):
+        async def scenario():
+            self.breaker.reset_timeout = 60
+            self.breaker.record_failure()
+            with self.assertRaises(CircuitOpenError):
+                await self.gateway.complete([{"role": "user", "content": "?"}])
+            self.assertEqual(self.completions.calls, 0)
+
+        asyncio.run(scenario())
+
+    def test_cancelled_request_keeps_foreign_probe(self):
+        async def scenario():
+            self.completions.hang = True
+            # Обычный запрос отправлен, пока предохранитель ещё закрыт
+            request = asyncio.create_task(self.gateway.complete([{"role": "user", "content": "?"}]))
+            await asyncio.sleep(0.01)
+            self.breaker.record_failure()
+            probe = asyncio.create_task(self.gateway.complete([{"role": "user", "content": "?"}]))
+            await asyncio.sleep(0.01)
+            self.assertEqual(self.completions.calls, 2)
+
+            # Отмена обычного запроса не освобождает чужой пробный запрос
+            request.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await request
+            with self.assertRaises(CircuitOpenError):
+                await asyncio.wait_for(self.gateway.complete([{"role": "user", "content": "?"}]), 1)
+            self.assertEqual(self.completions.calls, 2)
+
+            probe.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await probe
+
+        asyncio.run(scenario())
+
+    def test_local_error_does_not_close_breaker(self):
+        async def scenario():
+            self.breaker.record_failure()
+            # Ошибка до ответа OpenAI ничего не говорит о его состоянии
+            self.completions.error = ValueError("bad request arguments")
+            with self.assertRaises(LLMError):
+                await self.gateway.complete([{"role": "user", "content": "?"}])
+            self.assertEqual(self.breaker.state, 'half-open')
+            self.assertEqual(self.breaker.failures, 1)
+
+            # Пробный запрос освобождён: следующий запрос отправляется
+            self.completions.error = None
+            self.assertEqual(await self.gateway.complete([{"role": "user", "content": "?"}]), "ok")
+            self.assertEqual(self.breaker.state, 'closed')
+
+        asyncio.run(scenario())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from storage import SQLiteUserStore
+from search import search_entries, format_search_results
+
+
+def entry(user_text, forwarded_text='Неизвестно', link='Неизвестно'):
+    return {'user_text': user_text, 'forwarded_text': forwarded_text, 'link': link}
+
+
+class FakeUser(SimpleNamespace):
+
+    def to_dict(self):
+        return {'user_id': self.user_id, 'mode': 'info', 'info_message': self.info_message}
+
+
+class FullTextSearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, "users.db")
+        self.store = self.open_store()
+        self.user = FakeUser(user_id=5, info_message=[
+            entry("купить молоко и хлеб"),
+            entry("Неизвестно", "Вышел новый релиз Python", "https://t.me/c/1234/77"),
+            entry("позвонить маме"),
+            entry("молоко, молоко и ещё раз молоко"),
+        ])
+        self.save(self.user)
+
+    def open_store(self):
+        store = SQLiteUserStore(self.path, flush_interval=0)
+        self.addCleanup(store.close)
+        return store
+
+    def save(self, user, rewrite=False):
+        self.store.mark_dirty(user, rewrite=rewrite)
+        self.store.flush()
+
+    def positions(self, query, user=None):
+        return [position for position, _ in search_entries(self.store, user or self.user, query)]
+
+    def test_index_is_available(self):
+        self.assertTrue(self.store.fts)
+
+    def test_words_match_as_prefixes_in_any_case(self):
+        self.assertEqual(sorted(self.positions("МОЛОК")), [0, 3])
+        self.assertEqual(self.positions("релиз pyth"), [1])
+        self.assertEqual(self.positions("молоко маме"), [])
+
+    def test_more_relevant_entry_comes_first(self):
+        self.assertEqual(self.positions("молоко"), [3, 0])
+
+    def test_fragment_highlights_match(self):
+        results = search_entries(self.store, self.user, "python")
+        self.assertIn("«Python»", results[0][1])
+        text = format_search_results(self.user.info_message, "python", results)
+        self.assertIn("https://t.me/c/1234/77", text)
+
+    def test_query_syntax_is_ignored(self):
+        self.assertEqual(self.positions('"(*'), [])
+        self.assertEqual(self.positions('молоко" (хлеб*'), [0])
+        # Операторы FTS5 ищутся как обычные слова
+        self.assertEqual(self.positions('молоко OR хлеб'), [])
+
+    def test_other_users_entries_are_not_found(self):
+        self.save(FakeUser(user_id=6, info_message=[entry("молоко соседа")]))
+        self.assertEqual(sorted(self.positions("молоко")), [0, 3])
+        self.assertEqual(self.positions("соседа"), [])
+
+    def test_index_follows_rewrite_and_edits(self):
+        self.user.info_message = self.user.info_message[:1]
+        self.save(self.user, rewrite=True)
+        self.assertEqual(self.positions("релиз"), [])
+
+        self.user.info_message[0]['user_text'] = "купить кефир"
+        self.user.take_edited = lambda: {0}
+        self.save(self.user)
+        self.assertEqual(self.positions("кефир"), [0])
+        self.assertEqual(self.positions("хлеб"), [])
+
+    def test_index_survives_reopen(self):
+        self.store.close()
+        self.store = self.open_store()
+        self.assertEqual(self.positions("маме"), [2])
+
+    def test_scan_without_index(self):
+        self.store.fts = False
+        self.assertEqual(self.positions("молоко"), [3, 0])
+        self.assertEqual(self.positions("релиз python"), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from bot_core import User
+from storage import SQLiteUserStore, create_user_store
+
+
+def entry(text):
+    return {'user_text': text, 'forwarded_text': None, 'link': None}
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.config_path = os.path.join(self.workdir, "config.json")
+
+    def save_config(self, config):
+        with open(self.config_path, "w", encoding="utf-8") as config_file:
+            json.dump(config, config_file)
+
+    def load_config(self):
+        with open(self.config_path, encoding="utf-8") as config_file:
+            return json.load(config_file)
+
+    def open_store(self):
+        store = create_user_store(self.load_config(), self.workdir, self.save_config)
+        self.addCleanup(store.close)
+        return store
+
+    def test_user_data_is_removed_from_config_after_migration(self):
+        self.save_config({
+            "TELEGRAM_BOT_TOKEN": "token",
+            "user_data": {"5": {"mode": "info", "info_message": [entry("a"), entry("b")]}}
+        })
+        store = self.open_store()
+        self.assertEqual(self.load_config(), {"TELEGRAM_BOT_TOKEN": "token"})
+        self.assertEqual([e['user_text'] for e in store.load_user(5)['info_message']], ["a", "b"])
+        store.close()
+
+        # Следующий запуск читает пользователя из хранилища
+        store = self.open_store()
+        self.assertEqual(store.load_user(5)['mode'], "info")
+
+
+class SQLiteUserStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, "users.db")
+        self.store = self.open_store()
+
+    def open_store(self, flush_every=50):
+        # Без фонового потока: запись только по flush() или после flush_every обновлений
+        store = SQLiteUserStore(self.path, flush_interval=0, flush_every=flush_every)
+        self.addCleanup(store.close)
+        return store
+
+    def user(self, *texts):
+        user = User(5)
+        user.mode = 'info'
+        user.info_message = [entry(text) for text in texts]
+        return user
+
+    # Строки info_entries пользователя: (id, позиция, текст)
+    def rows(self, user_id=5):
+        return self.store._conn.execute(
+            "SELECT id, position, user_text FROM info_entries WHERE user_id = ? ORDER BY position", (user_id,)
+        ).fetchall()
+
+    def test_mark_dirty_waits_for_flush(self):
+        user = self.user("a", "b")
+        self.store.mark_dirty(user)
+        self.assertIsNone(self.store.load_user(5))
+        self.assertIs(self.store.pending_user(5), user)
+
+        self.store.flush()
+        self.assertIsNone(self.store.pending_user(5))
+        self.assertEqual([e['user_text'] for e in self.store.load_user(5)['info_message']], ["a", "b"])
+
+    def test_flush_every_writes_batch(self):
+        store = self.open_store(flush_every=3)
+        user = self.user("a")
+        store.mark_dirty(user)
+        store.mark_dirty(user)
+        self.assertEqual(store.dirty_count, 1)
+        store.mark_dirty(user)
+        self.assertEqual(store.dirty_count, 0)
+        self.assertEqual(store.load_user(5)['mode'], 'info')
+
+    def test_flush_appends_only_new_entries(self):
+        user = self.user("a", "b")
+        self.store.mark_dirty(user)
+        self.store.flush()
+        before = self.rows()
+
+        user.info_message.append(entry("c"))
+        self.store.mark_dirty(user)
+        self.store.flush()
+        after = self.rows()
+        # Уже сохранённые строки не переписываются
+        self.assertEqual(after[:2], before)
+        self.assertEqual(after[2][1:], (2, "c"))
+
+    def test_rewrite_after_clear_info(self):
+        user = self.user("a", "b", "c")
+        self.store.mark_dirty(user)
+        self.store.flush()
+
+        user.info_message = user.info_message[:1]
+        self.store.mark_dirty(user, rewrite=True)
+        self.store.flush()
+        self.assertEqual([row[1:] for row in self.rows()], [(0, "a")])
+
+    def test_edited_entry_is_updated_in_place(self):
+        user = self.user("a", "b")
+        self.store.mark_dirty(user)
+        self.store.flush()
+        before = self.rows()
+
+        user.info_message[0]['user_text'] = "a2"
+        user.mark_edited(0)
+        self.store.mark_dirty(user)
+        self.store.flush()
+        self.assertEqual(self.rows(), [(before[0][0], 0, "a2"), before[1]])
+
+    def test_close_flushes_and_data_survives_reopen(self):
+        self.store.mark_dirty(self.user("a", "b"))
+        self.store.close()
+
+        store = self.open_store()
+        data = store.load_user(5)
+        self.assertEqual(data['mode'], 'info')
+        self.assertEqual([e['user_text'] for e in data['info_message']], ["a", "b"])
+
+
+if __name__ == "__main__":
+    unittest.main()
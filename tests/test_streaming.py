@@ -0,0 +1,55 @@
+import unittest
+from types import SimpleNamespace
+from streaming import StreamingReply, TELEGRAM_MESSAGE_LIMIT, split_message
+
+
+class FakeBot:
+    """Двойник бота: запоминает отправленные и отредактированные сообщения."""
+
+    def __init__(self):
+        self.texts = {}
+        self.edits = []
+
+    def send_message(self, chat_id, text, reply_markup=None):
+        message_id = len(self.texts) + 1
+        self.texts[message_id] = text
+        return SimpleNamespace(message_id=message_id)
+
+    def edit_message_text(self, text, chat_id, message_id):
+        self.texts[message_id] = text
+        self.edits.append((message_id, text))
+
+
+class StreamingReplyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = FakeBot()
+
+    def test_edits_are_throttled(self):
+        reply = StreamingReply(self.bot, 1, edit_interval=60)
+        self.assertEqual(reply.run(["a", "b", "c", "d"]), "abcd")
+        # Первый кусочек показывается сразу, остальное - одной правкой в конце
+        self.assertEqual(self.bot.edits, [(1, "a"), (1, "abcd")])
+
+    def test_every_chunk_is_shown_without_interval(self):
+        StreamingReply(self.bot, 1, edit_interval=0).run(["a", "b", "c"])
+        self.assertEqual(self.bot.edits, [(1, "a"), (1, "ab"), (1, "abc")])
+
+    def test_long_answer_continues_in_new_message(self):
+        text = "x" * (TELEGRAM_MESSAGE_LIMIT + 100)
+        StreamingReply(self.bot, 1, edit_interval=60).run([text[:3000], text[3000:]])
+        self.assertEqual(list(self.bot.texts.values()), split_message(text))
+
+    def test_partial_answer_is_shown_when_stream_breaks(self):
+        def chunks():
+            yield "начало"
+            raise ConnectionError("обрыв")
+
+        reply = StreamingReply(self.bot, 1, edit_interval=60)
+        with self.assertRaises(ConnectionError):
+            reply.run(chunks())
+        self.assertEqual(self.bot.texts, {1: "начало"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+from types import SimpleNamespace
+from user_cache import UserCache
+
+
+class FakeStore:
+    """Двойник хранилища: каждый пользователь есть на диске, очередь записи пуста."""
+
+    def __init__(self):
+        self.forgotten = []
+
+    def pending_user(self, user_id):
+        return None
+
+    def load_user(self, user_id):
+        return {'user_id': user_id}
+
+    def forget(self, user_id):
+        self.forgotten.append(user_id)
+
+
+class FakeUser(SimpleNamespace):
+
+    @staticmethod
+    def from_dict(data):
+        return FakeUser(user_id=data['user_id'])
+
+
+class UserCacheEvictionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FakeStore()
+        self.evicted = []
+        self.cache = UserCache(self.store, FakeUser, on_evict=lambda user: self.evicted.append(user.user_id),
+                               max_users=2, min_idle=0)
+
+    def test_cached_access_keeps_active_user(self):
+        active = self.cache.get(1)
+        self.cache.get(2)
+        # Сообщения активного пользователя в async_main проходят через cached()
+        for _ in range(3):
+            self.assertIs(self.cache.cached(1), active)
+
+        self.cache.get(3)
+        self.assertEqual(self.evicted, [2])
+        self.assertEqual(self.store.forgotten, [2])
+        self.assertIs(self.cache.cached(1), active)
+        self.assertIsNone(self.cache.cached(2))
+
+    def test_cached_does_not_load(self):
+        self.assertIsNone(self.cache.cached(5))
+        self.assertEqual(len(self.cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import json
+import queue
+import unittest
+import urllib.request
+import urllib.error
+from webhook import WebhookServer, SECRET_HEADER
+
+
+def message_update(update_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "test"},
+            "text": text
+        }
+    }
+
+
+# Запросы к локальному серверу - без HTTP_PROXY из окружения
+opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+class WebhookSecretTokenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatched = queue.Queue()
+        self.server = WebhookServer(self.dispatched.put, host="127.0.0.1", port=0,
+                                    path="/telegram", secret_token="right-token")
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+    def post(self, update, token):
+        host, port = self.server.address[:2]
+        request = urllib.request.Request(
+            f"http://{host}:{port}/telegram",
+            data=json.dumps(update).encode("utf-8"),
+            headers={"Content-Type": "application/json", SECRET_HEADER: token}
+        )
+        try:
+            with opener.open(request, timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def test_wrong_token_is_rejected(self):
+        self.assertEqual(self.post(message_update(1, "чужой"), "wrong-token"), 403)
+        # Обновление с правильным токеном приходит следующим: чужое до обработчика не дошло
+        self.assertEqual(self.post(message_update(2, "свой"), "right-token"), 200)
+        self.assertEqual(self.dispatched.get(timeout=5)["update_id"], 2)
+        self.assertTrue(self.dispatched.empty())
+
+    def test_right_token_is_dispatched(self):
+        update = message_update(3, "привет")
+        self.assertEqual(self.post(update, "right-token"), 200)
+        self.assertEqual(self.dispatched.get(timeout=5), update)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,28 @@
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# tiktoken необязателен: без него используется грубая оценка по длине текста
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+# Локальный подсчёт токенов в тексте
+def count_tokens(text, model="gpt-4o"):
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_encoding(model).encode(text))
+    # В среднем около трёх символов на токен для смеси русского и английского
+    return len(text) // 3 + 1
@@ -0,0 +1,146 @@
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class UserCache:
+    """
+    Пользователи в памяти: загружаются из хранилища при первом обращении и
+    вытесняются, когда их больше max_users (самые давние) или они не
+    обращались к боту дольше idle_timeout секунд.
+
+    Поддерживает операции словаря (in, [], []=, get), поэтому обработчики
+    работают с ним как с прежним user_data. Перед вытеснением незавершённая
+    запись режима 'info' переносится в info_message, а изменённый
+    пользователь остаётся в очереди записи хранилища. Пока запись не
+    завершена, повторное обращение возвращает тот же объект из очереди,
+    поэтому изменения не теряются.
+
+    Пользователи, обращавшиеся к боту меньше min_idle секунд назад, не
+    вытесняются: их обработчик может ещё выполняться (например, ждать GPT).
+    """
+
+    def __init__(self, store, user_class, on_evict=None, max_users=10000, idle_timeout=3600,
+                 min_idle=300, sweep_interval=60):
+        self.store = store
+        self.user_class = user_class
+        self.on_evict = on_evict
+        self.max_users = max_users
+        self.idle_timeout = idle_timeout
+        self.min_idle = min_idle
+        self.sweep_interval = sweep_interval
+        self._users = OrderedDict()
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+        self.stats = {'hits': 0, 'loads': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self._users)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __getitem__(self, user_id):
+        user = self.get(user_id)
+        if user is None:
+            raise KeyError(user_id)
+        return user
+
+    def __setitem__(self, user_id, user):
+        with self._lock:
+            self._users[user_id] = user
+            self._users.move_to_end(user_id)
+            self._last_used[user_id] = time.monotonic()
+        self._evict()
+
+    # Все пользователи, находящиеся в памяти
+    def values(self):
+        with self._lock:
+            return list(self._users.values())
+
+    # Пользователь, если он уже в памяти (без обращения к хранилищу и без вытеснения).
+    # Обращение учитывается, как в get(): активный пользователь не должен вытесняться
+    def cached(self, user_id):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is not None:
+                self._users.move_to_end(user_id)
+                self._last_used[user_id] = time.monotonic()
+                self.stats['hits'] += 1
+            return user
+
+    def get(self, user_id, default=None):
+        now = time.monotonic()
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is not None:
+                self._users.move_to_end(user_id)
+                self._last_used[user_id] = now
+                self.stats['hits'] += 1
+        if user is None:
+            user = self._load(user_id)
+            if user is None:
+                return default
+            with self._lock:
+                # Пока загружали, пользователя мог добавить другой поток
+                user = self._users.setdefault(user_id, user)
+                self._last_used[user_id] = now
+                self.stats['loads'] += 1
+            self._evict()
+        elif now >= self._next_sweep:
+            self._evict()
+        return user
+
+    def _load(self, user_id):
+        # Ещё не записанный на диск пользователь берётся из очереди хранилища
+        user = self.store.pending_user(user_id)
+        if user is not None:
+            return user
+        data = self.store.load_user(user_id)
+        if data is None:
+            return None
+        return self.user_class.from_dict(data)
+
+    # Вытеснение сверх max_users и простаивающих дольше idle_timeout
+    def _evict(self):
+        now = time.monotonic()
+        candidates = []
+        with self._lock:
+            sweep = now >= self._next_sweep
+            if sweep:
+                self._next_sweep = now + self.sweep_interval
+            # Порядок OrderedDict - от давних к недавним
+            for user_id, user in self._users.items():
+                last_used = self._last_used[user_id]
+                idle = now - last_used
+                if idle < self.min_idle:
+                    break
+                if len(self._users) - len(candidates) <= self.max_users and not (sweep and idle >= self.idle_timeout):
+                    break
+                candidates.append((user, last_used))
+
+        evicted = 0
+        for user, last_used in candidates:
+            # Незавершённая запись сохраняется, пока пользователь ещё в памяти: после
+            # mark_dirty() повторное обращение найдёт этот же объект в очереди
+            # хранилища, а не загрузит из хранилища устаревшую копию
+            if self.on_evict is not None:
+                try:
+                    self.on_evict(user)
+                except Exception as e:
+                    logger.error("Ошибка при вытеснении пользователя %s: %s", user.user_id, e)
+            with self._lock:
+                # Пока сохраняли, к пользователю могли обратиться снова
+                if self._users.get(user.user_id) is not user or self._last_used[user.user_id] != last_used:
+                    continue
+                del self._users[user.user_id]
+                del self._last_used[user.user_id]
+                self.stats['evictions'] += 1
+            self.store.forget(user.user_id)
+            evicted += 1
+        if evicted:
+            logger.debug("Вытеснено пользователей из памяти: %d, осталось: %d", evicted, len(self._users))
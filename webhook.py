@@ -0,0 +1,104 @@
+import json
+import hmac
+import queue
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Заголовок, в котором Telegram присылает secret_token из setWebhook
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """
+    Локальный HTTP-сервер для приёма обновлений Telegram через webhook.
+
+    Проверяет secret_token, сразу отвечает Telegram 200 и кладёт обновление
+    во внутреннюю очередь, из которой отдельный поток передаёт его в
+    handle_update (словарь в формате Bot API). HTTPS обычно обеспечивает
+    обратный прокси (nginx и т.п.), который пересылает запросы сюда.
+    """
+
+    def __init__(self, handle_update, host="127.0.0.1", port=8443, path="/telegram",
+                 secret_token=None, max_pending=1000):
+        self.handle_update = handle_update
+        self.path = path
+        self.secret_token = secret_token
+        self._updates = queue.Queue(max_pending)
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._intake = threading.Thread(target=self._intake_loop, name="webhook-intake", daemon=True)
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    @property
+    def queue_depth(self):
+        return self._updates.qsize()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self._reply(404)
+                    return
+                if server.secret_token and not hmac.compare_digest(
+                        self.headers.get(SECRET_HEADER, ""), server.secret_token):
+                    logger.warning("Webhook: запрос с неверным secret_token отклонён.")
+                    self._reply(403)
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    update = json.loads(self.rfile.read(length))
+                except (ValueError, json.JSONDecodeError):
+                    self._reply(400)
+                    return
+                try:
+                    server._updates.put_nowait(update)
+                except queue.Full:
+                    # Telegram повторит доставку позже
+                    logger.warning("Webhook: очередь обновлений переполнена.")
+                    self._reply(503)
+                    return
+                self._reply(200)
+
+            def _reply(self, status):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug("Webhook: " + format, *args)
+
+        return Handler
+
+    def _intake_loop(self):
+        while True:
+            update = self._updates.get()
+            if update is None:
+                return
+            try:
+                self.handle_update(update)
+            except Exception as e:
+                logger.exception("Webhook: ошибка при обработке обновления: %s", e)
+
+    def start(self):
+        self._intake.start()
+        threading.Thread(target=self._server.serve_forever, name="webhook-http", daemon=True).start()
+        logger.info("Webhook-сервер слушает %s:%s%s", self.address[0], self.address[1], self.path)
+
+    def serve_forever(self):
+        self._intake.start()
+        logger.info("Webhook-сервер слушает %s:%s%s", self.address[0], self.address[1], self.path)
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._updates.put(None)
+        self._intake.join()